@@ -0,0 +1,443 @@
+# Copyright 2018 Mikaël Swawola. All Rights Reserved.
+#
+# GNU GENERAL PUBLIC LICENSE
+# Version 3, 29 June 2007
+# ==============================================================================
+
+import os
+import sys
+import time
+import threading
+import argparse
+from pathlib import Path
+
+from scanner import scan
+import instrument
+
+# Annotation store backends
+STORES = ['text', 'sqlite']
+
+# Extension of the per-image label files
+LABEL_EXT = '.txt'
+
+# Delay during which updates are gathered before being written, in seconds
+FLUSH_DELAY = 0.5
+
+
+def format_boxes(boxes):
+    """
+    Format bounding boxes in the label file format
+
+    The first line is the number of boxes, followed by one
+    'x1 y1 x2 y2 label' line per box.
+
+    # Arguments
+        boxes: List of (x1, y1, x2, y2, label) tuples
+
+    # Returns
+        The content of the label file
+    """
+
+    lines = ['%d' % len(boxes)] + [' '.join(map(str, bbox)) for bbox in boxes]
+
+    return '\n'.join(lines) + '\n'
+
+
+def parse_boxes(text):
+    """
+    Parse the content of a label file
+
+    # Arguments
+        text: Content of the label file
+
+    # Returns
+        The list of (x1, y1, x2, y2, label) tuples
+    """
+
+    boxes = []
+    for (i, line) in enumerate(text.splitlines()):
+        if i == 0 or not line.strip():
+            continue
+        tmp = line.split()
+        boxes.append(tuple([int(c) for c in tmp[:4]] + tmp[4:]))
+
+    return boxes
+
+
+class TextStore():
+    """
+    Annotations stored in one label file per image
+    """
+
+    def __init__(self, folder):
+
+        self.folder = Path(folder)
+        self.folder.mkdir(parents=True, exist_ok=True)
+
+    def path(self, name):
+        """
+        Path of the label file of an image
+        """
+
+        return self.folder/(name + LABEL_EXT)
+
+    def get(self, name):
+        """
+        Return the boxes of an image (empty list if it is not labeled)
+
+        # Arguments
+            name: Image name (file name without extension)
+        """
+
+        try:
+            return parse_boxes(self.path(name).read_text())
+        except FileNotFoundError:
+            return []
+
+    def put(self, name, boxes):
+        """
+        Replace the boxes of an image
+
+        # Arguments
+            name: Image name (file name without extension)
+            boxes: List of (x1, y1, x2, y2, label) tuples
+        """
+
+        self.put_many([(name, boxes)])
+
+    def put_many(self, items, sync=False):
+        """
+        Replace the boxes of many images
+
+        Each label file is written to a temporary file and renamed, so it
+        is never left half-written.
+
+        # Arguments
+            items: Iterable of (name, boxes)
+            sync: Flush the files to disk, with a single sync of the folder at the end
+
+        # Returns
+            The number of images written
+        """
+
+        count = 0
+        for name, boxes in items:
+            tmp = self.path(name).with_suffix('.tmp')
+            with tmp.open('w') as f:
+                f.write(format_boxes(boxes))
+                if sync:
+                    f.flush()
+                    os.fsync(f.fileno())
+            os.replace(tmp, self.path(name))
+            count += 1
+
+        if sync and count and hasattr(os, 'O_DIRECTORY'):
+            fd = os.open(self.folder, os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+        return count
+
+    def texts(self):
+        """
+        Iterate over the (name, label file content) of all labeled images
+        """
+
+        for entry in scan(self.folder, extensions=[LABEL_EXT]):
+            with open(entry.path) as f:
+                yield entry.name[:-len(LABEL_EXT)], f.read()
+
+    def items(self):
+        """
+        Iterate over the (name, boxes) of all labeled images
+        """
+
+        for name, text in self.texts():
+            yield name, parse_boxes(text)
+
+    def close(self):
+        """
+        Nothing to release
+        """
+
+
+class SQLiteStore():
+    """
+    Annotations of a whole folder stored in a single SQLite file
+
+    Each image is one row, holding its label file content, so opening the
+    store does not depend on the number of images and each update is a
+    single atomic transaction. The database is in WAL mode so readers are
+    not blocked by writes.
+    """
+
+    def __init__(self, path):
+
+        import sqlite3
+
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(str(self.path))
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS labels (image TEXT PRIMARY KEY, boxes TEXT)')
+
+    def get(self, name):
+        """
+        Return the boxes of an image (empty list if it is not labeled)
+
+        # Arguments
+            name: Image name (file name without extension)
+        """
+
+        row = self.db.execute('SELECT boxes FROM labels WHERE image = ?', (name,)).fetchone()
+
+        return parse_boxes(row[0]) if row is not None else []
+
+    def put(self, name, boxes):
+        """
+        Replace the boxes of an image, atomically
+
+        # Arguments
+            name: Image name (file name without extension)
+            boxes: List of (x1, y1, x2, y2, label) tuples
+        """
+
+        with self.db:
+            self.db.execute('INSERT OR REPLACE INTO labels VALUES (?, ?)', (name, format_boxes(boxes)))
+
+    def put_many(self, items, sync=False):
+        """
+        Replace the boxes of many images in a single transaction
+
+        # Arguments
+            items: Iterable of (name, boxes)
+            sync: Flush the transaction to disk when it is committed
+
+        # Returns
+            The number of images written
+        """
+
+        self.db.execute('PRAGMA synchronous=%s' % ('FULL' if sync else 'NORMAL'))
+        with self.db:
+            cursor = self.db.executemany('INSERT OR REPLACE INTO labels VALUES (?, ?)',
+                                         ((name, format_boxes(boxes)) for name, boxes in items))
+
+        return cursor.rowcount
+
+    def texts(self):
+        """
+        Iterate over the (name, label file content) of all labeled images
+        """
+
+        return self.db.execute('SELECT image, boxes FROM labels ORDER BY image')
+
+    def items(self):
+        """
+        Iterate over the (name, boxes) of all labeled images
+        """
+
+        for name, text in self.texts():
+            yield name, parse_boxes(text)
+
+    def close(self):
+        """
+        Close the database
+        """
+
+        self.db.close()
+
+
+def open_store(kind, folder):
+    """
+    Open the annotation store of an images folder
+
+    # Arguments
+        kind: One of STORES
+        folder: Label folder of the images folder (Labels/<images folder name>);
+                the SQLite store is the file with the same name and a .sqlite extension
+
+    # Returns
+        A TextStore or a SQLiteStore
+    """
+
+    folder = Path(folder)
+    if kind == 'sqlite':
+        return SQLiteStore(folder.with_name(folder.name + '.sqlite'))
+
+    return TextStore(folder)
+
+
+class WriteBehind():
+    """
+    Annotation store whose updates are written by a background thread
+
+    put() only queues the boxes of an image and returns immediately. The
+    thread gathers the updates for FLUSH_DELAY seconds and writes them as
+    one synced batch, with its own connection to the store. get() sees
+    the queued updates. flush() waits until everything is written.
+    """
+
+    def __init__(self, kind, folder, delay=FLUSH_DELAY):
+
+        self.kind = kind
+        self.folder = folder
+        self.delay = delay
+        self.reader = open_store(kind, folder)
+        self.pending = {}
+        self.writing = {}
+        self.urgent = False
+        self.closed = False
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def get(self, name):
+        """
+        Return the boxes of an image, including the updates not written yet
+        """
+
+        with self.cond:
+            for queue in (self.pending, self.writing):
+                if name in queue:
+                    return list(queue[name])
+
+        return self.reader.get(name)
+
+    def put(self, name, boxes):
+        """
+        Queue the boxes of an image for writing
+        """
+
+        with self.cond:
+            self.pending[name] = list(boxes)
+            self.cond.notify_all()
+
+    def items(self):
+        """
+        Iterate over the (name, boxes) of all labeled images, once flushed
+        """
+
+        self.flush()
+        return self.reader.items()
+
+    def run(self):
+        """
+        Background thread: write the queued updates in batches
+        """
+
+        store = open_store(self.kind, self.folder)
+        while True:
+            with self.cond:
+                while not self.pending and not self.closed:
+                    self.cond.wait()
+                if not self.pending:
+                    break
+                deadline = time.monotonic() + self.delay
+                while not (self.closed or self.urgent) and time.monotonic() < deadline:
+                    self.cond.wait(deadline - time.monotonic())
+                self.writing, self.pending = self.pending, {}
+
+            try:
+                with instrument.stage('write labels'):
+                    store.put_many(self.writing.items(), sync=True)
+            except Exception as e:
+                print(f'Error while saving {len(self.writing)} label(s): {e}')
+
+            with self.cond:
+                self.writing = {}
+                self.cond.notify_all()
+        store.close()
+
+    def flush(self):
+        """
+        Wait until all the queued updates are written
+        """
+
+        with self.cond:
+            self.urgent = True
+            self.cond.notify_all()
+            while self.pending or self.writing:
+                self.cond.wait()
+            self.urgent = False
+
+    def close(self):
+        """
+        Write the queued updates and stop the thread
+        """
+
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        self.thread.join()
+        self.reader.close()
+
+
+def copy_store(src, dst):
+    """
+    Copy all the annotations of a store into another one
+
+    # Returns
+        The number of images copied
+    """
+
+    return dst.put_many(src.items())
+
+
+def add_arguments(parser):
+    """
+    Add the command line arguments to a parser
+    """
+
+    parser.add_argument('-l','--labels', help='Label folder (Labels/<images folder name>)', required=True, type=str)
+    parser.add_argument('--export', help='Export the SQLite store to one label file per image', action='store_true')
+    parser.add_argument('--import', help='Import the label files into the SQLite store', action='store_true', dest='import_')
+
+
+def parse_arguments():
+    """
+    Parse command line arguments.
+
+    # Returns
+        Dictionnary containing the command line arguments
+    """
+
+    parser = argparse.ArgumentParser(description='Annotation store export and import')
+    add_arguments(parser)
+    args = vars(parser.parse_args())
+
+    return args
+
+
+def main(args=None):
+    """
+    Main function
+
+    # Arguments
+        args: Dictionnary of command line arguments (default: parsed from sys.argv)
+    """
+
+    if args is None:
+        args = parse_arguments()
+
+    if args['export'] == args['import_']:
+        print('Please choose either --export or --import')
+        sys.exit(1)
+
+    sqlite_store = open_store('sqlite', args['labels'])
+    text_store = open_store('text', args['labels'])
+
+    if args['export']:
+        count = copy_store(sqlite_store, text_store)
+    else:
+        count = copy_store(text_store, sqlite_store)
+    sqlite_store.close()
+
+    print(f'{count} images copied')
+    print('Done!')
+
+
+if __name__ == "__main__":
+    main()
@@ -13,26 +13,252 @@
 from __future__ import division
 from tkinter import *
 from tkinter import Tk, messagebox, filedialog
-from PIL import Image, ImageTk
-import os, sys
 from tkinter import ttk
-import glob
-import random
+import os
+import math
+import time
+import shutil
+import argparse
+import threading
+from hashlib import sha1
+from collections import OrderedDict
 
 from pathlib import Path
+from annotations import STORES
+import instrument
+from session import MAX_SIZE, CACHE_MB, LabelingSession, LatencyCounter
+from lazy import lazy_import
+
+Image = lazy_import('PIL.Image')
+ImageTk = lazy_import('PIL.ImageTk')
 
 # Colors for the bounding boxes
 COLORS = ['red', 'blue', 'yellow', 'pink', 'cyan', 'green', 'black']
 
-# Supported image formats
-IMAGE_FORMATS = ['.jpeg', '.jpg', '.png', '.JPEG', '.PNG', '.JPG']
+# Size of the tiles of the image pyramid used when zooming
+TILE_SIZE = 256
+
+# Folder of the tiles cache, and its disk budget in MB
+TILE_CACHE = Path('Labels')/'.tiles'
+TILE_CACHE_MB = 2048
+
+# Number of tiles kept in memory
+TILE_MEMORY = 256
+
+# Maximum scale of the zoomed image, in displayed pixels per image pixel
+MAX_SCALE = 8
+
+# Minimum delay between two redraws of the cursor, in ms (about one display frame)
+FRAME_MS = 16
 
-# Maximum size for width or height, because scrolling and zooming the image is not supported yet
-MAX_SIZE = 512
+# Delay between two checks of the tiles being built in the background, in ms
+TILE_POLL_MS = 50
 
 # Name of the text file containing the labels
 LABEL_FILE = 'class.txt'
 
+
+def trim_tile_cache(cache_dir=TILE_CACHE, budget_mb=TILE_CACHE_MB, keep=None):
+    """
+    Remove the tiles of the least recently opened images until the tiles
+    cache fits in budget_mb
+
+    # Arguments
+        cache_dir: Folder of the tiles cache (one sub-folder per image)
+        budget_mb: Disk budget of the cache, in MB
+        keep: Sub-folder never removed (the image being displayed)
+    """
+
+    folders = []
+    for entry in os.scandir(cache_dir):
+        if entry.is_dir():
+            size = sum(f.stat().st_size for f in os.scandir(entry.path))
+            folders.append((entry.stat().st_mtime, entry.path, size))
+
+    total = sum(size for (_, _, size) in folders)
+    for _, path, size in sorted(folders):
+        if total <= budget_mb * 1024 * 1024:
+            break
+        if keep is not None and Path(path) == Path(keep):
+            continue
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+
+
+class TilePyramid():
+    """
+    Multi-resolution tiles of an image, built in the background and cached on disk
+
+    Level n is the image downscaled by 2**n, cut in TILE_SIZE x TILE_SIZE
+    tiles. The first time a tile of a level is missing, a background
+    thread decodes the image at that level (directly at reduced scale for
+    JPEG images), saves all the tiles of the level to the cache folder,
+    the requested ones first, and drops the decoded image. tile() never
+    decodes the image: it returns None until the tile is ready. The
+    cache folder is trimmed to TILE_CACHE_MB after each level is built.
+    """
+
+    def __init__(self, path, cache_dir=TILE_CACHE):
+
+        self.path = Path(path)
+        st = self.path.stat()
+        key = sha1(f'{self.path.resolve()}:{st.st_size}:{st.st_mtime_ns}'.encode()).hexdigest()[:16]
+        self.cache_dir = Path(cache_dir)
+        self.dir = self.cache_dir/key
+        if self.dir.exists():
+            os.utime(self.dir) # Recently used, see trim_tile_cache
+        with Image.open(self.path) as img:
+            self.size = img.size
+            self.format = img.format
+        self.tiles = OrderedDict()
+        self.lock = threading.Lock()
+        self.wanted = {}
+        self.building = None
+        self.failed = set()
+        self.thread = None
+        self.closed = False
+
+    def level_size(self, level):
+        """
+        Size of the image at a level
+        """
+
+        return tuple(-(-s // 2 ** level) for s in self.size)
+
+    def tile_path(self, level, tx, ty):
+        """
+        Path of a tile in the cache folder
+        """
+
+        return self.dir/f'{level}_{tx}_{ty}.png'
+
+    def remember(self, key, img):
+        """
+        Keep a tile in memory, evicting the least recently used ones
+        """
+
+        with self.lock:
+            self.tiles[key] = img
+            self.tiles.move_to_end(key)
+            if len(self.tiles) > TILE_MEMORY:
+                self.tiles.popitem(last=False)
+
+    def tile(self, level, tx, ty):
+        """
+        Return the tile (tx, ty) of a level, or None if it is not built yet
+        (its level is then built in the background)
+        """
+
+        key = (level, tx, ty)
+        with self.lock:
+            if key in self.tiles:
+                self.tiles.move_to_end(key)
+                return self.tiles[key]
+
+        try:
+            img = Image.open(self.tile_path(level, tx, ty))
+            img.load()
+        except OSError:
+            self.request(level, (tx, ty))
+            return None
+
+        self.remember(key, img)
+        return img
+
+    def request(self, level, position):
+        """
+        Queue the build of a level, the tile at position first
+        """
+
+        with self.lock:
+            if self.closed or level in self.failed or level == self.building:
+                return
+            wanted = self.wanted.pop(level, set())
+            wanted.add(position)
+            self.wanted[level] = wanted # The latest level is built first
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+
+    def busy(self):
+        """
+        Whether levels are being built
+        """
+
+        return self.thread is not None
+
+    def close(self):
+        """
+        Stop building levels (the image is not displayed anymore)
+        """
+
+        with self.lock:
+            self.closed = True
+            self.wanted.clear()
+
+    def run(self):
+        """
+        Background thread: build the requested levels
+        """
+
+        while True:
+            with self.lock:
+                if self.closed or not self.wanted:
+                    self.building = self.thread = None
+                    return
+                level, first = self.wanted.popitem()
+                self.building = level
+            try:
+                self.build(level, first)
+                trim_tile_cache(self.cache_dir, keep=self.dir)
+            except Exception as e:
+                print(f'Cannot build the tiles of {self.path}: {e!r}')
+                with self.lock:
+                    self.failed.add(level)
+
+    def decode(self, level):
+        """
+        Decode the whole image at a level
+        """
+
+        with Image.open(self.path) as img:
+            if level > 0 and self.format == 'JPEG':
+                img.draft('RGB', self.level_size(level))
+            img.load()
+            if img.mode not in ('RGB', 'L'):
+                img = img.convert('RGB')
+            factor = max(1, round(2 ** level * img.width / self.size[0]))
+            if factor > 1:
+                img = img.reduce(factor)
+            if img.size != self.level_size(level):
+                img = img.resize(self.level_size(level), Image.BOX)
+
+            return img.convert('RGB')
+
+    @instrument.timed('build tiles')
+    def build(self, level, first):
+        """
+        Save all the tiles of a level, those of first (set of positions) first
+        """
+
+        src = self.decode(level)
+        columns, rows = (-(-s // TILE_SIZE) for s in src.size)
+        positions = sorted(((tx, ty) for ty in range(rows) for tx in range(columns)), key=lambda p: p not in first)
+        self.dir.mkdir(parents=True, exist_ok=True)
+        for tx, ty in positions:
+            if self.closed:
+                return
+            path = self.tile_path(level, tx, ty)
+            if path.exists():
+                continue
+            img = src.crop((tx * TILE_SIZE, ty * TILE_SIZE,
+                            min((tx + 1) * TILE_SIZE, src.width), min((ty + 1) * TILE_SIZE, src.height)))
+            tmp = path.with_suffix('.tmp')
+            img.save(tmp, format='PNG', compress_level=1)
+            os.replace(tmp, path)
+            self.remember((level, tx, ty), img)
+
+
 class BboxTool():
     """
     Bounding Box Labeling Class
@@ -47,7 +273,8 @@ class BboxTool():
         self.parent.title("Multi-object bounding box labeling tool")
         self.frame = Frame(self.parent)
         self.frame.pack(fill=BOTH, expand=1) # Make the frame fill the entire parent
-        root.resizable(width=True, height=True)
+        self.parent.resizable(width=True, height=True)
+        self.parent.protocol('WM_DELETE_WINDOW', self.quit)
 
 
     def setup_widgets(self):
@@ -79,16 +306,16 @@ class BboxTool():
         Initialize global state
         """
 
-        self.image_list = []
-        self.outDir = ''
-        self.current_img = 1 # Default to the 1st image in the collection
         self.directory = 0
-        self.imagename = ''
-        self.labelfilename = ''
         self.tkimg = None
         self.ratio = 1.0
         self.selected_label = ''
         self.multi_label = True
+        self.base_ratio = 1.0
+        self.zoom = 0
+        self.pyramid = None
+        self.tile_items = {}
+        self.tiles_pending = False
 
     def set_label(self, eventObject):
         """
@@ -122,8 +349,9 @@ class BboxTool():
         self.cbox_label.current(0)
         self.selected_label = self.cbox_label.get()
 
-    def __init__(self, master):
+    def __init__(self, master, cache_mb=CACHE_MB, store='text', prelabel=False):
         
+        self.session = LabelingSession(store=store, cache_mb=cache_mb, prelabel=prelabel)
         self.initialize_class_members()
         self.setup_main_frame(master)
         self.setup_widgets()
@@ -136,20 +364,40 @@ class BboxTool():
         # reference to bbox
         self.bboxIdList = []
         self.bboxId = None
-        self.bboxList = []
-        self.bboxList_display = []
         self.hl = None
         self.vl = None
 
-        # main panel for labeling
-        self.mainPanel = Canvas(self.frame, cursor='tcross')
+        # latest mouse position, drawn at most once per frame
+        self.cursor = None
+        self.cursor_pending = False
+        self.motion_events = 0
+        self.motion_latency = LatencyCounter('cursor redraw')
+
+        # main panel for labeling, with scrollbars
+        self.panelFrame = Frame(self.frame)
+        self.mainPanel = Canvas(self.panelFrame, cursor='tcross')
+        self.xscroll = Scrollbar(self.panelFrame, orient=HORIZONTAL, command=self.scrollX)
+        self.yscroll = Scrollbar(self.panelFrame, orient=VERTICAL, command=self.scrollY)
+        self.mainPanel.config(xscrollcommand=self.xscroll.set, yscrollcommand=self.yscroll.set)
         self.mainPanel.bind("<Button-1>", self.mouseClick)
         self.mainPanel.bind("<Motion>", self.mouseMove)
+        self.mainPanel.bind("<MouseWheel>", self.mouseWheel)  # zoom (Windows, macOS)
+        self.mainPanel.bind("<Button-4>", self.mouseWheel)  # zoom (X11)
+        self.mainPanel.bind("<Button-5>", self.mouseWheel)
+        self.mainPanel.bind("<ButtonPress-2>", self.panStart)  # pan with the middle button
+        self.mainPanel.bind("<B2-Motion>", self.panMove)
         self.parent.bind("<Escape>", self.cancelBBox)  # press <Espace> to cancel current bbox
         #self.parent.bind("s", self.cancelBBox)
         self.parent.bind("<Left>", self.prevImage)
         self.parent.bind("<Right>", self.nextImage)
-        self.mainPanel.grid(row = 3, column = 0, rowspan = 4, columnspan=2, sticky = W+N)
+        self.parent.bind("a", self.acceptProposals)  # accept the proposed boxes
+        self.parent.bind("<plus>", self.zoomIn)
+        self.parent.bind("<equal>", self.zoomIn)
+        self.parent.bind("<minus>", self.zoomOut)
+        self.mainPanel.grid(row = 0, column = 0, sticky = W+N)
+        self.yscroll.grid(row = 0, column = 1, sticky = N+S)
+        self.xscroll.grid(row = 1, column = 0, sticky = W+E)
+        self.panelFrame.grid(row = 3, column = 0, rowspan = 4, columnspan=2, sticky = W+N)
 
         self.setup_combobox_widget()
 
@@ -170,6 +418,8 @@ class BboxTool():
         self.prevBtn.pack(side = LEFT, padx = 5, pady = 3)
         self.nextBtn = Button(self.ctrPanel, text='Next >>', width = 10, command = self.nextImage)
         self.nextBtn.pack(side = LEFT, padx = 5, pady = 3)
+        self.acceptBtn = Button(self.ctrPanel, text='Accept (a)', width = 10, command = self.acceptProposals)
+        self.acceptBtn.pack(side = LEFT, padx = 5, pady = 3)
         self.progLabel = Label(self.ctrPanel, text = "Progress:     /    ")
         self.progLabel.pack(side = LEFT, padx = 5)
         self.tmpLabel = Label(self.ctrPanel, text = "Go to Image No.")
@@ -194,9 +444,10 @@ class BboxTool():
         if not self.directory.is_dir() or not self.directory.exists():
             showerror("Error!", message = f"{self.directory} doesn't exist!")
             self.dir.set("")
-            return
+            return False
 
         self.dir.set(self.directory) # Update directory label
+        return True
 
 
     def load_directory(self):
@@ -210,147 +461,276 @@ class BboxTool():
         self.parent.focus()
         
         # Set directory
-        self.set_directory(path)
+        if not self.set_directory(path):
+            return
 
-        # Get image list
-        imageList = list(self.directory.iterdir())
-        self.image_list = [x for x in imageList if x.suffix in IMAGE_FORMATS]
-        if len(self.image_list) == 0:
+        # Open the images and their annotation store
+        count = self.session.open_directory(self.directory)
+        if count == 0:
             print(f'No images found in {path}')
             return
-
-        # Setup output dir
-        self.outDir = Path('Labels')/self.directory.name
-        if not Path('Labels').exists():
-            Path('Labels').mkdir()
-        if not self.outDir.exists():
-            self.outDir.mkdir()
         
         self.loadImage()
-        print(f'{len(self.image_list)} images loaded from {self.directory}')
+        print(f'{count} images loaded from {self.directory}')
 
 
     def loadImage(self):
         """
-        Load image
+        Display the current image of the session and its boxes
         """
 
-        imagepath = self.image_list[self.current_img - 1]
-        img = Image.open(imagepath)
+        imagepath = self.session.imagepath()
+        img, self.ratio = self.session.image, self.session.ratio
         self.curimg.set(imagepath.name)
-
-        width, height = img.size
-
-        # Resize image to fit on screen (zooming and scrolling are not supported yet)
-        if width > height:
-            if width > MAX_SIZE:
-                print('W')
-                self.ratio = width / MAX_SIZE
-                img.thumbnail((MAX_SIZE,int(height/self.ratio)))
-        else:
-            if height > MAX_SIZE:
-                print('H')
-                self.ratio = height / MAX_SIZE
-                img.thumbnail((int(width/self.ratio), MAX_SIZE))
+        
+        # Reset the zoom
+        self.base_ratio = self.ratio
+        self.zoom = 0
+        if self.pyramid is not None:
+            self.pyramid.close()
+        self.pyramid = None
+        self.tile_items = {}
+        self.mainPanel.delete('image', 'tile')
         
         self.tkimg = ImageTk.PhotoImage(img)
         self.mainPanel.config(width=max(self.tkimg.width(), MAX_SIZE), height=max(self.tkimg.height(), MAX_SIZE))
-        self.mainPanel.create_image(0, 0, image = self.tkimg, anchor=NW)
-        
+        self.mainPanel.config(scrollregion=(0, 0, self.tkimg.width(), self.tkimg.height()))
+        self.mainPanel.xview_moveto(0)
+        self.mainPanel.yview_moveto(0)
+        self.mainPanel.create_image(0, 0, image = self.tkimg, anchor=NW, tags='image')
+        self.mainPanel.tag_lower('image')
+
         # Update Progress indicator
-        self.progLabel.config(text = f"{self.current_img}/{len(self.image_list)}")
-
-        # load labels
-        self.clearBBox()
-        self.imagename = imagepath.stem
-        labelname = self.imagename + '.txt'
-        self.labelfilename = os.path.join(self.outDir, labelname)
-        bbox_cnt = 0
-        if os.path.exists(self.labelfilename):
-            with open(self.labelfilename) as f:
-                for (i, line) in enumerate(f):
-                    if i == 0:
-                        bbox_cnt = int(line.strip())
-                        continue
-                    tmp = line.split()
-                    tmp[0] = int(tmp[0])
-                    tmp[1] = int(tmp[1])
-                    tmp[2] = int(tmp[2])
-                    tmp[3] = int(tmp[3])
-                    if tmp[-1] is None:
-                        tmp.append('Loaded')
-                    self.bboxList.append(tuple(tmp))
-                    tmp_disp = []
-                    tmp_disp.append(int(tmp[0]/self.ratio))
-                    tmp_disp.append(int(tmp[1]/self.ratio))
-                    tmp_disp.append(int(tmp[2]/self.ratio))
-                    tmp_disp.append(int(tmp[3]/self.ratio))
-                    self.bboxList_display.append(tuple(tmp_disp))
-   
-                    tmpId = self.mainPanel.create_rectangle(
-                        tmp_disp[0],
-                        tmp_disp[1],
-                        tmp_disp[2],
-                        tmp_disp[3],
-                        width=2,
-                        outline=COLORS[(len(self.bboxList)-1) % len(COLORS)])
-                    self.bboxIdList.append(tmpId)
-                    self.listbox.insert(END, f'{tmp[4]} : ({tmp[0]}, {tmp[1]}) -> ({tmp[2]}, {tmp[3]})')
-                    self.listbox.itemconfig(len(self.bboxIdList) - 1, fg = COLORS[(len(self.bboxIdList) - 1) % len(COLORS)])
-
-
-    def save_bounding_box(self):
-        """
-        Save Bounding box
-        """
-
-        with open(self.labelfilename, 'w') as f:
-            f.write('%d\n' %len(self.bboxList))
-            print(self.bboxList)
-            for bbox in self.bboxList:
-                if bbox[-1] is None:
-                    bbox = (int(int(bbox[0])*self.ratio),
-                        int(int(bbox[1])*self.ratio),
-                        int(int(bbox[2])*self.ratio),
-                        int(int(bbox[3])*self.ratio),
-                        bbox[4])
-                               
-                f.write(' '.join(map(str, bbox)) + '\n')
-        print(f'Image {self.labelfilename} saved')
+        self.progLabel.config(text = f"{self.session.current_img}/{len(self.session.image_list)}")
+
+        # Draw the labels
+        self.removeBoxItems()
+        boxes = self.session.bboxList + self.session.proposals
+        for tmp, tmp_disp in zip(boxes, self.session.display_boxes(self.ratio)):
+            tmpId = self.mainPanel.create_rectangle(
+                tmp_disp[0],
+                tmp_disp[1],
+                tmp_disp[2],
+                tmp_disp[3],
+                width=2,
+                dash=(4, 2) if len(self.bboxIdList) >= len(self.session.bboxList) else None,
+                outline=COLORS[len(self.bboxIdList) % len(COLORS)])
+            self.bboxIdList.append(tmpId)
+            self.listbox.insert(END, f'{tmp[4]} : ({tmp[0]}, {tmp[1]}) -> ({tmp[2]}, {tmp[3]})')
+            self.listbox.itemconfig(len(self.bboxIdList) - 1, fg = COLORS[(len(self.bboxIdList) - 1) % len(COLORS)])
 
 
     def mouseClick(self, event):
+        x, y = self.mainPanel.canvasx(event.x), self.mainPanel.canvasy(event.y)
         if self.STATE['click'] == 0:
-            self.STATE['x'], self.STATE['y'] = event.x, event.y
+            self.STATE['x'], self.STATE['y'] = x, y
         else:
-            x1, x2 = min(self.STATE['x'], event.x), max(self.STATE['x'], event.x)
-            y1, y2 = min(self.STATE['y'], event.y), max(self.STATE['y'], event.y)
-            if self.multi_label:
-                self.bboxList.append((x1, y1, x2, y2, self.selected_label, None))
-            else:
-                self.bboxList.append((x1, y1, x2, y2, None))
-            self.bboxIdList.append(self.bboxId)
+            # Boxes are stored in original image coordinates
+            if self.bboxId:
+                self.mainPanel.coords(self.bboxId, self.STATE['x'], self.STATE['y'], x, y)
+            x1, y1, x2, y2, _ = self.session.add_box(self.STATE['x'] * self.ratio, self.STATE['y'] * self.ratio,
+                                                     x * self.ratio, y * self.ratio,
+                                                     self.selected_label if self.multi_label else None)
+            # The new box goes before the proposals
+            idx = len(self.session.bboxList) - 1
+            self.bboxIdList.insert(idx, self.bboxId)
             self.bboxId = None
-            self.listbox.insert(END, '(%d, %d) -> (%d, %d)' %(x1, y1, x2, y2))
-            self.listbox.itemconfig(len(self.bboxIdList) - 1, fg = COLORS[(len(self.bboxIdList) - 1) % len(COLORS)])
+            self.listbox.insert(idx, '(%d, %d) -> (%d, %d)' %(x1, y1, x2, y2))
+            self.listbox.itemconfig(idx, fg = COLORS[(len(self.bboxIdList) - 1) % len(COLORS)])
         self.STATE['click'] = 1 - self.STATE['click']
 
     def mouseMove(self, event):
-        self.disp.config(text = 'x: %d, y: %d' %(event.x, event.y))
+        # Only record the position: bursts of motion events are coalesced
+        # into one redraw per frame
+        self.cursor = (event.x, event.y)
+        self.motion_events += 1
+        if not self.cursor_pending:
+            self.cursor_pending = True
+            self.mainPanel.after(FRAME_MS, self.drawCursor)
+
+    def drawCursor(self):
+        """
+        Move the crosshair and the box being drawn to the latest mouse position
+        """
+
+        start = time.perf_counter()
+        self.cursor_pending = False
+        x, y = self.mainPanel.canvasx(self.cursor[0]), self.mainPanel.canvasy(self.cursor[1])
+        self.disp.config(text = 'x: %d, y: %d' %(x * self.ratio, y * self.ratio))
         if self.tkimg:
+            width, height = self.displaySize()
             if self.hl:
-                self.mainPanel.delete(self.hl)
-            self.hl = self.mainPanel.create_line(0, event.y, self.tkimg.width(), event.y, width = 2)
+                self.mainPanel.coords(self.hl, 0, y, width, y)
+            else:
+                self.hl = self.mainPanel.create_line(0, y, width, y, width = 2)
             if self.vl:
-                self.mainPanel.delete(self.vl)
-            self.vl = self.mainPanel.create_line(event.x, 0, event.x, self.tkimg.height(), width = 2)
+                self.mainPanel.coords(self.vl, x, 0, x, height)
+            else:
+                self.vl = self.mainPanel.create_line(x, 0, x, height, width = 2)
         if 1 == self.STATE['click']:
             if self.bboxId:
-                self.mainPanel.delete(self.bboxId)
-            self.bboxId = self.mainPanel.create_rectangle(self.STATE['x'], self.STATE['y'], \
-                                                            event.x, event.y, \
-                                                            width = 2, \
-                                                            outline = COLORS[len(self.bboxList) % len(COLORS)])
+                self.mainPanel.coords(self.bboxId, self.STATE['x'], self.STATE['y'], x, y)
+            else:
+                self.bboxId = self.mainPanel.create_rectangle(self.STATE['x'], self.STATE['y'], \
+                                                                x, y, \
+                                                                width = 2, \
+                                                                outline = COLORS[len(self.session.bboxList) % len(COLORS)])
+        self.motion_latency.add(time.perf_counter() - start)
+
+    def quit(self):
+        """
+        Write out the pending labels, print the cursor redraw statistics and close the window
+        """
+
+        print(f'{self.motion_events} motion events, ' + self.motion_latency.summary())
+        if self.pyramid is not None:
+            self.pyramid.close()
+        self.session.close()
+        self.parent.destroy()
+
+    def displaySize(self):
+        """
+        Size of the displayed image at the current zoom
+        """
+
+        if self.zoom == 0 or self.pyramid is None:
+            return self.tkimg.width(), self.tkimg.height()
+        return tuple(math.ceil(s / self.ratio) for s in self.pyramid.size)
+
+    def maxZoom(self):
+        """
+        Highest zoom level at which an image pixel is at most MAX_SCALE displayed pixels wide
+        """
+
+        return max(0, int(math.floor(math.log2(self.base_ratio * MAX_SCALE))))
+
+    def setZoom(self, zoom, x=None, y=None):
+        """
+        Change the zoom level, keeping the point (x, y) of the panel in place
+
+        Zoom level 0 shows the image fitted in MAX_SIZE, each level doubles the scale.
+        """
+
+        if not self.session.image_list or self.tkimg is None or zoom == self.zoom or not 0 <= zoom <= self.maxZoom():
+            return
+        if self.pyramid is None:
+            self.pyramid = TilePyramid(self.session.imagepath())
+        self.cancelBBox(None)
+
+        if x is None:
+            x, y = self.mainPanel.winfo_width() / 2, self.mainPanel.winfo_height() / 2
+        ox = self.mainPanel.canvasx(x) * self.ratio
+        oy = self.mainPanel.canvasy(y) * self.ratio
+
+        self.zoom = zoom
+        self.ratio = self.base_ratio / 2 ** zoom
+        width, height = self.displaySize()
+        self.mainPanel.config(scrollregion=(0, 0, width, height))
+        self.mainPanel.xview_moveto((ox / self.ratio - x) / width)
+        self.mainPanel.yview_moveto((oy / self.ratio - y) / height)
+        self.redraw()
+
+    def zoomIn(self, event=None):
+        self.setZoom(self.zoom + 1)
+
+    def zoomOut(self, event=None):
+        self.setZoom(self.zoom - 1)
+
+    def mouseWheel(self, event):
+        step = 1 if event.num == 4 or event.delta > 0 else -1
+        self.setZoom(self.zoom + step, event.x, event.y)
+
+    def panStart(self, event):
+        self.mainPanel.scan_mark(event.x, event.y)
+
+    def panMove(self, event):
+        self.mainPanel.scan_dragto(event.x, event.y, gain=1)
+        self.drawTiles()
+
+    def scrollX(self, *args):
+        self.mainPanel.xview(*args)
+        self.drawTiles()
+
+    def scrollY(self, *args):
+        self.mainPanel.yview(*args)
+        self.drawTiles()
+
+    def redraw(self):
+        """
+        Redraw the image and the boxes at the current zoom
+        """
+
+        self.mainPanel.delete('tile')
+        self.tile_items = {}
+        self.mainPanel.itemconfig('image', state=NORMAL if self.zoom == 0 else HIDDEN)
+        self.drawTiles()
+        for bbox, bboxId in zip(self.session.bboxList + self.session.proposals, self.bboxIdList):
+            self.mainPanel.coords(bboxId, *[int(c / self.ratio) for c in bbox[:4]])
+
+    def drawTiles(self):
+        """
+        Draw the pyramid tiles visible in the panel, and drop the others
+
+        Each tile is cropped to the part visible in the panel before it is
+        scaled, so the images given to Tk are never larger than the panel,
+        and is drawn again when its visible part changes. The tiles being
+        built in the background are drawn when they are ready, by checking
+        again every TILE_POLL_MS.
+        """
+
+        if self.zoom == 0 or self.pyramid is None:
+            return
+
+        level = max(0, int(math.floor(math.log2(self.ratio)))) if self.ratio >= 1 else 0
+        scale = 2 ** level / self.ratio
+        lw, lh = self.pyramid.level_size(level)
+
+        x0, y0 = self.mainPanel.canvasx(0), self.mainPanel.canvasy(0)
+        x1 = self.mainPanel.canvasx(self.mainPanel.winfo_width())
+        y1 = self.mainPanel.canvasy(self.mainPanel.winfo_height())
+        tile = TILE_SIZE * scale
+        visible = set((tx, ty)
+                      for tx in range(max(0, int(x0 // tile)), min(-(-lw // TILE_SIZE), int(x1 // tile) + 1))
+                      for ty in range(max(0, int(y0 // tile)), min(-(-lh // TILE_SIZE), int(y1 // tile) + 1)))
+
+        # Visible part of each tile, in pixels of the tile
+        crops = {}
+        for tx, ty in visible:
+            width = min(TILE_SIZE, lw - tx * TILE_SIZE)
+            height = min(TILE_SIZE, lh - ty * TILE_SIZE)
+            box = (max(0, int((x0 - tx * tile) // scale)), max(0, int((y0 - ty * tile) // scale)),
+                   min(width, math.ceil((x1 - tx * tile) / scale)), min(height, math.ceil((y1 - ty * tile) / scale)))
+            if box[2] > box[0] and box[3] > box[1]:
+                crops[(tx, ty)] = box
+
+        for key in list(self.tile_items):
+            if crops.get(key) != self.tile_items[key][2]:
+                self.mainPanel.delete(self.tile_items.pop(key)[0])
+
+        for (tx, ty), box in crops.items():
+            if (tx, ty) in self.tile_items:
+                continue
+            img = self.pyramid.tile(level, tx, ty)
+            if img is None:
+                continue
+            if box != (0, 0) + img.size:
+                img = img.crop(box)
+            left, top = round(tx * tile + box[0] * scale), round(ty * tile + box[1] * scale)
+            size = (round(tx * tile + box[2] * scale) - left, round(ty * tile + box[3] * scale) - top)
+            if size != img.size:
+                img = img.resize(size, Image.BILINEAR)
+            photo = ImageTk.PhotoImage(img)
+            item = self.mainPanel.create_image(left, top, image=photo, anchor=NW, tags='tile')
+            self.mainPanel.tag_lower(item)
+            self.tile_items[(tx, ty)] = (item, photo, box)
+
+        if len(self.tile_items) < len(crops) and self.pyramid.busy() and not self.tiles_pending:
+            self.tiles_pending = True
+            self.mainPanel.after(TILE_POLL_MS, self.pollTiles)
+
+    def pollTiles(self):
+        self.tiles_pending = False
+        self.drawTiles()
 
     def cancelBBox(self, event):
         if 1 == self.STATE['click']:
@@ -364,41 +744,84 @@ class BboxTool():
         if len(sel) != 1 :
             return
         idx = int(sel[0])
+        proposal = idx >= len(self.session.bboxList)
         self.mainPanel.delete(self.bboxIdList[idx])
         self.bboxIdList.pop(idx)
-        self.bboxList.pop(idx)
+        self.session.delete_box(idx)
         self.listbox.delete(idx)
+        if proposal:
+            for item in self.bboxIdList:
+                self.mainPanel.itemconfig(item, dash=()) # the other proposals are accepted
 
-    def clearBBox(self):
+    def removeBoxItems(self):
         for idx in range(len(self.bboxIdList)):
             self.mainPanel.delete(self.bboxIdList[idx])
-        self.listbox.delete(0, len(self.bboxList))
+        self.listbox.delete(0, END)
         self.bboxIdList = []
-        self.bboxList = []
+
+    def clearBBox(self):
+        self.removeBoxItems()
+        self.session.clear_boxes()
+
+    def acceptProposals(self, event = None):
+        if self.session.accept_proposals():
+            for item in self.bboxIdList:
+                self.mainPanel.itemconfig(item, dash=())
 
     def prevImage(self, event = None):
-        self.save_bounding_box()
-        if self.current_img > 1:
-            self.current_img -= 1
-            self.ratio = 1.0
+        if self.session.prev():
             self.loadImage()
 
     def nextImage(self, event = None):
-        self.save_bounding_box()
-        if self.current_img < len(self.image_list):
-            self.current_img += 1
-            self.ratio = 1.0
+        if self.session.next():
             self.loadImage()
 
     def gotoImage(self):
-        idx = int(self.idxEntry.get())
-        if 1 <= idx and idx <= len(self.image_list):
-            self.save_bounding_box()
-            self.current_img = idx
+        if self.session.goto(int(self.idxEntry.get())):
             self.loadImage()
 
 
+def add_arguments(parser):
+    """
+    Add the command line arguments to a parser
+    """
+
+    parser.add_argument('--store', help='Store the labels in one text file per image, or in one SQLite file per folder (default: text)', choices=STORES, default='text')
+    parser.add_argument('--prelabel', help='Propose the boxes of an unlabeled image from the boxes of the previous image', action='store_true')
+    parser.add_argument('--cache-mb', help=f'Memory budget of the decoded images cache in MB (default: {CACHE_MB})', required=False, type=int, default=CACHE_MB)
+    instrument.add_arguments(parser)
+
+
+def parse_arguments():
+    """
+    Parse command line arguments.
+
+    # Returns
+        Dictionnary containing the command line arguments
+    """
+
+    parser = argparse.ArgumentParser(description='Bounding Box Labeler')
+    add_arguments(parser)
+    args = vars(parser.parse_args())
+
+    return args
+
+
+def main(args=None):
+    """
+    Main function
+
+    # Arguments
+        args: Dictionnary of command line arguments (default: parsed from sys.argv)
+    """
+
+    if args is None:
+        args = parse_arguments()
+    with instrument.profile(args):
+        root = Tk()
+        _ = BboxTool(root, cache_mb=args['cache_mb'], store=args['store'], prelabel=args['prelabel'])
+        root.mainloop()
+
+
 if __name__ == '__main__':
-    root = Tk()
-    _ = BboxTool(root)
-    root.mainloop()
+    main()
@@ -0,0 +1,820 @@
+# Copyright 2018 Mikaël Swawola. All Rights Reserved.
+#
+# GNU GENERAL PUBLIC LICENSE
+# Version 3, 29 June 2007
+# ==============================================================================
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import statistics
+import subprocess
+from pathlib import Path
+from lazy import lazy_import
+
+np = lazy_import('numpy')
+Image = lazy_import('PIL.Image')
+ImageFilter = lazy_import('PIL.ImageFilter')
+
+# Startup time budget of the command line tools, in ms
+STARTUP_BUDGET = 100
+
+# Hot paths timed by the benchmark suite: name -> description
+SUITE_CASES = {
+    'hash': 'duplicate_find.compute_hash over the whole dataset',
+    'split': 'split.copy_and_split of the dataset (copy mode)',
+    'label': 'LabelingSession.load of every image, as driven by BboxTool.loadImage',
+}
+
+# Number of images of the synthetic datasets of the benchmark suite
+SUITE_SCALES = [100, 1000]
+
+# Number of runs of each case of the benchmark suite
+SUITE_REPEAT = 5
+
+# Resolutions of the synthetic images (width, height)
+DATASET_SIZES = [(320, 240), (640, 480), (1024, 768), (1920, 1080)]
+
+# Formats of the synthetic images: (extension, PIL mode)
+DATASET_FORMATS = [('.jpg', 'RGB'), ('.jpeg', 'RGB'), ('.png', 'RGB'), ('.png', 'RGBA'), ('.png', 'L')]
+
+# Relative increase of the wall time or of the peak memory reported as a regression
+REGRESSION_TOLERANCE = 0.2
+
+# Formats of the large images of the pixel hash memory benchmark: (extension, PIL mode)
+HASH_MEMORY_FORMATS = [('.png', 'RGB'), ('.png', 'RGBA'), ('.png', 'P'), ('.png', 'L'), ('.jpg', 'RGB'), ('.tif', 'RGB')]
+
+
+def generate_images(folder, count, size=256, seed=0):
+    """
+    Generate random PNG images in a folder
+
+    # Arguments
+        folder: Destination folder
+        count: Number of images
+        size: Width and height of the images
+        seed: Random seed
+
+    # Returns
+        The list of generated image paths
+    """
+
+    rng = np.random.RandomState(seed)
+    paths = []
+    for i in range(count):
+        data = rng.randint(0, 256, (size, size, 3), dtype=np.uint8)
+        path = Path(folder)/f'img_{i:06d}.png'
+        Image.fromarray(data).save(path)
+        paths.append(path)
+
+    return paths
+
+
+def generate_dataset(folder, images, classes=10, duplicate_rate=0.1, seed=0):
+    """
+    Generate a synthetic classification dataset: one folder per class
+    holding images of mixed formats and resolutions, with duplicates
+
+    The images are smooth random textures, which compress like photos.
+    A duplicate has the pixels of an earlier image of any class: a byte
+    copy for JPEG, a re-encoded file for PNG (same pixels, other bytes).
+
+    # Arguments
+        folder: Destination folder
+        images: Number of images
+        classes: Number of classes
+        duplicate_rate: Fraction of the images which duplicate an earlier image
+        seed: Random seed
+
+    # Returns
+        Dictionnary describing the dataset: images, classes, duplicates and bytes
+    """
+
+    rng = np.random.RandomState(seed)
+    folders = [Path(folder)/f'class_{c:03d}' for c in range(classes)]
+    for f in folders:
+        f.mkdir(parents=True, exist_ok=True)
+
+    paths, duplicates, size = [], 0, 0
+    for i in range(images):
+        path = folders[i % classes]/f'img_{i:07d}'
+        if paths and rng.rand() < duplicate_rate:
+            original = paths[rng.randint(len(paths))]
+            path = path.with_suffix(original.suffix)
+            if original.suffix == '.png':
+                with Image.open(original) as im:
+                    im.save(path, compress_level=1)
+            else:
+                shutil.copyfile(original, path)
+            duplicates += 1
+        else:
+            width, height = DATASET_SIZES[rng.randint(len(DATASET_SIZES))]
+            ext, mode = DATASET_FORMATS[rng.randint(len(DATASET_FORMATS))]
+            path = path.with_suffix(ext)
+            small = rng.randint(0, 256, (height // 16 + 1, width // 16 + 1, 4), dtype=np.uint8)
+            im = Image.fromarray(small, 'RGBA').resize((width, height), Image.BICUBIC).convert(mode)
+            im.save(path, quality=90) if ext != '.png' else im.save(path)
+        paths.append(path)
+        size += path.stat().st_size
+
+    return {'images': images, 'classes': classes, 'duplicates': duplicates, 'bytes': size}
+
+
+def bench_hash(images, workers_list):
+    """
+    Time duplicate_find.compute_hash for several worker counts
+
+    # Arguments
+        images: The list of images
+        workers_list: Worker counts to benchmark
+    """
+
+    import duplicate_find
+
+    reference = None
+    baseline = None
+    for workers in workers_list:
+        start = time.perf_counter()
+        hashes = duplicate_find.compute_hash(images, workers=workers)
+        elapsed = time.perf_counter() - start
+
+        if reference is None:
+            reference, baseline = hashes, elapsed
+        elif hashes != reference:
+            print(f'!! workers={workers} produced different hashes')
+
+        print(f'workers={workers:3d}  {elapsed:7.2f}s  '
+              f'{len(images)/elapsed:8.1f} images/sec  speedup x{baseline/elapsed:.2f}')
+
+
+def legacy_hash_image(path):
+    """
+    Pixel hash as computed before duplicate_find.hash_image was streamed:
+    full-size conversion to RGB and full-size NumPy copy
+    """
+
+    from hashlib import sha1
+
+    im = Image.open(path)
+    if im.mode != 'RGB':
+        im = im.convert('RGB')
+
+    return im.size, sha1(np.array(im)).hexdigest()
+
+
+def peak_rss(children=False):
+    """
+    Peak RSS of the current process, in bytes
+
+    On Linux this is VmHWM, which starts with the process (unlike
+    ru_maxrss, it is not inherited through exec) and can be reset with
+    reset_peak_rss. Elsewhere it is ru_maxrss.
+
+    # Arguments
+        children: Return the ru_maxrss of the largest terminated child process instead
+    """
+
+    if not children:
+        try:
+            with open('/proc/self/status') as f:
+                for line in f:
+                    if line.startswith('VmHWM:'):
+                        return int(line.split()[1]) * 1024
+        except OSError:
+            pass
+
+    import resource
+
+    # ru_maxrss is in kB on Linux and in bytes on macOS
+    unit = 1 if sys.platform == 'darwin' else 1024
+    who = resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF
+    return resource.getrusage(who).ru_maxrss * unit
+
+
+def reset_peak_rss():
+    """
+    Reset the peak RSS of the current process to its current RSS (Linux only)
+    """
+
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def run_hash_memory(path, streamed, conn):
+    """
+    Hash one image and send its digest, the time and the memory used (child process)
+
+    # Arguments
+        path: Path of the image
+        streamed: Use duplicate_find.hash_image, or legacy_hash_image
+        conn: Pipe on which the results are sent
+    """
+
+    import io
+    import duplicate_find
+
+    func = duplicate_find.hash_image if streamed else legacy_hash_image
+
+    # Warm up on a tiny image of the same format, so that imports are not counted
+    tiny = io.BytesIO()
+    with Image.open(path) as im:
+        im.resize((2, 2)).save(tiny, im.format)
+    func(tiny)
+
+    reset_peak_rss()
+    before = peak_rss()
+    start = time.perf_counter()
+    _, digest = func(path)
+    elapsed = time.perf_counter() - start
+
+    conn.send((digest, elapsed, peak_rss() - before))
+    conn.close()
+
+
+def bench_hash_memory(folder, megapixels=24, seed=0):
+    """
+    Compare the peak memory and the digests of the streamed pixel hash
+    with the full-size conversion it replaced, on large images
+
+    Each hash runs in a fresh process; the memory reported is the growth
+    of its peak RSS during the hash, which includes the decoded image.
+
+    # Arguments
+        folder: Folder for the images
+        megapixels: Size of the images
+        seed: Random seed
+    """
+
+    import multiprocessing
+
+    rng = np.random.RandomState(seed)
+    width = int((megapixels * 1e6 * 4 / 3) ** 0.5)
+    height = int(megapixels * 1e6 / width)
+    small = rng.randint(0, 256, (height // 32 + 1, width // 32 + 1, 4), dtype=np.uint8)
+    texture = Image.fromarray(small, 'RGBA').resize((width, height), Image.BICUBIC)
+
+    ctx = multiprocessing.get_context('spawn')
+    for (ext, mode) in HASH_MEMORY_FORMATS:
+        path = Path(folder)/f'large_{mode}{ext}'
+        texture.convert(mode).save(path)
+        results = []
+        for streamed in (False, True):
+            parent, child = ctx.Pipe(duplex=False)
+            process = ctx.Process(target=run_hash_memory, args=(os.fspath(path), streamed, child))
+            process.start()
+            child.close()
+            results.append(parent.recv())
+            process.join()
+        (old, old_time, old_mem), (new, new_time, new_mem) = results
+        status = 'same digest' if old == new else 'DIFFERENT DIGESTS'
+        print(f'{mode:>4} {ext:5s} {width}x{height}  full copies {old_mem / 2**20:7.1f} MB {old_time:6.2f}s  '
+              f'streamed {new_mem / 2**20:7.1f} MB {new_time:6.2f}s  {status}')
+        path.unlink()
+
+
+def bench_index(folder, size, segments=10, queries=1000, seed=0):
+    """
+    Build a duplicate index of random digests, added in several segments
+    (which are merged on the way), and time lookups in it
+
+    # Arguments
+        folder: Folder of the index
+        size: Number of indexed images
+        segments: Number of additions
+        queries: Number of looked up digests, half of them indexed
+        seed: Random seed
+    """
+
+    from duplicate_index import DuplicateIndex, DIGEST_SIZE
+
+    rng = np.random.RandomState(seed)
+    index = DuplicateIndex(folder)
+    hexes = []
+    start = time.perf_counter()
+    for s in range(segments):
+        n = size // segments + (s < size % segments)
+        digests = rng.bytes(n * DIGEST_SIZE)
+        items = [(f'img_{s}_{i:09d}.png', digests[DIGEST_SIZE * i:DIGEST_SIZE * (i + 1)].hex(), 0, 0) for i in range(n)]
+        index.add(f'/dataset/part_{s}', items)
+        hexes += [h for (_, h, _, _) in items[:queries // 2 // segments + 1]]
+    elapsed = time.perf_counter() - start
+    print(f'index: {size} digests added in {segments} segments in {elapsed:.2f}s, '
+          f'{len(index.manifest["segments"])} segment(s) after merging')
+
+    known = hexes[:queries // 2]
+    unknown = [rng.bytes(DIGEST_SIZE).hex() for _ in range(queries - len(known))]
+    for label in ('cold', 'warm'):
+        index = DuplicateIndex(folder) if label == 'cold' else index
+        start = time.perf_counter()
+        found = index.lookup(known + unknown)
+        elapsed = time.perf_counter() - start
+        status = 'ok' if sorted(found) == list(range(len(known))) else 'WRONG RESULTS'
+        print(f'index: {label} lookup of {queries} digests in {elapsed * 1000:.2f} ms, '
+              f'{len(found)} found {status}')
+
+
+def bench_hash_split(count, ratios=(0.1, 0.2, 0.5)):
+    """
+    Time split.is_valid_file and check the validation ratio it produces
+
+    The observed ratio must stay within 4 standard deviations of a
+    binomial draw of count files.
+
+    # Arguments
+        count: Number of simulated files in the category
+        ratios: Split ratios to check
+    """
+
+    import split
+
+    names = [f'category/img_{i:08d}.jpg' for i in range(count)]
+    for ratio in ratios:
+        start = time.perf_counter()
+        valid = sum(split.is_valid_file(name, ratio, seed=0) for name in names)
+        elapsed = time.perf_counter() - start
+
+        tolerance = 4 * np.sqrt(ratio * (1 - ratio) / count)
+        observed = valid / count
+        status = 'ok' if abs(observed - ratio) <= tolerance else 'OUT OF TOLERANCE'
+        print(f'ratio={ratio:.2f}  observed={observed:.4f} (+/-{tolerance:.4f}) {status}  '
+              f'{count/elapsed:10.0f} files/sec')
+
+
+def bench_session(folder, navigations, store='text', seed=0):
+    """
+    Drive a labeling session through simulated navigations and report the
+    latency of each operation
+
+    Each step adds a box to the current image with probability 1/2, then
+    moves to the next, previous or a random image (which saves the boxes).
+
+    # Arguments
+        folder: Images folder (the labels are written in folder/Labels)
+        navigations: Number of simulated navigations
+        store: Annotation store kind
+        seed: Random seed
+    """
+
+    from session import LabelingSession
+
+    rng = np.random.RandomState(seed)
+    session = LabelingSession(store=store, labels=Path(folder)/'Labels')
+    latencies = {'open': [], 'add box': [], 'next': [], 'prev': [], 'goto': [], 'close': []}
+
+    start = time.perf_counter()
+    session.open_directory(folder)
+    latencies['open'].append(time.perf_counter() - start)
+
+    count = len(session.image_list)
+    for _ in range(navigations):
+        if rng.rand() < 0.5:
+            start = time.perf_counter()
+            session.add_box(*rng.randint(0, 256, 4), label='label1')
+            latencies['add box'].append(time.perf_counter() - start)
+
+        op = rng.choice(['next', 'next', 'prev', 'goto'])
+        start = time.perf_counter()
+        if op == 'next':
+            session.next() or session.goto(1)
+        elif op == 'prev':
+            session.prev() or session.goto(count)
+        else:
+            session.goto(rng.randint(1, count + 1))
+        latencies[op].append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    session.close()
+    latencies['close'].append(time.perf_counter() - start)
+
+    for op, values in latencies.items():
+        if values:
+            ms = np.array(values) * 1000
+            print(f'{store:>6} {op:>8}: {len(ms):6d} ops  mean {ms.mean():7.3f} ms  '
+                  f'p50 {np.percentile(ms, 50):7.3f} ms  p99 {np.percentile(ms, 99):7.3f} ms  max {ms.max():7.3f} ms')
+
+
+def generate_sequence(folder, count, size=(640, 480), step=(3, 2), seed=0):
+    """
+    Generate a sequence of PNG frames panning over a random texture
+
+    # Arguments
+        folder: Destination folder
+        count: Number of frames
+        size: Width and height of the frames
+        step: Motion (dx, dy) of the content between two frames, in pixels
+        seed: Random seed
+    """
+
+    rng = np.random.RandomState(seed)
+    width, height = size
+    margin = max(abs(step[0]), abs(step[1])) * count
+    texture = rng.randint(0, 256, (height + 2 * margin, width + 2 * margin, 3), dtype=np.uint8)
+    texture = np.asarray(Image.fromarray(texture).filter(ImageFilter.GaussianBlur(2)))
+    for i in range(count):
+        # The content moves by +step: the crop window moves by -step
+        x, y = margin - i * step[0], margin - i * step[1]
+        Image.fromarray(texture[y:y + height, x:x + width]).save(Path(folder)/f'frame_{i:06d}.png')
+
+
+def bench_prelabel(folder, count, think=0.1, step=(3, 2)):
+    """
+    Label the first frame of a panning sequence, then move through the
+    following frames with pre-labeling, accepting the proposals of each
+    frame, and report the navigation latency and the error of the
+    proposed boxes
+
+    # Arguments
+        folder: Empty folder for the frames
+        count: Number of frames
+        think: Time spent on each frame before moving to the next one, in seconds
+        step: Motion (dx, dy) of the content between two frames, in pixels
+    """
+
+    from session import LabelingSession
+
+    generate_sequence(folder, count, step=step)
+    session = LabelingSession(labels=Path(folder)/'Labels', prelabel=True)
+    session.open_directory(folder)
+    boxes = [(50, 60, 150, 140), (300, 200, 380, 300), (450, 100, 600, 250)]
+    for box in boxes:
+        session.add_box(*box, label='label1')
+
+    latencies, errors = [], []
+    for i in range(1, count):
+        time.sleep(think)
+        start = time.perf_counter()
+        session.next()
+        latencies.append(time.perf_counter() - start)
+        session.accept_proposals()
+        truth = [(x1 + i * step[0], y1 + i * step[1]) for (x1, y1, _, _) in boxes]
+        errors += [abs(x1 - tx) + abs(y1 - ty) for ((x1, y1, *_), (tx, ty)) in zip(session.bboxList, truth)]
+    session.close()
+
+    ms = np.array(latencies) * 1000
+    print(f'prelabel next: {len(ms)} frames  mean {ms.mean():.3f} ms  p99 {np.percentile(ms, 99):.3f} ms  '
+          f'max {ms.max():.3f} ms  mean box drift after {count - 1} frames: {np.mean(errors[-len(boxes):]):.1f} px')
+
+
+def import_times(stderr):
+    """
+    Parse the output of python -X importtime
+
+    # Returns
+        Dictionnary {top-level module: cumulative import time in ms}
+    """
+
+    times = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        if not name.startswith('  '):
+            times[name.strip()] = int(cumulative) / 1000
+
+    return times
+
+
+def bench_startup(repeat=5):
+    """
+    Time the startup of the command line tools, for --help and for an
+    argument error, and show the heaviest imports (python -X importtime)
+
+    # Arguments
+        repeat: Number of runs of each command line (the fastest is reported)
+    """
+
+    import tools
+
+    script = os.fspath(Path(tools.__file__).resolve())
+    cases = [['--help']]
+    for command in tools.COMMANDS:
+        cases += [[command, '--help'], [command, '--no-such-option']]
+
+    for argv in cases:
+        elapsed = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            subprocess.run([sys.executable, script] + argv, capture_output=True)
+            elapsed.append(time.perf_counter() - start)
+        ms = min(elapsed) * 1000
+
+        result = subprocess.run([sys.executable, '-X', 'importtime', script] + argv, capture_output=True, text=True)
+        heaviest = sorted(import_times(result.stderr).items(), key=lambda x: -x[1])[:3]
+        status = 'ok' if ms <= STARTUP_BUDGET else 'OVER BUDGET'
+        print(f'{" ".join(argv):30s} {ms:6.1f} ms  {status:11s}  '
+              + ', '.join(f'{name} {t:.1f} ms' for (name, t) in heaviest))
+
+
+def run_case(case, dataset, workers, conn):
+    """
+    Run one hot path of the benchmark suite on a dataset (child process)
+
+    The case runs in a fresh process, so its peak RSS is its own. The
+    output of the tools is discarded.
+
+    # Arguments
+        case: One of SUITE_CASES
+        dataset: Dataset folder (see generate_dataset)
+        workers: Number of worker processes or threads
+        conn: Pipe on which the wall time and the peak RSS are sent
+    """
+
+    import contextlib
+
+    with tempfile.TemporaryDirectory() as tmp, open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        start = time.perf_counter()
+        if case == 'hash':
+            import duplicate_find
+            from scanner import scan
+            duplicate_find.compute_hash(scan(dataset, recursive=True), workers=workers, folder=dataset)
+        elif case == 'split':
+            import split
+            for sub in ('train', 'valid'):
+                (Path(tmp)/sub).mkdir()
+            split.copy_and_split(Path(dataset), Path(tmp)/'train', Path(tmp)/'valid', seed=0, jobs=workers)
+        elif case == 'label':
+            from scanner import scan_dirs
+            from session import LabelingSession
+            session = LabelingSession(labels=Path(tmp)/'Labels')
+            for folder in sorted(entry.path for entry in scan_dirs(dataset)):
+                session.open_directory(folder)
+                while session.next():
+                    pass
+            session.close()
+        wall = time.perf_counter() - start
+
+    peak = max(peak_rss(), peak_rss(children=True))
+    conn.send((wall, peak))
+    conn.close()
+
+
+def spawn_case(case, dataset, workers):
+    """
+    Run one hot path of the benchmark suite in a child process
+
+    # Returns
+        The wall time (s) and the peak RSS (bytes) of the run
+    """
+
+    import multiprocessing
+
+    ctx = multiprocessing.get_context('spawn')
+    parent, child = ctx.Pipe(duplex=False)
+    process = ctx.Process(target=run_case, args=(case, os.fspath(dataset), workers, child))
+    process.start()
+    child.close()
+    try:
+        wall, peak = parent.recv()
+    except EOFError:
+        process.join()
+        raise RuntimeError(f'benchmark case {case} failed (exit code {process.exitcode})')
+    process.join()
+
+    return wall, peak
+
+
+def measure_case(case, dataset, info, workers, repeat=SUITE_REPEAT):
+    """
+    Time one hot path of the benchmark suite over several runs
+
+    Each run is done in a fresh child process. The wall time, files/sec
+    and MB/s are those of the median run; the fastest run and the spread
+    of the runs ((slowest - fastest) / median) are reported as well.
+
+    # Arguments
+        case: One of SUITE_CASES
+        dataset: Dataset folder
+        info: Description of the dataset (see generate_dataset)
+        workers: Number of worker processes or threads
+        repeat: Number of runs
+
+    # Returns
+        Dictionnary with the median, minimum and spread of the wall time (s),
+        files/sec, throughput (MB/s) and median peak RSS of the largest process (MB)
+    """
+
+    runs = [spawn_case(case, dataset, workers) for _ in range(repeat)]
+    walls = [wall for (wall, _) in runs]
+    wall = statistics.median(walls)
+    peak = statistics.median(peak for (_, peak) in runs)
+
+    return {'case': case, 'images': info['images'], 'workers': workers, 'repeat': repeat,
+            'wall': round(wall, 4),
+            'wall_min': round(min(walls), 4),
+            'wall_spread': round((max(walls) - min(walls)) / wall, 3),
+            'files_per_sec': round(info['images'] / wall, 1),
+            'mb_per_sec': round(info['bytes'] / wall / 2**20, 2),
+            'peak_rss_mb': round(peak / 2**20, 1)}
+
+
+def run_suite(scales, classes=10, duplicate_rate=0.1, workers=1, cases=SUITE_CASES, repeat=SUITE_REPEAT):
+    """
+    Run the hot paths of the tools on synthetic datasets of several sizes
+
+    # Arguments
+        scales: Numbers of images of the datasets
+        classes: Number of classes
+        duplicate_rate: Fraction of duplicate images
+        workers: Number of worker processes or threads
+        cases: Cases to run, among SUITE_CASES
+        repeat: Number of runs of each case
+
+    # Returns
+        The report: environment, datasets and one result per case and scale
+    """
+
+    report = {'python': platform.python_version(), 'platform': platform.platform(),
+              'cpus': os.cpu_count(), 'datasets': [], 'results': []}
+    for images in scales:
+        with tempfile.TemporaryDirectory() as tmp:
+            print(f'Generating {images} images in {classes} classes ({duplicate_rate:.0%} duplicates)...')
+            info = generate_dataset(tmp, images, classes, duplicate_rate)
+            report['datasets'].append(info)
+            for case in cases:
+                result = measure_case(case, tmp, info, workers, repeat)
+                report['results'].append(result)
+                print(f'{case:>6} {images:8d} images  {result["wall"]:8.3f}s (min {result["wall_min"]:.3f}s, '
+                      f'spread {result["wall_spread"]:5.1%})  {result["files_per_sec"]:9.1f} files/sec  '
+                      f'{result["mb_per_sec"]:8.2f} MB/s  peak RSS {result["peak_rss_mb"]:7.1f} MB')
+
+    return report
+
+
+def compare_results(report, baseline, tolerance=REGRESSION_TOLERANCE):
+    """
+    Compare the results of a benchmark suite run with a baseline run
+
+    Results are matched by case, number of images and workers. A result
+    is a regression when its fastest run or its median peak RSS exceeds
+    the baseline by more than tolerance. The fastest run is the least
+    disturbed by the load of the machine; baselines written before
+    repeated runs only have the wall time of their single run.
+
+    # Arguments
+        report: Report of the current run (see run_suite)
+        baseline: Report of the baseline run
+        tolerance: Relative increase allowed
+
+    # Returns
+        The list of (case, images, metric, baseline value, current value) regressions
+    """
+
+    reference = {(r['case'], r['images'], r['workers']): r for r in baseline['results']}
+    regressions = []
+    for result in report['results']:
+        before = reference.get((result['case'], result['images'], result['workers']))
+        if before is None:
+            continue
+        wall = 'wall_min' if 'wall_min' in before else 'wall'
+        for metric in (wall, 'peak_rss_mb'):
+            if result[metric] > before[metric] * (1 + tolerance):
+                regressions.append((result['case'], result['images'], metric, before[metric], result[metric]))
+
+    return regressions
+
+
+def add_arguments(parser):
+    """
+    Add the command line arguments to a parser
+    """
+
+    parser.add_argument('-n','--count', help='Number of synthetic images', required=False, type=int, default=500)
+    parser.add_argument('-s','--size', help='Size of the synthetic images', required=False, type=int, default=256)
+    parser.add_argument('-m','--megapixels', help='Size of the images of the pixel hash memory benchmark, in megapixels', required=False, type=int, default=24)
+    parser.add_argument('-x','--index-size', help='Number of digests of the duplicate index benchmark', required=False, type=int, default=2000000)
+    parser.add_argument('-f','--files', help='Number of simulated files for the split benchmark', required=False, type=int, default=1000000)
+    parser.add_argument('-v','--navigations', help='Number of simulated navigations for the labeling session benchmark', required=False, type=int, default=10000)
+    parser.add_argument('--suite', help='Run the benchmark suite of the hot paths on synthetic datasets instead', action='store_true')
+    parser.add_argument('--scales', help='Comma-separated numbers of images of the suite datasets (default: %(default)s)', required=False, type=str, default=','.join(map(str, SUITE_SCALES)))
+    parser.add_argument('--classes', help='Number of classes of the suite datasets', required=False, type=int, default=10)
+    parser.add_argument('--duplicates', help='Fraction of duplicate images of the suite datasets', required=False, type=float, default=0.1)
+    parser.add_argument('--cases', help='Comma-separated suite cases (default: all)', required=False, type=str, default=','.join(SUITE_CASES))
+    parser.add_argument('--repeat', help='Number of runs of each suite case (default: %(default)s)', required=False, type=int, default=SUITE_REPEAT)
+    parser.add_argument('-w','--workers', help='Number of worker processes or threads of the suite (default: number of CPUs)', required=False, type=int, default=os.cpu_count() or 1)
+    parser.add_argument('-o','--output', help='JSON file for the suite report', required=False, type=str, default=None)
+    parser.add_argument('-b','--baseline', help='JSON report of a previous suite run to compare with', required=False, type=str, default=None)
+    parser.add_argument('--tolerance', help='Relative slowdown or memory increase reported as a regression', required=False, type=float, default=REGRESSION_TOLERANCE)
+
+
+def parse_arguments():
+    """
+    Parse command line arguments.
+
+    # Returns
+        Dictionnary containing the command line arguments
+    """
+
+    parser = argparse.ArgumentParser(description='Benchmarks')
+    add_arguments(parser)
+    args = vars(parser.parse_args())
+
+    return args
+
+
+def suite(args):
+    """
+    Run the benchmark suite, save its report and compare it with a baseline
+    """
+
+    cases = args['cases'].split(',')
+    for case in cases:
+        if case not in SUITE_CASES:
+            print(f'Unknown benchmark case {case}, choose among {", ".join(SUITE_CASES)}')
+            sys.exit(1)
+    try:
+        scales = [int(s) for s in args['scales'].split(',')]
+    except ValueError:
+        print(f'Invalid scales {args["scales"]}')
+        sys.exit(1)
+    if args['repeat'] < 1:
+        print('--repeat must be at least 1')
+        sys.exit(1)
+
+    baseline = None
+    if args['baseline'] is not None:
+        try:
+            with open(args['baseline']) as f:
+                baseline = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f'Cannot read the baseline {args["baseline"]}: {e}')
+            sys.exit(1)
+
+    report = run_suite(scales, args['classes'], args['duplicates'], args['workers'], cases, args['repeat'])
+
+    if args['output'] is not None:
+        with open(args['output'], 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f'Report written to {args["output"]}')
+    else:
+        print(json.dumps(report, indent=2))
+
+    if baseline is not None:
+        regressions = compare_results(report, baseline, args['tolerance'])
+        for (case, images, metric, before, after) in regressions:
+            print(f'REGRESSION {case} {images} images: {metric} {before} -> {after} (x{after / before:.2f})')
+        if regressions:
+            sys.exit(1)
+        print(f'No regression against {args["baseline"]}')
+
+    print('Done!')
+
+
+def main(args=None):
+    """
+    Main function
+
+    # Arguments
+        args: Dictionnary of command line arguments (default: parsed from sys.argv)
+    """
+
+    if args is None:
+        args = parse_arguments()
+
+    if args['suite']:
+        suite(args)
+        return
+
+    cpus = os.cpu_count() or 1
+    workers_list = [1]
+    while workers_list[-1] * 2 <= cpus:
+        workers_list.append(workers_list[-1] * 2)
+    if workers_list[-1] != cpus:
+        workers_list.append(cpus)
+
+    print('Startup of the command line tools...')
+    bench_startup()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        print(f'Generating {args["count"]} images...')
+        images = generate_images(tmp, args['count'], args['size'])
+        bench_hash(images, workers_list)
+        print(f'Memory of the pixel hash on {args["megapixels"]} MP images...')
+        bench_hash_memory(tmp, args['megapixels'])
+        print(f'Labeling session, {args["navigations"]} navigations...')
+        for store in ('text', 'sqlite'):
+            bench_session(tmp, args['navigations'], store)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        print('Pre-labeling a panning sequence of 50 frames...')
+        bench_prelabel(tmp, 50)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        print(f'Duplicate index of {args["index_size"]} images...')
+        bench_index(tmp, args['index_size'])
+
+    print(f'Splitting {args["files"]} files by hash...')
+    bench_hash_split(args['files'])
+
+    print('Done!')
+
+
+if __name__ == "__main__":
+    main()
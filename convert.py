@@ -0,0 +1,371 @@
+# Copyright 2018 Mikaël Swawola. All Rights Reserved.
+#
+# GNU GENERAL PUBLIC LICENSE
+# Version 3, 29 June 2007
+# ==============================================================================
+
+import os
+import sys
+import json
+import time
+import argparse
+from pathlib import Path
+from functools import partial
+
+from scanner import scan, relative_path, IMAGE_EXTENSIONS
+from annotations import LABEL_EXT
+from duplicate_find import image_size, map_images
+
+# Output formats
+FORMATS = ['coco', 'voc', 'yolo']
+
+# File listing the classes, one per line
+CLASS_FILE = 'class.txt'
+
+# Number of checked label files between two progress reports
+PROGRESS_EVERY = 100000
+
+VOC_OBJECT = """    <object>
+        <name>{}</name>
+        <bndbox>
+            <xmin>{}</xmin>
+            <ymin>{}</ymin>
+            <xmax>{}</xmax>
+            <ymax>{}</ymax>
+        </bndbox>
+    </object>
+"""
+
+
+def read_classes(path):
+    """
+    Read the class names, one per line (blank lines are ignored)
+
+    # Returns
+        The list of class names, or None if the file does not exist
+    """
+
+    try:
+        with open(path) as f:
+            return [line.strip() for line in f if line.strip()]
+    except FileNotFoundError:
+        return None
+
+
+def parse_label_file(text):
+    """
+    Strictly parse the content of a label file written by bbox.py
+
+    # Arguments
+        text: Content of the label file
+
+    # Returns
+        The list of (x1, y1, x2, y2, label) tuples
+
+    # Raises
+        ValueError if the file is malformed
+    """
+
+    lines = [line for line in text.splitlines() if line.strip()]
+    if not lines:
+        raise ValueError('empty file')
+
+    try:
+        count = int(lines[0])
+    except ValueError:
+        raise ValueError(f'invalid box count {lines[0]!r}')
+    if count != len(lines) - 1:
+        raise ValueError(f'{count} boxes announced, {len(lines) - 1} found')
+
+    boxes = []
+    for (i, line) in enumerate(lines[1:], 2):
+        tmp = line.split()
+        if len(tmp) != 5:
+            raise ValueError(f'line {i}: expected "x1 y1 x2 y2 label"')
+        try:
+            coords = [int(c) for c in tmp[:4]]
+        except ValueError:
+            raise ValueError(f'line {i}: invalid coordinates')
+        boxes.append(tuple(coords + tmp[4:]))
+
+    return boxes
+
+
+def find_image(folder, name):
+    """
+    Find the image of a label file, trying each image extension
+    """
+
+    for ext in sorted(IMAGE_EXTENSIONS):
+        for candidate in (name + ext, name + ext.upper()):
+            path = os.path.join(folder, candidate)
+            if os.path.isfile(path):
+                return path
+
+    return None
+
+
+def check_label(path, labels, images, classes):
+    """
+    Read and validate a label file (process pool worker)
+
+    # Arguments
+        path: Path of the label file, inside the labels folder
+        labels: Labels folder (Labels/)
+        images: Folder containing the images folders
+        classes: Set of known class names, or None to accept any label
+
+    # Returns
+        The (image, size, boxes, errors) tuple: path of the image relative
+        to the images folder, (width, height), list of boxes and list of
+        error messages
+    """
+
+    rel = relative_path(path, labels)[:-len(LABEL_EXT)]
+    folder, name = os.path.split(rel)
+
+    try:
+        with open(path) as f:
+            boxes = parse_label_file(f.read())
+    except (ValueError, UnicodeDecodeError) as e:
+        return rel, None, [], [f'malformed: {e}']
+
+    image = find_image(os.path.join(images, folder), name)
+    if image is None:
+        return rel, None, boxes, ['image not found']
+    try:
+        width, height = image_size(image)
+    except OSError as e:
+        return rel, None, boxes, [f'unreadable image: {e}']
+
+    errors = []
+    for (x1, y1, x2, y2, label) in boxes:
+        if not (0 <= x1 < x2 <= width and 0 <= y1 < y2 <= height):
+            errors.append(f'box ({x1}, {y1}) -> ({x2}, {y2}) out of the {width}x{height} image')
+        if classes is not None and label not in classes:
+            errors.append(f'unknown class {label!r}')
+
+    return relative_path(image, images), (width, height), boxes, errors
+
+
+class CocoWriter():
+    """
+    Stream images and annotations to a single COCO JSON file
+
+    The images are written as they come and the annotations are buffered
+    in a temporary file, then appended, so memory does not grow with the
+    number of images.
+    """
+
+    def __init__(self, path, classes):
+
+        import tempfile
+
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.classes = {c: i for (i, c) in enumerate(classes, 1)}
+        self.f = self.path.open('w')
+        self.annotations = tempfile.TemporaryFile('w+', dir=self.path.parent)
+        self.image_id = 0
+        self.annotation_id = 0
+        self.f.write('{"images": [')
+
+    def write(self, image, size, boxes):
+
+        self.image_id += 1
+        sep = ',\n' if self.image_id > 1 else '\n'
+        self.f.write(sep + json.dumps({'id': self.image_id, 'file_name': image,
+                                       'width': size[0], 'height': size[1]}))
+        for (x1, y1, x2, y2, label) in boxes:
+            self.annotation_id += 1
+            sep = ',\n' if self.annotation_id > 1 else '\n'
+            self.annotations.write(sep + json.dumps({
+                'id': self.annotation_id, 'image_id': self.image_id,
+                'category_id': self.classes[label], 'bbox': [x1, y1, x2 - x1, y2 - y1],
+                'area': (x2 - x1) * (y2 - y1), 'iscrowd': 0}))
+
+    def close(self):
+
+        import shutil
+
+        self.f.write('\n],\n"annotations": [')
+        self.annotations.seek(0)
+        shutil.copyfileobj(self.annotations, self.f)
+        self.annotations.close()
+        categories = [{'id': i, 'name': c} for (c, i) in self.classes.items()]
+        self.f.write('\n],\n"categories": ' + json.dumps(categories) + '}\n')
+        self.f.close()
+
+
+class VocWriter():
+    """
+    Write one Pascal VOC XML file per image
+    """
+
+    def __init__(self, folder, classes):
+
+        self.folder = Path(folder)
+
+    def write(self, image, size, boxes):
+
+        from xml.sax.saxutils import escape
+
+        path = (self.folder/image).with_suffix('.xml')
+        path.parent.mkdir(parents=True, exist_ok=True)
+        folder, filename = os.path.split(image)
+        objects = ''.join(VOC_OBJECT.format(escape(label), x1, y1, x2, y2)
+                          for (x1, y1, x2, y2, label) in boxes)
+        with path.open('w') as f:
+            f.write('<annotation>\n'
+                    f'    <folder>{escape(folder)}</folder>\n'
+                    f'    <filename>{escape(filename)}</filename>\n'
+                    f'    <size>\n        <width>{size[0]}</width>\n'
+                    f'        <height>{size[1]}</height>\n        <depth>3</depth>\n    </size>\n'
+                    f'{objects}</annotation>\n')
+
+    def close(self):
+        pass
+
+
+class YoloWriter():
+    """
+    Write one YOLO txt file per image, with normalized center coordinates,
+    and the class names by index in classes.txt
+    """
+
+    def __init__(self, folder, classes):
+
+        self.folder = Path(folder)
+        self.folder.mkdir(parents=True, exist_ok=True)
+        self.classes = {c: i for (i, c) in enumerate(classes)}
+        with (self.folder/'classes.txt').open('w') as f:
+            f.write(''.join(c + '\n' for c in classes))
+
+    def write(self, image, size, boxes):
+
+        path = (self.folder/image).with_suffix('.txt')
+        path.parent.mkdir(parents=True, exist_ok=True)
+        width, height = size
+        with path.open('w') as f:
+            for (x1, y1, x2, y2, label) in boxes:
+                f.write(f'{self.classes[label]} {(x1 + x2) / 2 / width:.6f} {(y1 + y2) / 2 / height:.6f} '
+                        f'{(x2 - x1) / width:.6f} {(y2 - y1) / height:.6f}\n')
+
+    def close(self):
+        pass
+
+
+WRITERS = {'coco': CocoWriter, 'voc': VocWriter, 'yolo': YoloWriter}
+
+
+def convert_labels(labels, images, classes=None, fmt=None, output=None, workers=1):
+    """
+    Validate all the label files of a labels folder and convert the valid ones
+
+    The label files are checked in a process pool and the results are
+    written as they come back, in a single pass. Files with errors are
+    reported and left out of the output.
+
+    # Arguments
+        labels: Labels folder (Labels/), containing one folder per images folder
+        images: Folder containing the images folders
+        classes: List of class names, or None to accept any label (validation only)
+        fmt: One of FORMATS, or None to only validate
+        output: Output file (coco) or folder (voc, yolo)
+        workers: Number of worker processes
+
+    # Returns
+        The (number of label files, number of converted files, list of (label file, error)) tuple
+    """
+
+    check = partial(check_label, labels=os.fspath(labels), images=os.fspath(images),
+                    classes=set(classes) if classes is not None else None)
+    writer = WRITERS[fmt](output, classes) if fmt is not None else None
+
+    count, converted, errors = 0, 0, []
+    start = time.perf_counter()
+    for (path, (image, size, boxes, errs)) in map_images(check, scan(labels, extensions=[LABEL_EXT], recursive=True), workers):
+        count += 1
+        if errs:
+            errors.extend((relative_path(path, labels), e) for e in errs)
+        elif writer is not None:
+            writer.write(image, size, boxes)
+            converted += 1
+        if count % PROGRESS_EVERY == 0:
+            print(f'{count} label files checked ({count / (time.perf_counter() - start):.0f} files/sec)')
+
+    if writer is not None:
+        writer.close()
+
+    return count, converted, errors
+
+
+def add_arguments(parser):
+    """
+    Add the command line arguments to a parser
+    """
+
+    parser.add_argument('-l','--labels', help='Labels folder, containing one folder per images folder (default: Labels)', required=False, type=str, default='Labels')
+    parser.add_argument('-i','--images', help='Folder containing the images folders', required=True, type=str)
+    parser.add_argument('-c','--classes', help=f'File listing the classes, one per line (default: {CLASS_FILE})', required=False, type=str, default=CLASS_FILE)
+    parser.add_argument('-f','--format', help='Output format (default: only validate)', choices=FORMATS, default=None)
+    parser.add_argument('-o','--output', help='Output file (coco) or folder (voc, yolo)', required=False, type=str, default=None)
+    parser.add_argument('-w','--workers', help='Number of worker processes (default: number of CPUs)', required=False, type=int, default=os.cpu_count() or 1)
+
+
+def parse_arguments():
+    """
+    Parse command line arguments.
+
+    # Returns
+        Dictionnary containing the command line arguments
+    """
+
+    parser = argparse.ArgumentParser(description='Validate the bounding box labels and convert them')
+    add_arguments(parser)
+    args = vars(parser.parse_args())
+
+    return args
+
+
+def main(args=None):
+    """
+    Main function
+
+    # Arguments
+        args: Dictionnary of command line arguments (default: parsed from sys.argv)
+    """
+
+    if args is None:
+        args = parse_arguments()
+
+    if not Path(args['labels']).is_dir():
+        print(f'Labels folder {args["labels"]} does not exist')
+        sys.exit(1)
+
+    classes = read_classes(args['classes'])
+    if args['format'] is not None:
+        if classes is None:
+            print(f'Classes file {args["classes"]} is required to convert the labels')
+            sys.exit(1)
+        if args['output'] is None:
+            print('Please specify the output with -o')
+            sys.exit(1)
+
+    count, converted, errors = convert_labels(Path(args['labels']), Path(args['images']), classes,
+                                              args['format'], args['output'], args['workers'])
+
+    for (path, error) in errors:
+        print(f'{path}: {error}')
+    print(f'{count} label files checked, {len({p for (p, _) in errors})} invalid')
+    if args['format'] is not None:
+        print(f'{converted} label files converted to {args["format"]} in {args["output"]}')
+
+    if errors:
+        sys.exit(1)
+
+    print('Done!')
+
+
+if __name__ == "__main__":
+    main()
@@ -4,21 +4,73 @@
 # Version 3, 29 June 2007
 # ==============================================================================
 
+import os
 import sys
+import time
 import argparse
 from pathlib import Path
-import numpy as np
-from PIL import Image
-from hashlib import sha1
+from collections import deque
+from math import comb
+from itertools import combinations
+from functools import partial, lru_cache
+from hashlib import sha1, blake2b
 from collections import defaultdict
+from scanner import scan, relative_path
+from removal import KEEP_POLICIES, PLAN_FILE, plan_removals, write_plan, read_plan, execute_plan
+import instrument
+from lazy import lazy_import
 
-# Supported image formats
-IMAGE_FORMATS = ['.jpeg', '.jpg', '.png', '.JPEG', '.PNG', '.JPG']
+np = lazy_import('numpy')
+Image = lazy_import('PIL.Image')
 
 # Image Model
 MODE = "RGB"
 
+# Block size used to read raw files
+READ_SIZE = 1 << 20
 
+# Size of the strips of pixels hashed at once by hash_image, in bytes
+HASH_STRIP = 1 << 22
+
+# Number of images sent to a worker at once
+CHUNK_SIZE = 64
+
+# Name of the hash cache file, stored in the images folder
+CACHE_FILE = '.duplicate_find.sqlite'
+
+# Number of new cache entries written per transaction
+CACHE_BATCH = 10000
+
+# Side of the perceptual hash grid (HASH_SIZE * HASH_SIZE = 64 bits)
+HASH_SIZE = 8
+
+# Side of the grayscale thumbnail used for pHash
+PHASH_SIZE = 32
+
+# Number of candidate pairs compared at once when searching near-duplicates
+PAIR_BATCH = 1 << 20
+
+# Cost of looking up a block value relative to comparing a candidate pair
+PROBE_COST = 1
+
+# Maximum width of the blocks of near-duplicate search (table of 2**MAX_BLOCK_BITS bucket starts)
+MAX_BLOCK_BITS = 22
+
+
+@lru_cache(maxsize=None)
+def dct_matrix():
+    """
+    Orthonormal DCT-II matrix used for pHash
+    """
+
+    k = np.arange(PHASH_SIZE)
+    m = np.sqrt(2 / PHASH_SIZE) * np.cos(np.pi * (2 * k[None, :] + 1) * k[:, None] / (2 * PHASH_SIZE))
+    m[0] /= np.sqrt(2)
+
+    return m
+
+
+@instrument.timed('find_identical_images')
 def find_identical_images(imdict):
     """
     """
@@ -32,6 +84,161 @@ def find_identical_images(imdict):
     return duple
 
 
+
+class UnionFind():
+    """
+    Disjoint sets of integers with path halving and union by size
+    """
+
+    def __init__(self, n):
+
+        self.parent = list(range(n))
+        self.size = [1] * n
+
+    def find(self, a):
+        """
+        Return the representative of the set containing a
+        """
+
+        parent = self.parent
+        while parent[a] != a:
+            parent[a] = parent[parent[a]]
+            a = parent[a]
+        return a
+
+    def union(self, a, b):
+        """
+        Merge the sets containing a and b
+        """
+
+        a, b = self.find(a), self.find(b)
+        if a == b:
+            return
+        if self.size[a] < self.size[b]:
+            a, b = b, a
+        self.parent[b] = a
+        self.size[a] += self.size[b]
+
+
+def popcount(x):
+    """
+    Count the set bits of each element of an uint64 array
+    """
+
+    if hasattr(np, 'bitwise_count'): # NumPy >= 2.0
+        return np.bitwise_count(x)
+
+    x = x - ((x >> np.uint64(1)) & np.uint64(0x5555555555555555))
+    x = (x & np.uint64(0x3333333333333333)) + ((x >> np.uint64(2)) & np.uint64(0x3333333333333333))
+    x = (x + (x >> np.uint64(4))) & np.uint64(0x0f0f0f0f0f0f0f0f)
+
+    return (x * np.uint64(0x0101010101010101)) >> np.uint64(56)
+
+
+def search_plan(count, threshold):
+    """
+    Choose the blocks of the multi-index search of near-duplicates
+
+    If two 64-bit hashes are within threshold bits, at least one of their
+    m blocks differs by at most threshold // m bits. Few wide blocks give
+    small buckets but many bit flips to probe, many narrow blocks the
+    opposite. The number of blocks is chosen from the number of hashes to
+    minimize the expected work, so buckets stay small whatever the size
+    of the dataset.
+
+    # Arguments
+        count: Number of distinct hashes
+        threshold: Maximum Hamming distance between two near-duplicates
+
+    # Returns
+        The (number of blocks, bit flips probed per block) tuple
+    """
+
+    best = None
+    for blocks in range(-(-64 // MAX_BLOCK_BITS), max(threshold + 1, -(-64 // MAX_BLOCK_BITS)) + 1):
+        width, radius = 64 / blocks, threshold // blocks
+        probes = blocks * sum(comb(int(width), k) for k in range(radius + 1))
+        cost = probes * (PROBE_COST + count / 2 ** width)
+        if best is None or cost < best[0]:
+            best = (cost, blocks, radius)
+
+    return best[1:]
+
+
+def flip_masks(width, radius):
+    """
+    All the masks of at most radius bits among width bits
+    """
+
+    return [sum(1 << b for b in bits) for k in range(radius + 1) for bits in combinations(range(width), k)]
+
+
+@instrument.timed('find_near_images')
+def find_near_images(imdict, threshold):
+    """
+    Find clusters of images whose perceptual hashes are close
+    
+    Identical hashes (e.g. blank images) are merged first and compared
+    once. The distinct hashes are then searched with multi-index hashing
+    (see search_plan): the hashes are sorted by each block in turn, and
+    every hash looks up the buckets of the block values within the allowed
+    bit flips of its own. Candidates are checked PAIR_BATCH at a time, so
+    the memory does not depend on the size of the buckets, and matching
+    pairs are merged with union-find.
+    
+    # Arguments
+        imdict: Dictionnary {'filename': perceptual_hash}
+        threshold: Maximum Hamming distance between two near-duplicates
+    
+    # Returns
+        The list of clusters (sets of filenames)
+    """
+
+    names = list(imdict.keys())
+    hashes, first, inverse = np.unique(np.array(list(imdict.values()), dtype=np.uint64),
+                                       return_index=True, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    sets = UnionFind(len(names))
+    for i, u in enumerate(inverse.tolist()):
+        sets.union(i, int(first[u]))
+
+    count = len(hashes)
+    blocks, radius = search_plan(count, threshold)
+    bounds = np.linspace(0, 64, blocks + 1).astype(int)
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        width = int(end - start)
+        keys = ((hashes >> np.uint64(start)) & np.uint64((1 << width) - 1)).astype(np.intp)
+        order = np.argsort(keys, kind='stable')
+        keys, block = keys[order], hashes[order]
+        # Start of the bucket of each block value in the sorted hashes
+        starts = np.zeros((1 << width) + 1, dtype=np.intp)
+        np.cumsum(np.bincount(keys, minlength=1 << width), out=starts[1:])
+        for flip in flip_masks(width, radius):
+            found = starts[keys ^ flip]
+            sizes = starts[(keys ^ flip) + 1] - found
+            # Candidate pairs, expanded by slices of about PAIR_BATCH pairs
+            ends = np.cumsum(sizes)
+            i = 0
+            while i < count:
+                j = max(i + 1, int(np.searchsorted(ends, ends[i] - sizes[i] + PAIR_BATCH, 'right')))
+                n = sizes[i:j]
+                rows = np.repeat(np.arange(i, j), n)
+                cols = np.repeat(found[i:j] - np.cumsum(n) + n, n) + np.arange(int(n.sum()))
+                keep = cols > rows
+                rows, cols = rows[keep], cols[keep]
+                close = popcount(block[rows] ^ block[cols]) <= threshold
+                for a, b in zip(order[rows[close]].tolist(), order[cols[close]].tolist()):
+                    sets.union(int(first[a]), int(first[b]))
+                i = j
+
+    clusters = defaultdict(set)
+    for i, name in enumerate(names):
+        if sets.size[sets.find(i)] > 1:
+            clusters[sets.find(i)].add(name)
+
+    return list(clusters.values())
+
+
 def check_folder(args):
     """
     Check if the specified folder exists and contains images
@@ -40,7 +247,7 @@ def check_folder(args):
         args: Dictionnary containing the command line arguments
     
     # Returns
-        The list of images in the specified folder
+        A generator of the images (os.DirEntry) in the specified folder
     """
     
     SRC_PATH = Path(args['folder'])
@@ -49,37 +256,626 @@ def check_folder(args):
         print(f'"{SRC_PATH}" does not exist or is a file!')
         sys.exit(1)
 
-    imgs = list(SRC_PATH.iterdir())
-    imgs = [x for x in imgs if x.suffix in IMAGE_FORMATS]
+    return instrument.timed_iter('list images', scan(SRC_PATH, recursive=args.get('recursive', False)))
+
+
+@instrument.timed('read header')
+def image_size(path):
+    """
+    Read the dimensions of an image from its header, without decoding pixels
+    
+    # Arguments
+        path: Path of the image
+    
+    # Returns
+        The (width, height) tuple
+    """
+
+    with Image.open(path) as im:
+        return im.size
+
+
+def file_digest(path):
+    """
+    Compute the blake2b hash of the raw bytes of a file
+    
+    # Arguments
+        path: Path of the file
+    
+    # Returns
+        The blake2b hex digest of the file
+    """
+
+    h = blake2b(digest_size=20)
+    with open(path, 'rb') as f:
+        while True:
+            with instrument.stage('read bytes'):
+                block = f.read(READ_SIZE)
+            if not block:
+                break
+            instrument.count('bytes read', len(block))
+            with instrument.stage('blake2b'):
+                h.update(block)
+
+    return h.hexdigest()
+
+
+def hash_image(path):
+    """
+    Compute the hash of the pixel data of a single image
+    
+    The decoded image is converted to MODE and hashed by strips of at most
+    HASH_STRIP bytes, so apart from the decoded image no full-size copy is
+    made. The digest is the same as hashing the whole converted image.
+    
+    # Arguments
+        path: Path of the image
+    
+    # Returns
+        The (width, height) of the image and the sha1 hex digest of the image converted to MODE
+    """
+
+    with instrument.stage('open'):
+        im = Image.open(path)
+    with im:
+        with instrument.stage('decode'):
+            im.load()
+        instrument.count('images decoded')
+        instrument.count('pixels decoded', im.width * im.height)
+
+        width, height = im.size
+        rows = max(1, HASH_STRIP // (Image.getmodebands(MODE) * max(1, width)))
+        h = sha1()
+        for top in range(0, height, rows):
+            with instrument.stage('convert'):
+                strip = im.crop((0, top, width, min(height, top + rows)))
+                if strip.mode != MODE:
+                    strip = strip.convert(MODE)
+                data = strip.tobytes()
+            with instrument.stage('sha1'):
+                h.update(data)
+
+    return (width, height), h.hexdigest()
+
+
+def grayscale_thumbnail(path, width, height):
+    """
+    Decode an image to a small grayscale array
+    
+    JPEG images are decoded directly at a reduced scale (Image.draft).
+    
+    # Arguments
+        path: Path of the image
+        width, height: Size of the thumbnail
+    
+    # Returns
+        The float32 array of shape (height, width)
+    """
+
+    im = Image.open(path)
+    im.draft('L', (width * 8, height * 8))
+    im = im.convert('L').resize((width, height), Image.BOX)
+
+    return np.asarray(im, dtype=np.float32)
+
+
+def pack_bits(bits):
+    """
+    Pack an array of HASH_SIZE * HASH_SIZE booleans into an integer
+    """
+
+    return int.from_bytes(np.packbits(bits.ravel()).tobytes(), 'big')
+
+
+def dhash(path):
+    """
+    Compute the 64-bit difference hash of an image
+    
+    Each bit tells whether a pixel is brighter than its left neighbour
+    in a (HASH_SIZE + 1) x HASH_SIZE thumbnail.
+    """
+
+    px = grayscale_thumbnail(path, HASH_SIZE + 1, HASH_SIZE)
+
+    return pack_bits(px[:, 1:] > px[:, :-1])
+
+
+def phash(path):
+    """
+    Compute the 64-bit DCT perceptual hash of an image
+    
+    Each bit tells whether a low-frequency DCT coefficient of a
+    PHASH_SIZE x PHASH_SIZE thumbnail is above their median.
+    """
+
+    px = grayscale_thumbnail(path, PHASH_SIZE, PHASH_SIZE)
+    low = (dct_matrix() @ px @ dct_matrix().T)[:HASH_SIZE, :HASH_SIZE]
+
+    return pack_bits(low > np.median(low))
+
+
+# Perceptual hash functions available with --near
+PERCEPTUAL_HASHES = {'dhash': dhash, 'phash': phash}
+
+
+def apply_chunk(func, paths):
+    """
+    Apply func to a chunk of images (process pool worker)
+    
+    # Arguments
+        func: Function taking an image path
+        paths: List of image paths
+    
+    # Returns
+        The list of results, in the same order as paths
+    """
+
+    return [func(p) for p in paths]
+
+
+def chunks(images, size):
+    """
+    Split an iterable of images into lists of at most size elements
+    """
+
+    chunk = []
+    for i in images:
+        chunk.append(i)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def map_parallel(func, images, workers, chunksize=CHUNK_SIZE):
+    """
+    Apply func to images in a process pool, yielding (image, result) in input order
+    
+    At most 2 chunks per worker are in flight, so memory stays bounded
+    whatever the number of images.
+    
+    # Arguments
+        func: Function taking an image path
+        images: Iterable of images (os.DirEntry or paths)
+        workers: Number of worker processes
+        chunksize: Number of images per task
+    """
+
+    from concurrent.futures import ProcessPoolExecutor
+
+    # With --profile, the workers send their stages along with the results
+    profiled = instrument.ENABLED
+    task = instrument.worker_task(partial(apply_chunk, func))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for chunk in chunks(images, chunksize):
+            pending.append((chunk, executor.submit(task, [os.fspath(i) for i in chunk])))
+            if len(pending) >= 2 * workers:
+                chunk, future = pending.popleft()
+                yield from zip(chunk, instrument.unwrap(future.result(), profiled))
+        while pending:
+            chunk, future = pending.popleft()
+            yield from zip(chunk, instrument.unwrap(future.result(), profiled))
+
+
+def map_images(func, images, workers=1):
+    """
+    Apply func to images, yielding (image, result) in input order
+    
+    # Arguments
+        func: Function taking an image path
+        images: Iterable of image paths
+        workers: Number of worker processes (1 runs in the main process)
+    """
+
+    if workers > 1:
+        return map_parallel(func, images, workers)
+
+    return ((i, func(i)) for i in images)
+
+
+class HashCache():
+    """
+    Persistent cache of image dimensions and hashes stored in a SQLite file
+
+    Entries are keyed on the path relative to the images folder and are
+    only reused if size, mtime_ns and inode are unchanged. The hash of an
+    entry is NULL when the image was never decoded.
+
+    Entries are looked up one by one, so the table is never loaded in
+    memory. The paths looked up are recorded in a temporary table, and
+    the other entries are deleted on close().
+
+    If the cache cannot be written (read-only or locked folder), the
+    entries already cached are still used but nothing is written.
+    """
+
+    COLUMNS = ['path', 'size', 'mtime_ns', 'inode', 'width', 'height', 'hash']
+
+    def __init__(self, folder, rebuild=False):
+
+        import sqlite3
+
+        self.folder = Path(folder)
+        self.path = self.folder/CACHE_FILE
+        self.db = sqlite3.connect(str(self.path))
+        columns = [row[1] for row in self.db.execute('PRAGMA table_info(hashes)')]
+        if rebuild or (columns and columns != self.COLUMNS):
+            self.db.execute('DROP TABLE IF EXISTS hashes')
+        self.db.execute('CREATE TABLE IF NOT EXISTS hashes '
+                        '(path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, inode INTEGER, '
+                        'width INTEGER, height INTEGER, hash TEXT)')
+        self.db.execute('CREATE TEMP TABLE seen (path TEXT PRIMARY KEY)')
+
+        self.keys = {}
+        self.seen = []
+        self.pending = []
+        self.readonly = False
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+
+    def get(self, image):
+        """
+        Look up an image in the cache
+        
+        # Arguments
+            image: Path of the image
+        
+        # Returns
+            The cached ((width, height), hash) tuple, or None if the image is new or has changed
+        """
+
+        name = relative_path(image, self.folder)
+        st = image.stat()
+        key = (st.st_size, st.st_mtime_ns, st.st_ino)
+        self.seen.append((name,))
+        if len(self.seen) >= CACHE_BATCH:
+            self.flush()
+
+        entry = self.db.execute('SELECT size, mtime_ns, inode, width, height, hash FROM hashes WHERE path = ?',
+                                (name,)).fetchone()
+        if entry is not None and entry[:3] == key:
+            self.hits += 1
+            if entry[5] is None:
+                self.keys[name] = key # Not decoded yet, may be put()
+            return entry[3:5], entry[5]
+
+        self.misses += 1
+        if entry is not None:
+            self.stale += 1
+        self.keys[name] = key
+        return None
+
+    def put(self, image, dims, value):
+        """
+        Store the dimensions and hash of an image previously looked up with get()
+        """
+
+        name = relative_path(image, self.folder)
+        self.pending.append((name,) + self.keys.pop(name) + tuple(dims) + (value,))
+        if len(self.pending) >= CACHE_BATCH:
+            self.flush()
+
+    def flush(self):
+        """
+        Write pending entries to disk
+        """
+
+        import sqlite3
+
+        try:
+            with self.db:
+                if not self.readonly:
+                    self.db.executemany('INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?, ?)', self.pending)
+                self.db.executemany('INSERT OR IGNORE INTO seen VALUES (?)', self.seen)
+        except sqlite3.Error as e:
+            print(f'Cannot write the hash cache {self.path} ({e}), new hashes will not be cached')
+            self.readonly = True
+            return self.flush()
+        self.pending = []
+        self.seen = []
+
+    def close(self):
+        """
+        Write pending entries, drop entries of deleted images and print stats
+        """
+
+        self.flush()
+        if not self.readonly:
+            with self.db:
+                removed = self.db.execute('DELETE FROM hashes WHERE path NOT IN (SELECT path FROM seen)').rowcount
+            self.stale += removed
+        self.db.close()
+        if self.readonly:
+            print(f'Cache: {self.hits} hits, {self.misses} misses, {self.stale} stale entries (not updated)')
+        else:
+            print(f'Cache: {self.hits} hits, {self.misses} misses, {self.stale} stale entries removed')
+
+
+def open_cache(folder, rebuild=False):
+    """
+    Open the hash cache of a folder
     
-    return imgs
+    # Arguments
+        folder: Images folder
+        rebuild: Discard the cached entries
+    
+    # Returns
+        The HashCache, or None if the cache file cannot be opened (e.g. read-only folder)
+    """
+
+    import sqlite3
 
+    try:
+        return HashCache(folder, rebuild)
+    except sqlite3.Error as e:
+        print(f'Cannot open the hash cache of {folder} ({e}), images are hashed without it')
+        return None
 
-def compute_hash(images):
+
+def image_key(image, folder=None):
+    """
+    Key of an image in the hash dictionnaries
+    
+    # Arguments
+        image: os.DirEntry or path of the image
+        folder: Scanned folder, or None to use the file name
+    
+    # Returns
+        The path of the image relative to folder, or its file name
+    """
+
+    if folder is None:
+        return image.name
+
+    return relative_path(image, folder)
+
+
+def filter_cached(images, hashes, dims, cache, folder=None):
+    """
+    Yield the images whose hash is not in the cache
+    
+    A key is added to hashes for every image, in the order of images,
+    with the cached hash or None.
+    
+    # Arguments
+        images: Iterable of images
+        hashes: Dictionnary {'filename': hash_value} to fill
+        dims: Dictionnary {'filename': (width, height)} to fill from the cache
+        cache: HashCache, or None
+        folder: Scanned folder (see image_key)
+    """
+
+    for i in images:
+        name = image_key(i, folder)
+        hashes[name] = None
+        if cache is not None:
+            with instrument.stage('cache lookup'):
+                entry = cache.get(i)
+            if entry is not None:
+                dims[name], hashes[name] = entry
+        if hashes[name] is None:
+            yield i
+
+
+@instrument.timed('compute_hash')
+def compute_hash(images, workers=1, cache=None, prefilter=False, folder=None):
     """
     Compute the hash of each image
     
+    Images are consumed as they come, so images can be a generator.
+    
     # Arguments
-        images: The list of images
+        images: Iterable of images (os.DirEntry or paths)
+        workers: Number of worker processes (1 hashes in the main process)
+        cache: Optional HashCache, only images missing from it are hashed
+        prefilter: Only decode images which may have a twin (see compute_hash_staged)
+        folder: Scanned folder, keys are relative to it (default: file names)
     
     # Returns
         A dictionnary {'filename': hash_value}
     """
 
+    if prefilter:
+        return compute_hash_staged(images, workers, cache, folder)
+
     print('Computing hashes...')
 
     hashes = defaultdict()
+    dims = {}
+    count = 0
+    start = time.perf_counter()
 
-    for i in images:
-        im = Image.open(i)
-        if im.mode != MODE:
-            im = im.convert(MODE)
-        im_np = np.array(im)
-        hashes[i.name] = sha1(im_np).hexdigest()
+    for i, (size, h) in map_images(hash_image, filter_cached(images, hashes, dims, cache, folder), workers):
+        name = image_key(i, folder)
+        hashes[name] = h
+        count += 1
+        if cache is not None:
+            with instrument.stage('cache update'):
+                cache.put(i, size, h)
+
+    elapsed = time.perf_counter() - start
+    rate = count / elapsed if elapsed > 0 else 0.0
+    print(f'Hashed {count} images in {elapsed:.2f}s ({rate:.1f} images/sec)')
+    
+    return hashes
+
+
+def compute_hash_staged(images, workers=1, cache=None, folder=None):
+    """
+    Compute a key for each image, decoding pixels only when needed
+    
+    Stage 1 reads the dimensions from the image headers: an image whose
+    dimensions are unique cannot have a twin. Stage 2 hashes the raw bytes
+    of the remaining images: if all of them share the same bytes they are
+    identical. Only the other groups reach stage 3, the pixel hash of
+    hash_image, which is computed once per set of byte-identical files.
     
+    Two images have the same key if and only if they have the same
+    pixels, so find_identical_images returns the same sets as with
+    compute_hash. Keys of images that were not decoded are not sha1
+    digests of their pixels.
+    
+    # Arguments
+        images: Iterable of images (os.DirEntry or paths)
+        workers: Number of worker processes (1 hashes in the main process)
+        cache: Optional HashCache, used for dimensions and pixel hashes
+        folder: Scanned folder, keys are relative to it (default: file names)
+    
+    # Returns
+        A dictionnary {'filename': key}
+    """
+
+    print('Computing hashes...')
+
+    hashes = defaultdict()
+    dims = {}
+    start = time.perf_counter()
+
+    # Stage 1: group by dimensions
+    todo = []
+    paths = {}
+    for i in filter_cached(images, hashes, dims, cache, folder):
+        todo.append(image_key(i, folder))
+        paths[todo[-1]] = i
+    for name, (i, d) in zip(todo, map_images(image_size, [paths[n] for n in todo], workers)):
+        dims[name] = d
+    updated = set(todo)
+    pixel = set(name for name, h in hashes.items() if h is not None)
+    headers = len(todo)
+
+    groups = defaultdict(list)
+    for name in hashes:
+        groups[dims[name]].append(name)
+
+    # Stage 2: raw bytes hash of the images sharing their dimensions
+    todo = [n for group in groups.values() if len(group) > 1 for n in group if hashes[n] is None]
+    digests = dict((name, d) for name, (i, d) in zip(todo, map_images(file_digest, [paths[n] for n in todo], workers)))
+    raw = len(todo)
+
+    # Stage 3: pixel hash of one image per set of byte-identical files
+    todo = {}
+    for size, group in groups.items():
+        unknown = [n for n in group if hashes[n] is None]
+        if not unknown:
+            continue
+        if len(group) == 1:
+            hashes[group[0]] = f'size:{size[0]}x{size[1]}:{group[0]}'
+        elif len(unknown) == len(group) and len(set(digests[n] for n in group)) == 1:
+            for n in group:
+                hashes[n] = f'bytes:{digests[n]}'
+        else:
+            for n in unknown:
+                todo.setdefault(digests[n], []).append(n)
+    for same, (i, (_, h)) in zip(todo.values(), map_images(hash_image, [paths[same[0]] for same in todo.values()], workers)):
+        for n in same:
+            hashes[n] = h
+            pixel.add(n)
+            updated.add(n)
+    decoded = len(todo)
+
+    if cache is not None:
+        with instrument.stage('cache update'):
+            for n in updated:
+                cache.put(paths[n], dims[n], hashes[n] if n in pixel else None)
+
+    elapsed = time.perf_counter() - start
+    print(f'Stage 1: read {headers} headers, {sum(len(g) for g in groups.values() if len(g) == 1)} images with unique dimensions')
+    print(f'Stage 2: hashed the bytes of {raw} images')
+    print(f'Stage 3: decoded {decoded} images, {len(hashes) - decoded} decodings avoided')
+    print(f'Processed {len(hashes)} images in {elapsed:.2f}s')
+    
+    return hashes
+
+
+@instrument.timed('compute_perceptual_hash')
+def compute_perceptual_hash(images, workers=1, method='dhash', folder=None):
+    """
+    Compute the perceptual hash of each image
+    
+    # Arguments
+        images: Iterable of images (os.DirEntry or paths)
+        workers: Number of worker processes (1 hashes in the main process)
+        method: Name of the hash function in PERCEPTUAL_HASHES
+        folder: Scanned folder, keys are relative to it (default: file names)
+    
+    # Returns
+        A dictionnary {'filename': 64-bit hash}
+    """
+
+    print(f'Computing perceptual hashes ({method})...')
+
+    hashes = defaultdict()
+    start = time.perf_counter()
+
+    for i, h in map_images(PERCEPTUAL_HASHES[method], images, workers):
+        hashes[image_key(i, folder)] = h
+
+    elapsed = time.perf_counter() - start
+    rate = len(hashes) / elapsed if elapsed > 0 else 0.0
+    print(f'Hashed {len(hashes)} images in {elapsed:.2f}s ({rate:.1f} images/sec)')
+
     return hashes
 
 
+def clean_duplicates(plan, folder, quarantine=None, jobs=1):
+    """
+    Execute a removal plan and print its report
+
+    # Arguments
+        plan: Plan file (see removal.write_plan)
+        folder: Images folder
+        quarantine: Quarantine folder, or None to delete the duplicates
+        jobs: Number of concurrent removal batches
+
+    # Returns
+        True if every file was handled
+    """
+
+    header, _ = read_plan(plan)
+    if header['folder'] != os.path.abspath(folder):
+        print(f'The plan {plan} was made for "{header["folder"]}"')
+        return False
+
+    print(f'Removing {header["files"]} duplicates of {header["sets"]} images'
+          + (f' to {quarantine}' if quarantine is not None else '') + '...')
+    counts, failures = execute_plan(plan, folder, quarantine, jobs)
+    print(', '.join(f'{status}: {n}' for (status, n) in sorted(counts.items())))
+    if counts.get('changed'):
+        print(f'{counts["changed"]} files were left alone because they or their kept image changed since the plan')
+    for rel, error in failures:
+        print(f'Failed to remove {rel}: {error}')
+    if failures:
+        print(f'Run again with --apply {plan} to retry')
+
+    return not failures
+
+
+def add_arguments(parser):
+    """
+    Add the command line arguments to a parser
+    """
+
+    parser.add_argument('-f','--folder', help='Folder containing the images', required=True, type=str)
+    parser.add_argument('-c','--clean', help='Remove the duplicates, keeping one image of each set (see --keep)', action='store_true')
+    parser.add_argument('--keep', help='Image kept in each set of duplicates (default: oldest)', choices=sorted(KEEP_POLICIES), default='oldest')
+    parser.add_argument('--dry-run', help='Only write the removal plan of --clean', action='store_true')
+    parser.add_argument('--plan', help=f'Removal plan file (default: {PLAN_FILE} in the images folder)', required=False, type=str, default=None)
+    parser.add_argument('--apply', help='Execute a removal plan written by --dry-run, or resume an interrupted --clean', required=False, type=str, default=None)
+    parser.add_argument('--quarantine', help='Move the duplicates to this folder instead of deleting them', required=False, type=str, default=None)
+    parser.add_argument('-j','--jobs', help='Number of concurrent removal batches (default: 8)', required=False, type=int, default=8)
+    parser.add_argument('-r','--recursive', help='Also scan the sub-folders', action='store_true')
+    parser.add_argument('-w','--workers', help='Number of hashing processes (default: 1)', required=False, type=int, default=1)
+    parser.add_argument('--no-cache', help='Do not use the hash cache of the folder', action='store_true')
+    parser.add_argument('--rebuild-cache', help='Discard the hash cache and hash every image', action='store_true')
+    parser.add_argument('--no-prefilter', help='Decode every image instead of prefiltering on dimensions and raw bytes', action='store_true')
+    parser.add_argument('-n','--near', help='Only report near-duplicates within this Hamming distance of perceptual hashes (not with --clean)', required=False, type=int, default=None)
+    parser.add_argument('--perceptual', help='Perceptual hash used with --near (default: dhash)', choices=sorted(PERCEPTUAL_HASHES), default='dhash')
+    instrument.add_arguments(parser)
+
+
 def parse_arguments():
     """
     Parse command line arguments.
@@ -89,47 +885,77 @@ def parse_arguments():
     """
     
     parser = argparse.ArgumentParser(description='Identical Images Finder')
-    parser.add_argument('-f','--folder', help='Folder containing the images', required=True, type=str)
-    parser.add_argument('-c','--clean', action='store_true')
+    add_arguments(parser)
     args = vars(parser.parse_args())
 
     return args
 
 
-def main():    
+def main(args=None):
     """
     Main function
+
+    # Arguments
+        args: Dictionnary of command line arguments (default: parsed from sys.argv)
     """
     
     # Parse command line arguments
-    args = parse_arguments()
-    
-    # Check if the specified folder exists and contains images
-    imgs = check_folder(args)
-
-    # Compute hash for each images
-    l = compute_hash(imgs)
-
-    # Find identical images
-    iden = find_identical_images(l)
-    print(f'Found {len(iden)} sets of identical images!')
-    if args['clean'] == False:
-        for i in iden:
-            print(i)
-
-    # Remove duplicated images
-    if args['clean'] == True:
-        for i in iden:
-            remove = list(i)[1:]
-            for r in remove:
-                a = Path(args['folder'])/Path(r)
-                a.unlink()
-                print(f'Removed {a}')
-
-    # End
-    print('Done!')
-
-    print()
+    if args is None:
+        args = parse_arguments()
+    
+    # Near-duplicates are only reported: resized copies, crops or neighbouring
+    # frames are distinct images that must not be removed automatically
+    if args.get('near') is not None and (args.get('clean') or args.get('dry_run') or args.get('apply') is not None):
+        print('--near cannot be combined with --clean, --dry-run or --apply')
+        sys.exit(1)
+
+    with instrument.profile(args):
+        # Check if the specified folder exists and contains images
+        imgs = check_folder(args)
+
+        # Execute a removal plan
+        if args['apply'] is not None:
+            if not clean_duplicates(args['apply'], args['folder'], args['quarantine'], args['jobs']):
+                sys.exit(1)
+            print('Done!')
+            return
+
+        if args['near'] is not None:
+            # Find near-duplicate images
+            l = compute_perceptual_hash(imgs, workers=args['workers'], method=args['perceptual'], folder=Path(args['folder']))
+            iden = find_near_images(l, args['near'])
+            print(f'Found {len(iden)} clusters of near-duplicate images!')
+        else:
+            # Open the hash cache of the folder
+            cache = None
+            if args['no_cache'] == False:
+                cache = open_cache(args['folder'], rebuild=args['rebuild_cache'])
+
+            # Compute hash for each images
+            l = compute_hash(imgs, workers=args['workers'], cache=cache, prefilter=not args['no_prefilter'], folder=Path(args['folder']))
+            if cache is not None:
+                cache.close()
+
+            # Find identical images
+            iden = find_identical_images(l)
+            print(f'Found {len(iden)} sets of identical images!')
+        if args['clean'] == False and args['dry_run'] == False:
+            for i in iden:
+                print(i)
+
+        # Remove duplicated images
+        if args['clean'] == True or args['dry_run'] == True:
+            plan = plan_removals(iden, args['folder'], args['keep'], args['jobs'])
+            path = args['plan'] or os.path.join(args['folder'], PLAN_FILE)
+            write_plan(path, args['folder'], args['keep'], plan)
+            print(f'Removal plan written to {path}: keep {len(plan)} images, remove {sum(len(r) for (_, r) in plan)} duplicates')
+            if args['dry_run'] == False and not clean_duplicates(path, args['folder'], args['quarantine'], args['jobs']):
+                sys.exit(1)
+
+        # End
+        print('Done!')
+
+        print()
 
 
 if __name__ == "__main__":
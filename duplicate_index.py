@@ -0,0 +1,552 @@
+# Copyright 2018 Mikaël Swawola. All Rights Reserved.
+#
+# GNU GENERAL PUBLIC LICENSE
+# Version 3, 29 June 2007
+# ==============================================================================
+
+import os
+import sys
+import json
+import argparse
+from pathlib import Path
+
+from scanner import scan, relative_path
+import instrument
+from lazy import lazy_import
+
+np = lazy_import('numpy')
+
+# Width of the digests: sha1 of the pixels (see duplicate_find.hash_image)
+DIGEST_SIZE = 20
+
+# Manifest of the index, listing its segments and folders
+MANIFEST = 'index.json'
+
+# Paths of the indexed images, and offset of each path (one more than the images)
+PATHS_FILE = 'paths.bin'
+OFFSETS_FILE = 'offsets.bin'
+
+# Type of the image ids and of the path offsets (little-endian uint64)
+ID_TYPE = '<u8'
+
+# Size and modification time (ns) of each indexed image when it was hashed
+STATS_FILE = 'stats.bin'
+STAT_TYPE = '<i8'
+
+# Sorted ids of the images removed or modified since they were indexed
+TOMBSTONES_FILE = 'tombstones.bin'
+
+# Number of segments above which they are merged into one
+MAX_SEGMENTS = 8
+
+# Number of records of each segment merged at once
+MERGE_BLOCK = 1 << 20
+
+
+def digest_array(hexes):
+    """
+    Convert sha1 hex digests to a NumPy array of fixed-width binary digests
+
+    # Arguments
+        hexes: Sequence of hex digests
+
+    # Returns
+        A (n,) array of dtype S20
+    """
+
+    return np.frombuffer(b''.join(bytes.fromhex(h) for h in hexes), dtype=f'S{DIGEST_SIZE}')
+
+
+def write_array(path, array):
+    """
+    Write an array to a raw binary file and sync it
+    """
+
+    with open(path, 'wb') as f:
+        array.tofile(f)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def map_array(path, dtype):
+    """
+    Memory-map a raw binary file as a read-only array (empty files give empty arrays)
+    """
+
+    if os.path.getsize(path) == 0:
+        return np.empty(0, dtype=dtype)
+
+    return np.memmap(path, dtype=dtype, mode='r')
+
+
+def merge_segments(a, b, digests_path, ids_path, dead=()):
+    """
+    Merge two sorted segments into a new one, by blocks of MERGE_BLOCK records
+
+    # Arguments
+        a, b: (digests, ids) arrays of the segments, sorted by digest
+        digests_path, ids_path: Files of the merged segment
+        dead: Sorted array of the ids of the records to drop
+    """
+
+    (da, ia), (db, ib) = a, b
+    i = j = 0
+    with open(digests_path, 'wb') as fd, open(ids_path, 'wb') as fi:
+        while i < len(da) or j < len(db):
+            ba, bb = da[i:i + MERGE_BLOCK], db[j:j + MERGE_BLOCK]
+            # Every record up to the smallest last digest of the two blocks can be written
+            if len(ba) and len(bb):
+                limit = min(ba[-1], bb[-1])
+                na, nb = np.searchsorted(ba, limit, 'right'), np.searchsorted(bb, limit, 'right')
+            else:
+                na, nb = len(ba), len(bb)
+            digests = np.concatenate([ba[:na], bb[:nb]])
+            ids = np.concatenate([ia[i:i + na], ib[j:j + nb]])
+            order = np.argsort(digests, kind='stable')
+            order = order[~np.isin(ids[order], dead)]
+            digests[order].tofile(fd)
+            ids[order].tofile(fi)
+            i, j = i + na, j + nb
+        for f in (fd, fi):
+            f.flush()
+            os.fsync(f.fileno())
+
+
+class DuplicateIndex():
+    """
+    Persistent index of the pixel digests of the images of many folders
+
+    Each addition of images is written as a segment: the binary digests
+    sorted in one file and the image ids in the same order in another,
+    both memory-mapped. A lookup is a binary search in each segment, so
+    it only touches a few pages of the files whatever the size of the
+    index. Segments are merged when there are more than MAX_SEGMENTS.
+
+    The paths of the images are appended to PATHS_FILE, image id i being
+    between offsets i and i + 1 of OFFSETS_FILE, and their size and
+    modification time to STATS_FILE. An image removed or modified since
+    it was indexed is tombstoned: its id is ignored by the lookups and
+    dropped by the merges, and a modified image is indexed again under a
+    new id. The manifest is replaced atomically after the files are
+    written, so an interrupted addition leaves the index as it was.
+    """
+
+    def __init__(self, folder):
+
+        self.folder = Path(folder)
+        self.folder.mkdir(parents=True, exist_ok=True)
+        try:
+            with (self.folder/MANIFEST).open() as f:
+                self.manifest = json.load(f)
+        except FileNotFoundError:
+            self.manifest = {'count': 0, 'next_segment': 0, 'segments': [], 'folders': {}}
+        self.segments = None
+        self.offsets = None
+        self.stats = None
+        self.dead = None
+
+    def __len__(self):
+
+        return self.manifest['count'] - len(self.tombstones())
+
+    def open_segments(self):
+        """
+        Memory-map the segments, once
+
+        # Returns
+            The list of (digests, ids) arrays
+        """
+
+        if self.segments is None:
+            self.segments = [(map_array(self.folder/f'{name}.digests', f'S{DIGEST_SIZE}'),
+                              map_array(self.folder/f'{name}.ids', ID_TYPE))
+                             for name in self.manifest['segments']]
+
+        return self.segments
+
+    def release(self):
+        """
+        Drop the memory maps (before the files are replaced)
+        """
+
+        self.segments = None
+        self.offsets = None
+        self.stats = None
+        self.dead = None
+
+    def tombstones(self):
+        """
+        Sorted array of the ids of the removed or modified images
+        """
+
+        if self.dead is None:
+            path = self.folder/TOMBSTONES_FILE
+            self.dead = map_array(path, ID_TYPE) if path.exists() else np.empty(0, dtype=ID_TYPE)
+
+        return self.dead
+
+    def remove(self, image_ids):
+        """
+        Tombstone indexed images, atomically
+
+        # Arguments
+            image_ids: Ids of the removed or modified images
+        """
+
+        if not len(image_ids):
+            return
+
+        dead = np.union1d(self.tombstones(), np.asarray(image_ids, dtype=ID_TYPE)).astype(ID_TYPE)
+        tmp = self.folder/(TOMBSTONES_FILE + '.tmp')
+        write_array(tmp, dead)
+        os.replace(tmp, self.folder/TOMBSTONES_FILE)
+        self.dead = None
+
+    def paths(self, first, count=1):
+        """
+        Paths of the indexed images first to first + count - 1
+        """
+
+        if self.offsets is None:
+            self.offsets = map_array(self.folder/OFFSETS_FILE, ID_TYPE)
+        offsets = [int(o) for o in self.offsets[first:first + count + 1]]
+        with open(self.folder/PATHS_FILE, 'rb') as f:
+            f.seek(offsets[0])
+            data = f.read(offsets[-1] - offsets[0])
+
+        return [os.fsdecode(data[a - offsets[0]:b - offsets[0] - 1]) for (a, b) in zip(offsets, offsets[1:])]
+
+    def path(self, image_id):
+        """
+        Path of an indexed image
+        """
+
+        return self.paths(image_id)[0]
+
+    def folder_entries(self, folder):
+        """
+        Images of a folder in the index, except the tombstoned ones
+
+        # Returns
+            A dictionnary {path relative to folder: (image id, size, mtime_ns)}
+        """
+
+        folder = os.path.abspath(folder)
+        entries = {}
+        for (first, count) in self.manifest['folders'].get(folder, []):
+            if self.stats is None:
+                self.stats = map_array(self.folder/STATS_FILE, STAT_TYPE).reshape(-1, 2)
+            ids = np.arange(first, first + count)
+            alive = ~np.isin(ids, self.tombstones())
+            stats = self.stats[first:first + count]
+            for i, p, (size, mtime_ns), keep in zip(ids.tolist(), self.paths(first, count), stats.tolist(), alive):
+                if keep:
+                    entries[os.path.relpath(p, folder)] = (i, size, mtime_ns)
+
+        return entries
+
+    def save_manifest(self):
+        """
+        Atomically replace the manifest
+        """
+
+        tmp = self.folder/(MANIFEST + '.tmp')
+        with tmp.open('w') as f:
+            json.dump(self.manifest, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.folder/MANIFEST)
+
+    def append_paths(self, paths, stats):
+        """
+        Append image paths and (size, mtime_ns) stats, after discarding
+        those of an interrupted addition
+
+        # Returns
+            The id of the first path
+        """
+
+        count = self.manifest['count']
+        offsets_path, paths_path, stats_path = self.folder/OFFSETS_FILE, self.folder/PATHS_FILE, self.folder/STATS_FILE
+        with open(offsets_path, 'ab+') as f:
+            f.truncate(8 * (count + 1) if count else 0)
+            f.seek(8 * count)
+            end = int(np.frombuffer(f.read(8), dtype=ID_TYPE)[0]) if count else 0
+
+        encoded = [os.fsencode(p) + b'\n' for p in paths]
+        new_offsets = (end + np.cumsum([0] + [len(p) for p in encoded])).astype(ID_TYPE)
+        with open(paths_path, 'ab+') as f:
+            f.truncate(end)
+            f.write(b''.join(encoded))
+            f.flush()
+            os.fsync(f.fileno())
+        with open(offsets_path, 'ab') as f:
+            (new_offsets if count == 0 else new_offsets[1:]).tofile(f)
+            f.flush()
+            os.fsync(f.fileno())
+        with open(stats_path, 'ab') as f:
+            f.truncate(16 * count)
+            np.array(stats, dtype=STAT_TYPE).reshape(-1, 2).tofile(f)
+            f.flush()
+            os.fsync(f.fileno())
+        self.offsets = None
+        self.stats = None
+
+        return count
+
+    @instrument.timed('add to index')
+    def add(self, folder, items):
+        """
+        Add the images of a folder to the index as a new segment
+
+        # Arguments
+            folder: Images folder
+            items: List of (path relative to folder, sha1 hex digest, size, mtime_ns)
+
+        # Returns
+            The number of images added
+        """
+
+        if not items:
+            return 0
+
+        folder = os.path.abspath(folder)
+        first = self.append_paths([os.path.join(folder, rel) for (rel, _, _, _) in items],
+                                  [(size, mtime_ns) for (_, _, size, mtime_ns) in items])
+        digests = digest_array([h for (_, h, _, _) in items])
+        order = np.argsort(digests, kind='stable')
+
+        name = f'segment_{self.manifest["next_segment"]:06d}'
+        write_array(self.folder/f'{name}.digests', digests[order])
+        write_array(self.folder/f'{name}.ids', (first + order).astype(ID_TYPE))
+
+        self.manifest['next_segment'] += 1
+        self.manifest['segments'].append(name)
+        self.manifest['count'] += len(items)
+        self.manifest['folders'].setdefault(folder, []).append([first, len(items)])
+        self.save_manifest()
+        self.release()
+
+        if len(self.manifest['segments']) > MAX_SEGMENTS:
+            self.compact()
+
+        return len(items)
+
+    @instrument.timed('compact index')
+    def compact(self):
+        """
+        Merge all the segments into one, the two smallest first
+        """
+
+        segments = list(self.manifest['segments'])
+        while len(segments) > 1:
+            sizes = {name: os.path.getsize(self.folder/f'{name}.digests') for name in segments}
+            a, b = sorted(segments, key=lambda s: sizes[s])[:2]
+            name = f'segment_{self.manifest["next_segment"]:06d}'
+            self.manifest['next_segment'] += 1
+
+            mapped = dict(zip(self.manifest['segments'], self.open_segments()))
+            merge_segments(mapped[a], mapped[b], self.folder/f'{name}.digests', self.folder/f'{name}.ids',
+                           self.tombstones())
+            segments = [s for s in segments if s not in (a, b)] + [name]
+
+            self.manifest['segments'] = segments
+            self.save_manifest()
+            self.release()
+            for old in (a, b):
+                for ext in ('digests', 'ids'):
+                    os.unlink(self.folder/f'{old}.{ext}')
+
+    @instrument.timed('lookup')
+    def lookup(self, hexes):
+        """
+        Find the indexed images having each of the digests, except the
+        tombstoned ones
+
+        # Arguments
+            hexes: Sequence of sha1 hex digests
+
+        # Returns
+            A dictionnary {position in hexes: list of image ids}
+        """
+
+        queries = digest_array(hexes)
+        order = np.argsort(queries, kind='stable')
+        queries = queries[order]
+
+        found = {}
+        dead = self.tombstones()
+        for (digests, ids) in self.open_segments():
+            lo = np.searchsorted(digests, queries, 'left')
+            hi = np.searchsorted(digests, queries, 'right')
+            for k in np.nonzero(hi > lo)[0]:
+                alive = ids[lo[k]:hi[k]]
+                alive = alive[~np.isin(alive, dead)]
+                if len(alive):
+                    found.setdefault(int(order[k]), []).extend(int(i) for i in alive)
+
+        return found
+
+
+def hash_folder(folder, recursive=False, workers=1, use_cache=True, known=None):
+    """
+    Compute the pixel digests of the images of a folder
+
+    # Arguments
+        folder: Images folder
+        recursive: Also scan the sub-folders
+        workers: Number of worker processes
+        use_cache: Use the hash cache of the folder (see duplicate_find.HashCache)
+        known: Dictionnary {relative path: (image id, size, mtime_ns)} of the
+               images already indexed; those with the same size and mtime
+               are not returned, and only hashed with the cache (if it
+               can be opened), which must see every image
+
+    # Returns
+        The list of (path relative to folder, sha1 hex digest, size,
+        mtime_ns) of the other images, and the set of relative paths of
+        the unchanged known images
+    """
+
+    from duplicate_find import compute_hash, open_cache
+
+    folder = Path(folder)
+    known = known or {}
+    cache = open_cache(folder) if use_cache else None
+    images, stats, unchanged = [], {}, set()
+    for image in instrument.timed_iter('list images', scan(folder, recursive=recursive)):
+        rel = relative_path(image, folder)
+        st = image.stat()
+        entry = known.get(rel)
+        if entry is not None and entry[1:] == (st.st_size, st.st_mtime_ns):
+            unchanged.add(rel)
+            if cache is None:
+                continue
+        stats[rel] = (st.st_size, st.st_mtime_ns)
+        images.append(image)
+
+    hashes = compute_hash(images, workers=workers, cache=cache, folder=folder)
+    if cache is not None:
+        cache.close()
+
+    return [(rel, h) + stats[rel] for (rel, h) in hashes.items() if rel not in unchanged], unchanged
+
+
+def add_folders(index, folders, recursive=False, workers=1, use_cache=True):
+    """
+    Add the images of folders to an index
+
+    The images already indexed with the same size and modification time
+    are skipped. The modified images are tombstoned and indexed again,
+    and the removed images are tombstoned.
+
+    # Returns
+        The number of images added
+    """
+
+    added = 0
+    for folder in folders:
+        known = index.folder_entries(folder)
+        items, unchanged = hash_folder(folder, recursive, workers, use_cache, known)
+        stale = [entry[0] for (rel, entry) in known.items() if rel not in unchanged]
+        index.remove(stale)
+        count = index.add(folder, items)
+        print(f'{folder}: {count} images added ({len(unchanged)} unchanged, {len(stale)} modified or removed)')
+        added += count
+
+    return added
+
+
+def query_folder(index, folder, recursive=False, workers=1, use_cache=True):
+    """
+    Find the images of a folder which already exist in an index
+
+    An image is not reported as a duplicate of itself when its folder is
+    already indexed, and indexed images which no longer exist are not
+    reported.
+
+    # Returns
+        A dictionnary {path relative to folder: list of paths of identical indexed images}
+    """
+
+    items, _ = hash_folder(folder, recursive, workers, use_cache)
+    found = index.lookup([h for (_, h, _, _) in items])
+
+    duplicates = {}
+    for (k, image_ids) in sorted(found.items()):
+        rel = items[k][0]
+        own = os.path.join(os.path.abspath(folder), rel)
+        paths = [p for p in (index.path(i) for i in image_ids) if p != own and os.path.exists(p)]
+        if paths:
+            duplicates[rel] = paths
+
+    return duplicates
+
+
+def add_arguments(parser):
+    """
+    Add the command line arguments to a parser
+    """
+
+    parser.add_argument('-i','--index', help='Index folder', required=True, type=str)
+    parser.add_argument('-a','--add', help='Folders to add to the index', nargs='+', default=[])
+    parser.add_argument('-q','--query', help='Folder whose images are looked up in the index', required=False, type=str, default=None)
+    parser.add_argument('-r','--recursive', help='Also scan the sub-folders', action='store_true')
+    parser.add_argument('-w','--workers', help='Number of hashing processes (default: 1)', required=False, type=int, default=1)
+    parser.add_argument('--no-cache', help='Do not use the hash caches of the folders', action='store_true')
+    parser.add_argument('--compact', help='Merge all the segments of the index into one', action='store_true')
+    instrument.add_arguments(parser)
+
+
+def parse_arguments():
+    """
+    Parse command line arguments.
+
+    # Returns
+        Dictionnary containing the command line arguments
+    """
+
+    parser = argparse.ArgumentParser(description='Persistent index of identical images across folders')
+    add_arguments(parser)
+    args = vars(parser.parse_args())
+
+    return args
+
+
+def main(args=None):
+    """
+    Main function
+
+    # Arguments
+        args: Dictionnary of command line arguments (default: parsed from sys.argv)
+    """
+
+    if args is None:
+        args = parse_arguments()
+
+    for folder in args['add'] + ([args['query']] if args['query'] else []):
+        if not Path(folder).is_dir():
+            print(f'"{folder}" does not exist or is a file!')
+            sys.exit(1)
+    if not args['add'] and args['query'] is None and not args['compact']:
+        print('Please choose --add, --query or --compact')
+        sys.exit(1)
+
+    with instrument.profile(args):
+        index = DuplicateIndex(args['index'])
+        if args['query'] is not None:
+            duplicates = query_folder(index, args['query'], args['recursive'], args['workers'], not args['no_cache'])
+            for rel, paths in duplicates.items():
+                print(f'{rel}: {", ".join(paths)}')
+            print(f'{len(duplicates)} images of {args["query"]} already exist in the index')
+        if args['add']:
+            add_folders(index, args['add'], args['recursive'], args['workers'], not args['no_cache'])
+        if args['compact']:
+            index.compact()
+        print(f'{len(index)} images in {len(index.manifest["segments"])} segments')
+
+    print('Done!')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,359 @@
+# Copyright 2018 Mikaël Swawola. All Rights Reserved.
+#
+# GNU GENERAL PUBLIC LICENSE
+# Version 3, 29 June 2007
+# ==============================================================================
+
+import os
+import json
+import time
+import threading
+from functools import wraps, partial
+from contextlib import contextmanager
+
+# Instrumentation switch, set by enable(): when False, stage() returns a
+# shared no-op context manager and the timed functions are called directly
+ENABLED = False
+
+# Time spent in each stage: name -> [seconds, calls]
+STAGES = {}
+
+# Counters: name -> value
+COUNTERS = {}
+
+# Chrome trace events, or None when no trace is recorded
+EVENTS = None
+
+LOCK = threading.Lock()
+
+
+class NullStage():
+    """
+    Context manager doing nothing, returned by stage() when disabled
+    """
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NULL_STAGE = NullStage()
+
+
+class Stage():
+    """
+    Context manager timing one execution of a stage
+    """
+
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+
+        self.name = name
+
+    def __enter__(self):
+
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+
+        record(self.name, self.start, time.perf_counter())
+        return False
+
+
+def record(name, start, end):
+    """
+    Account for one execution of a stage, from start to end (time.perf_counter)
+    """
+
+    with LOCK:
+        entry = STAGES.get(name)
+        if entry is None:
+            entry = STAGES[name] = [0.0, 0]
+        entry[0] += end - start
+        entry[1] += 1
+        if EVENTS is not None:
+            EVENTS.append({'name': name, 'ph': 'X', 'ts': start * 1e6, 'dur': (end - start) * 1e6,
+                           'pid': os.getpid(), 'tid': threading.get_ident()})
+
+
+def stage(name):
+    """
+    Time a block of code:
+
+        with instrument.stage('decode'):
+            ...
+
+    # Returns
+        A Stage, or NULL_STAGE when the instrumentation is disabled
+    """
+
+    return Stage(name) if ENABLED else NULL_STAGE
+
+
+def count(name, n=1):
+    """
+    Add n to a counter (nothing when the instrumentation is disabled)
+    """
+
+    if ENABLED:
+        with LOCK:
+            COUNTERS[name] = COUNTERS.get(name, 0) + n
+
+
+def timed(name):
+    """
+    Decorator timing each call of a function as a stage
+    """
+
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not ENABLED:
+                return func(*args, **kwargs)
+            with Stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+
+    return decorator
+
+
+def timed_iter(name, iterable):
+    """
+    Time the production of the items of an iterable (e.g. a directory
+    listing consumed lazily), excluding the time spent by the consumer
+
+    # Returns
+        The iterable itself when the instrumentation is disabled
+    """
+
+    if not ENABLED:
+        return iterable
+
+    return timed_items(name, iter(iterable))
+
+
+def timed_items(name, iterator):
+    """
+    Generator of timed_iter
+    """
+
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            record(name, start, time.perf_counter())
+            return
+        record(name, start, time.perf_counter())
+        yield item
+
+
+def enable(trace=False):
+    """
+    Enable the instrumentation and clear the recorded stages
+
+    # Arguments
+        trace: Also record every stage execution for write_trace
+    """
+
+    global ENABLED, EVENTS
+
+    reset()
+    EVENTS = [] if trace else None
+    ENABLED = True
+
+
+def disable():
+    """
+    Disable the instrumentation (the recorded stages are kept)
+    """
+
+    global ENABLED
+
+    ENABLED = False
+
+
+def reset():
+    """
+    Clear the recorded stages, counters and events
+    """
+
+    with LOCK:
+        STAGES.clear()
+        COUNTERS.clear()
+        if EVENTS is not None:
+            del EVENTS[:]
+
+
+def snapshot():
+    """
+    Picklable copy of the recorded stages, counters and events
+    """
+
+    with LOCK:
+        return ({k: list(v) for (k, v) in STAGES.items()}, dict(COUNTERS),
+                list(EVENTS) if EVENTS is not None else None)
+
+
+def merge(snap):
+    """
+    Add the stages, counters and events of a snapshot (e.g. from a worker process)
+    """
+
+    stages, counters, events = snap
+    with LOCK:
+        for name, (seconds, calls) in stages.items():
+            entry = STAGES.setdefault(name, [0.0, 0])
+            entry[0] += seconds
+            entry[1] += calls
+        for name, n in counters.items():
+            COUNTERS[name] = COUNTERS.get(name, 0) + n
+        if EVENTS is not None and events:
+            EVENTS.extend(events)
+
+
+def collect(trace, func, *args):
+    """
+    Call func with the instrumentation enabled (process pool worker)
+
+    # Arguments
+        trace: Record the events for the trace
+        func: Function to call with args
+
+    # Returns
+        The (result, snapshot) tuple, see merge()
+    """
+
+    enable(trace)
+    try:
+        result = func(*args)
+        return result, snapshot()
+    finally:
+        disable()
+        reset()
+
+
+def worker_task(func):
+    """
+    Wrap a process pool task so that the workers record their stages
+
+    # Returns
+        func itself when the instrumentation is disabled, or a task
+        returning (result, snapshot) whose snapshot must be merged
+    """
+
+    if not ENABLED:
+        return func
+
+    return partial(collect, EVENTS is not None, func)
+
+
+def unwrap(result, profiled):
+    """
+    Result of a task made by worker_task, merging the stages of the worker
+
+    # Arguments
+        result: Value returned by the task
+        profiled: Whether the task was wrapped (instrumentation enabled when it was made)
+    """
+
+    if not profiled:
+        return result
+
+    result, snap = result
+    merge(snap)
+
+    return result
+
+
+def summary(wall=None):
+    """
+    Format the stage breakdown and the counters
+
+    The stages of the worker processes and threads are summed over the
+    workers, so their total can exceed the wall time.
+
+    # Arguments
+        wall: Wall time of the run, in seconds, for the percentages
+    """
+
+    with LOCK:
+        stages = sorted(STAGES.items(), key=lambda x: -x[1][0])
+        counters = sorted(COUNTERS.items())
+
+    lines = [f'{"stage":32s} {"total (s)":>10s} {"calls":>9s} {"mean (ms)":>10s}' + ('  % wall' if wall else '')]
+    for name, (seconds, calls) in stages:
+        line = f'{name:32s} {seconds:10.3f} {calls:9d} {seconds / calls * 1000:10.3f}'
+        if wall:
+            line += f'  {seconds / wall:6.1%}'
+        lines.append(line)
+    for name, n in counters:
+        lines.append(f'{name:32s} {n:>10}')
+    if wall:
+        lines.append(f'{"wall time":32s} {wall:10.3f}')
+
+    return '\n'.join(lines)
+
+
+def write_trace(path):
+    """
+    Write the recorded events as a Chrome trace (chrome://tracing, Perfetto)
+    """
+
+    with LOCK:
+        events = list(EVENTS or [])
+    with open(path, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+
+def add_arguments(parser):
+    """
+    Add the profiling command line arguments to a parser
+    """
+
+    parser.add_argument('--profile', help='Print the time spent in each stage', action='store_true')
+    parser.add_argument('--cprofile', help='Also write cProfile statistics of the main process to this file (pstats format)', required=False, type=str, default=None)
+    parser.add_argument('--trace', help='Also write every stage execution to this Chrome trace JSON file', required=False, type=str, default=None)
+
+
+@contextmanager
+def profile(args):
+    """
+    Instrument a run of a tool according to its command line arguments
+    (see add_arguments), and print the stage breakdown at the end
+
+    # Arguments
+        args: Dictionnary of command line arguments
+    """
+
+    if not (args.get('profile') or args.get('cprofile') or args.get('trace')):
+        yield
+        return
+
+    enable(trace=args.get('trace') is not None)
+    profiler = None
+    if args.get('cprofile'):
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        wall = time.perf_counter() - start
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(args['cprofile'])
+        disable()
+        print(summary(wall))
+        if profiler is not None:
+            print(f'cProfile statistics written to {args["cprofile"]} (python -m pstats {args["cprofile"]})')
+        if args.get('trace'):
+            write_trace(args['trace'])
+            print(f'Trace written to {args["trace"]}')
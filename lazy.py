@@ -0,0 +1,37 @@
+# Copyright 2018 Mikaël Swawola. All Rights Reserved.
+#
+# GNU GENERAL PUBLIC LICENSE
+# Version 3, 29 June 2007
+# ==============================================================================
+
+import sys
+import importlib.util
+
+
+def lazy_import(name):
+    """
+    Import a module on first use
+
+    The tools bind NumPy and PIL at the top of their modules with this
+    function, so that the command line (--help, argument errors) starts
+    without them: the module is only executed when one of its attributes
+    is first accessed.
+
+    # Arguments
+        name: Full name of the module (e.g. 'PIL.Image')
+
+    # Returns
+        The module, or the module already imported under that name
+    """
+
+    if name in sys.modules:
+        return sys.modules[name]
+
+    spec = importlib.util.find_spec(name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+
+    return module
@@ -0,0 +1,127 @@
+# Copyright 2018 Mikaël Swawola. All Rights Reserved.
+#
+# GNU GENERAL PUBLIC LICENSE
+# Version 3, 29 June 2007
+# ==============================================================================
+
+from lazy import lazy_import
+
+np = lazy_import('numpy')
+Image = lazy_import('PIL.Image')
+
+# Side of the patches compared by phase correlation, in pixels
+PATCH_SIZE = 64
+
+# Margin added around a box to search for its motion, as a fraction of the box size
+SEARCH_MARGIN = 0.5
+
+# Minimum margin around a box, in displayed pixels
+MIN_MARGIN = 16
+
+
+def grayscale(img):
+    """
+    Convert a decoded PIL image to a float32 grayscale array
+    """
+
+    return np.asarray(img.convert('L'), dtype=np.float32)
+
+
+def phase_correlation(a, b):
+    """
+    Estimate the translation between two patches of the same size
+
+    The normalized cross-power spectrum of the patches (with a Hann
+    window against border effects) has a peak at their relative shift,
+    refined to sub-pixel precision with a parabola fit on each axis.
+
+    # Arguments
+        a, b: 2-D float arrays
+
+    # Returns
+        The (dy, dx) shift such that b(y, x) ~ a(y - dy, x - dx), and the
+        peak height (close to 1 for a clean match, close to 0 without one)
+    """
+
+    h, w = a.shape
+    window = np.outer(np.hanning(h), np.hanning(w)).astype(np.float32)
+    fa = np.fft.rfft2((a - a.mean()) * window)
+    fb = np.fft.rfft2((b - b.mean()) * window)
+    cross = fb * np.conj(fa)
+    cross /= np.abs(cross) + 1e-9
+    r = np.fft.irfft2(cross, s=(h, w))
+
+    py, px = np.unravel_index(np.argmax(r), r.shape)
+    shift = []
+    for (p, n, axis) in ((py, h, 0), (px, w, 1)):
+        before = r[(p - 1) % n, px] if axis == 0 else r[py, (p - 1) % n]
+        after = r[(p + 1) % n, px] if axis == 0 else r[py, (p + 1) % n]
+        denom = before - 2 * r[py, px] + after
+        offset = 0.5 * (before - after) / denom if denom < 0 else 0.0
+        s = p + offset
+        shift.append(s - n if s > n / 2 else s)
+
+    return tuple(shift), float(r[py, px])
+
+
+def propose_boxes(prev, prev_ratio, cur, cur_ratio, boxes, min_peak=0.05):
+    """
+    Propose the boxes of an image from the boxes of the previous image
+
+    Each box is moved by the translation of its neighbourhood between the
+    two decoded (downscaled) images, estimated by phase correlation on a
+    PATCH_SIZE x PATCH_SIZE patch. A box whose neighbourhood has no clear
+    match is kept in place.
+
+    # Arguments
+        prev, cur: Decoded previous and current images (PIL images, see session.decode_image)
+        prev_ratio, cur_ratio: Ratios between the original and decoded sizes
+        boxes: Boxes of the previous image, (x1, y1, x2, y2, label) in original coordinates
+        min_peak: Minimum phase correlation peak to accept a translation
+
+    # Returns
+        The list of proposed (x1, y1, x2, y2, label) boxes, in original coordinates
+    """
+
+    if not boxes:
+        return []
+
+    width, height = cur.size
+    full_width, full_height = width * cur_ratio, height * cur_ratio
+    a = grayscale(prev)
+    if prev.size != cur.size:
+        a = grayscale(prev.resize(cur.size, Image.BILINEAR))
+    b = grayscale(cur)
+
+    # Scale of the boxes if the original images have different sizes
+    fx, fy = full_width / (prev.width * prev_ratio), full_height / (prev.height * prev_ratio)
+
+    proposals = []
+    for (x1, y1, x2, y2, label) in boxes:
+        x1, x2, y1, y2 = x1 * fx, x2 * fx, y1 * fy, y2 * fy
+        # Box in displayed coordinates of the current image
+        bx1, by1, bx2, by2 = (c / cur_ratio for c in (x1, y1, x2, y2))
+        margin = max(MIN_MARGIN, SEARCH_MARGIN * max(bx2 - bx1, by2 - by1))
+        left, top = int(max(0, bx1 - margin)), int(max(0, by1 - margin))
+        right, bottom = int(min(width, bx2 + margin)), int(min(height, by2 + margin))
+
+        dx = dy = 0.0
+        if right - left >= MIN_MARGIN and bottom - top >= MIN_MARGIN:
+            pa, pb = a[top:bottom, left:right], b[top:bottom, left:right]
+            scale = max(right - left, bottom - top) / PATCH_SIZE
+            if scale > 1:
+                size = (max(1, round((right - left) / scale)), max(1, round((bottom - top) / scale)))
+                pa = np.asarray(Image.fromarray(pa).resize(size, Image.BILINEAR))
+                pb = np.asarray(Image.fromarray(pb).resize(size, Image.BILINEAR))
+            else:
+                scale = 1
+            (sy, sx), peak = phase_correlation(pa, pb)
+            if peak >= min_peak:
+                dx, dy = sx * scale * cur_ratio, sy * scale * cur_ratio
+
+        nx1, nx2 = min(max(x1 + dx, 0), full_width), min(max(x2 + dx, 0), full_width)
+        ny1, ny2 = min(max(y1 + dy, 0), full_height), min(max(y2 + dy, 0), full_height)
+        if nx2 - nx1 >= 1 and ny2 - ny1 >= 1:
+            proposals.append((int(round(nx1)), int(round(ny1)), int(round(nx2)), int(round(ny2)), label))
+
+    return proposals
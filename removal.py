@@ -0,0 +1,265 @@
+# Copyright 2018 Mikaël Swawola. All Rights Reserved.
+#
+# GNU GENERAL PUBLIC LICENSE
+# Version 3, 29 June 2007
+# ==============================================================================
+
+import os
+import json
+import time
+import shutil
+from pathlib import Path
+from collections import deque
+
+import instrument
+
+# Policies choosing the image kept in each set of duplicates: name -> sort key
+# of the (path, size, mtime_ns) of the images, the first one is kept. Ties
+# are broken by path, so the choice does not depend on the listing order.
+KEEP_POLICIES = {
+    'oldest': lambda info: (info[2], len(info[0]), info[0]),
+    'shortest': lambda info: (len(info[0]), info[0]),
+    'largest': lambda info: (-info[1], info[2], info[0]),
+}
+
+# Default name of the removal plan, in the images folder
+PLAN_FILE = '.duplicate_find.plan.jsonl'
+
+# Extension of the journal of an executed plan, next to the plan
+JOURNAL_EXT = '.done'
+
+# Number of files removed by each task
+BATCH_SIZE = 256
+
+# Number of removed files between two progress reports
+PROGRESS_EVERY = 10000
+
+
+def file_info(folder, rel):
+    """
+    Read the size and modification time of a file
+
+    # Arguments
+        folder: Images folder
+        rel: Path of the file relative to folder
+
+    # Returns
+        The (rel, size, mtime_ns) tuple, or None if the file does not exist
+    """
+
+    try:
+        st = os.stat(os.path.join(folder, rel))
+    except FileNotFoundError:
+        return None
+
+    return (rel, st.st_size, st.st_mtime_ns)
+
+
+def plan_removals(groups, folder, policy='oldest', jobs=1):
+    """
+    Choose the image kept in each set of duplicates
+
+    # Arguments
+        groups: Iterable of sets of paths relative to folder (see find_identical_images)
+        folder: Images folder
+        policy: One of KEEP_POLICIES
+        jobs: Number of concurrent stat calls
+
+    # Returns
+        The list of (kept, removed) tuples, where kept is the (path, size,
+        mtime_ns) of the kept image and removed the sorted list of those of
+        the other images, sorted by kept path
+    """
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    groups = [sorted(g) for g in groups]
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        infos = dict(zip((rel for g in groups for rel in g),
+                         executor.map(lambda rel: file_info(folder, rel), (rel for g in groups for rel in g))))
+
+    key = KEEP_POLICIES[policy]
+    plan = []
+    for group in groups:
+        existing = sorted((infos[rel] for rel in group if infos[rel] is not None), key=key)
+        if len(existing) > 1:
+            plan.append((existing[0], sorted(existing[1:])))
+
+    return sorted(plan)
+
+
+def write_plan(path, folder, policy, plan):
+    """
+    Atomically write a removal plan: a JSON header line, then one line
+    per set of duplicates: {"keep": [path, size, mtime_ns], "remove": [[path, size, mtime_ns], ...]}
+    """
+
+    path = Path(path)
+    tmp = path.with_name(path.name + '.tmp')
+    with tmp.open('w') as f:
+        f.write(json.dumps({'folder': os.path.abspath(folder), 'policy': policy,
+                            'sets': len(plan), 'files': sum(len(r) for (_, r) in plan)}) + '\n')
+        for kept, removed in plan:
+            f.write(json.dumps({'keep': list(kept), 'remove': [list(r) for r in removed]}) + '\n')
+    os.replace(tmp, path)
+    if os.path.exists(str(path) + JOURNAL_EXT):
+        os.unlink(str(path) + JOURNAL_EXT) # The journal of a previous plan
+
+
+def read_plan(path):
+    """
+    Read a removal plan written by write_plan
+
+    # Returns
+        The header dictionnary, and the list of (kept, removed) tuples
+    """
+
+    with open(path) as f:
+        header = json.loads(f.readline())
+        plan = []
+        for line in f:
+            entry = json.loads(line)
+            plan.append((tuple(entry['keep']), [tuple(r) for r in entry['remove']]))
+
+    return header, plan
+
+
+def read_journal(path):
+    """
+    Paths already handled by a previous execution of a plan
+
+    # Returns
+        A set of relative paths
+    """
+
+    try:
+        with open(path) as f:
+            return set(json.loads(line)[0] for line in f if line.endswith('\n'))
+    except FileNotFoundError:
+        return set()
+
+
+def remove_file(folder, kept, info, quarantine=None):
+    """
+    Delete a duplicate, or move it to the quarantine folder
+
+    Nothing is done if the duplicate or the kept image is missing or was
+    modified since the plan was made.
+
+    # Arguments
+        folder: Images folder
+        kept, info: (path, size, mtime_ns) of the kept image and of the duplicate
+        quarantine: Quarantine folder (the relative path is kept), or None to delete
+
+    # Returns
+        The status: 'removed', 'quarantined', 'missing' or 'changed'
+
+    # Raises
+        OSError if the file could not be removed
+    """
+
+    rel = info[0]
+    current = file_info(folder, rel)
+    if current is None:
+        if quarantine is not None and os.path.exists(os.path.join(quarantine, rel)):
+            return 'quarantined' # Moved by an interrupted execution
+        return 'missing'
+    if current != tuple(info) or file_info(folder, kept[0]) != tuple(kept):
+        return 'changed'
+
+    src = os.path.join(folder, rel)
+    if quarantine is None:
+        os.unlink(src)
+        return 'removed'
+
+    dst = os.path.join(quarantine, rel)
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    try:
+        os.replace(src, dst)
+    except OSError:
+        shutil.move(src, dst) # Across filesystems
+
+    return 'quarantined'
+
+
+@instrument.timed('remove batch')
+def remove_batch(folder, batch, quarantine=None):
+    """
+    Remove a batch of duplicates (thread pool task)
+
+    # Arguments
+        folder: Images folder
+        batch: List of (kept, duplicate) tuples of (path, size, mtime_ns)
+        quarantine: Quarantine folder, or None to delete
+
+    # Returns
+        The list of (path, status, error message or None)
+    """
+
+    results = []
+    for kept, info in batch:
+        try:
+            results.append((info[0], remove_file(folder, kept, info, quarantine), None))
+        except OSError as e:
+            results.append((info[0], 'failed', str(e)))
+
+    return results
+
+
+def execute_plan(path, folder, quarantine=None, jobs=1, batch_size=BATCH_SIZE):
+    """
+    Execute a removal plan with a pool of threads, by batches
+
+    The result of each batch is appended to the journal of the plan once
+    the batch is done, in the order of the plan. Executing the plan again
+    skips the files in the journal, so an interrupted execution resumes
+    where it stopped. Failed files are not journaled and are retried.
+
+    # Arguments
+        path: Plan file (see write_plan)
+        folder: Images folder
+        quarantine: Quarantine folder, or None to delete the duplicates
+        jobs: Number of concurrent batches
+        batch_size: Number of files per batch
+
+    # Returns
+        The dictionnary counting the files of each status, and the list of (path, error) failures
+    """
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    header, plan = read_plan(path)
+    journal = str(path) + JOURNAL_EXT
+    done = read_journal(journal)
+    todo = [(kept, info) for (kept, removed) in plan for info in removed if info[0] not in done]
+    batches = [todo[i:i + batch_size] for i in range(0, len(todo), batch_size)]
+
+    counts = {'skipped': len(done)} if done else {}
+    failures = []
+    start = time.perf_counter()
+
+    def record(results):
+        # Journal and count the results of a batch
+        handled = sum(counts.values()) - counts.get('skipped', 0)
+        for rel, status, error in results:
+            counts[status] = counts.get(status, 0) + 1
+            if status == 'failed':
+                failures.append((rel, error))
+            else:
+                log.write(json.dumps([rel, status]) + '\n')
+        log.flush()
+        os.fsync(log.fileno())
+        if (handled + len(results)) // PROGRESS_EVERY > handled // PROGRESS_EVERY:
+            elapsed = time.perf_counter() - start
+            print(f'{handled + len(results)} files handled ({(handled + len(results)) / elapsed:.0f} files/sec)')
+
+    with open(journal, 'a') as log, ThreadPoolExecutor(max_workers=jobs) as executor:
+        pending = deque()
+        for batch in batches:
+            pending.append(executor.submit(remove_batch, folder, batch, quarantine))
+            if len(pending) >= 2 * jobs:
+                record(pending.popleft().result())
+        while pending:
+            record(pending.popleft().result())
+
+    return counts, failures
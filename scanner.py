@@ -0,0 +1,91 @@
+# Copyright 2018 Mikaël Swawola. All Rights Reserved.
+#
+# GNU GENERAL PUBLIC LICENSE
+# Version 3, 29 June 2007
+# ==============================================================================
+
+import os
+
+# Supported image extensions (lower case, matched case-insensitively)
+IMAGE_EXTENSIONS = frozenset(['.jpeg', '.jpg', '.png'])
+
+
+def has_extension(name, extensions):
+    """
+    Check if a file name has one of the extensions, ignoring case
+
+    # Arguments
+        name: File name
+        extensions: Set of lower case extensions, or None to accept any file
+    """
+
+    if extensions is None:
+        return True
+
+    return os.path.splitext(name)[1].lower() in extensions
+
+
+def scan(folder, extensions=IMAGE_EXTENSIONS, recursive=False):
+    """
+    Lazily list the files of a folder
+
+    Built on os.scandir: entries are yielded as soon as they are read, the
+    file type comes from the directory listing and stat() results are
+    cached on the entries.
+
+    # Arguments
+        folder: Folder to scan
+        extensions: Set of lower case extensions, or None to accept any file
+        recursive: Also scan the sub-folders (symbolic links to folders are not followed)
+
+    # Returns
+        A generator of os.DirEntry
+    """
+
+    stack = [os.fspath(folder)]
+    while stack:
+        subfolders = []
+        with os.scandir(stack.pop()) as it:
+            for entry in it:
+                if recursive and entry.is_dir(follow_symlinks=False):
+                    subfolders.append(entry.path)
+                elif entry.is_file() and has_extension(entry.name, extensions):
+                    yield entry
+        stack.extend(reversed(subfolders))
+
+
+def scan_dirs(folder):
+    """
+    Lazily list the sub-folders of a folder
+
+    # Arguments
+        folder: Folder to scan
+
+    # Returns
+        A generator of os.DirEntry
+    """
+
+    with os.scandir(os.fspath(folder)) as it:
+        for entry in it:
+            if entry.is_dir():
+                yield entry
+
+
+def relative_path(entry, folder):
+    """
+    Path of a scanned entry relative to the scanned folder
+
+    # Arguments
+        entry: os.DirEntry or path yielded by scan(folder)
+        folder: The scanned folder
+
+    # Returns
+        The relative path, as a string
+    """
+
+    path = os.fspath(entry)
+    prefix = os.path.join(os.fspath(folder), '')
+    if path.startswith(prefix):
+        return path[len(prefix):]
+
+    return os.path.relpath(path, folder)
@@ -0,0 +1,446 @@
+# Copyright 2018 Mikaël Swawola. All Rights Reserved.
+#
+# GNU GENERAL PUBLIC LICENSE
+# Version 3, 29 June 2007
+# ==============================================================================
+
+import threading
+from pathlib import Path
+from collections import OrderedDict
+
+from scanner import scan
+import instrument
+from annotations import WriteBehind
+from prelabel import propose_boxes
+from lazy import lazy_import
+
+Image = lazy_import('PIL.Image')
+
+# Folder of the annotation stores, one per images folder
+LABELS_DIR = Path('Labels')
+
+# Maximum size for width or height of the image when it fits the panel (zoom level 0)
+MAX_SIZE = 512
+
+# Number of images decoded in advance on each side of the current image
+PREFETCH_DEPTH = 3
+
+# Memory budget of the decoded images cache, in MB
+CACHE_MB = 256
+
+
+@instrument.timed('decode')
+def decode_image(path):
+    """
+    Decode an image and downscale it to fit in MAX_SIZE x MAX_SIZE
+
+    JPEG images are decoded directly at a reduced scale (Image.draft).
+
+    # Arguments
+        path: Path of the image
+
+    # Returns
+        The downscaled image, and the ratio between the original and displayed sizes
+    """
+
+    img = Image.open(path)
+    width, height = img.size
+    ratio = max(width, height) / MAX_SIZE
+
+    if ratio > 1:
+        size = (int(width / ratio), int(height / ratio))
+        img.draft('RGB', size)
+        img.thumbnail(size)
+    else:
+        ratio = 1.0
+        img.load()
+
+    return img, ratio
+
+
+class ImageCache():
+    """
+    LRU cache of decoded images, filled by a background thread
+
+    The thread decodes the images requested with prefetch(); get() returns
+    the cached image, or decodes it on the spot. An image is decoded by a
+    single thread at a time: get() waits for an image being decoded by
+    another thread, and the background thread skips the images decoded
+    by get(). The cache is bounded to budget_mb of decoded pixels.
+    """
+
+    def __init__(self, budget_mb=CACHE_MB):
+
+        self.budget = budget_mb * 1024 * 1024
+        self.images = OrderedDict()
+        self.size = 0
+        self.wanted = []
+        self.loading = set()
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def insert(self, path, entry):
+        """
+        Add a decoded image and evict the least recently used ones (lock held)
+        """
+
+        img = entry[0]
+        old = self.images.pop(path, None)
+        if old is not None:
+            self.size -= old[0].width * old[0].height * len(old[0].getbands())
+        self.images[path] = entry
+        self.size += img.width * img.height * len(img.getbands())
+        while self.size > self.budget and len(self.images) > 1:
+            _, (old, _) = self.images.popitem(last=False)
+            self.size -= old.width * old.height * len(old.getbands())
+
+    def get(self, path):
+        """
+        Return the decoded image and its ratio (see decode_image)
+        """
+
+        with self.cond:
+            while path in self.loading:
+                self.cond.wait()
+            if path in self.images:
+                self.images.move_to_end(path)
+                return self.images[path]
+            self.loading.add(path)
+
+        entry = None
+        try:
+            entry = decode_image(path)
+        finally:
+            with self.cond:
+                if entry is not None:
+                    self.insert(path, entry)
+                self.loading.discard(path)
+                self.cond.notify_all()
+        return entry
+
+    def prefetch(self, paths):
+        """
+        Replace the list of images to decode in the background
+        """
+
+        with self.cond:
+            self.wanted = [p for p in paths if p not in self.images]
+            self.cond.notify_all()
+
+    def run(self):
+        """
+        Background thread: decode the wanted images
+        """
+
+        while True:
+            with self.cond:
+                while not self.wanted:
+                    self.cond.wait()
+                path = self.wanted.pop(0)
+                if path in self.images or path in self.loading:
+                    continue
+                self.loading.add(path)
+
+            try:
+                entry = decode_image(path)
+            except Exception:
+                entry = None # Unreadable image, reported when displayed
+
+            with self.cond:
+                if entry is not None:
+                    self.insert(path, entry)
+                self.loading.discard(path)
+                self.cond.notify_all()
+
+
+class LatencyCounter():
+    """
+    Count events and accumulate their handling time
+    """
+
+    def __init__(self, name):
+
+        self.name = name
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        """
+        Record the handling time of one event
+        """
+
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def summary(self):
+        """
+        Return a one-line report of the latencies
+        """
+
+        mean = self.total / self.count if self.count else 0.0
+        return f'{self.name}: {self.count} events, mean {mean * 1000:.3f} ms, max {self.max * 1000:.3f} ms'
+
+
+class LabelingSession():
+    """
+    State and logic of a labeling session, independent of any user interface
+
+    The session holds the images of a folder, the current image (1-based
+    index current_img) and its boxes in original image coordinates
+    (bboxList). Moving to another image saves the boxes of the current one
+    (only if they changed, see save()) and loads the boxes of the new one
+    from the annotation store. Images are decoded and downscaled to fit
+    MAX_SIZE x MAX_SIZE by a background cache; ratio is the scale between
+    the original image and the decoded one.
+
+    With prelabel, an unlabeled image reached from the previous or next
+    image gets the boxes of that image, moved by the local motion between
+    the two images (see prelabel.propose_boxes), as proposals. They are
+    kept apart from bboxList and never saved until they are accepted
+    (accept_proposals), or reviewed by deleting one of them. The proposals
+    for the next image are computed in a background thread while the
+    current one is being labeled.
+    """
+
+    def __init__(self, store='text', cache_mb=CACHE_MB, labels=LABELS_DIR, prelabel=False):
+
+        self.store_kind = store
+        self.labels = Path(labels)
+        self.image_cache = ImageCache(cache_mb)
+        self.store = None
+        self.directory = None
+        self.image_list = []
+        self.current_img = 1
+        self.imagename = ''
+        self.image = None
+        self.ratio = 1.0
+        self.bboxList = []
+        self.saved_boxes = []
+        self.prelabel = prelabel
+        self.proposals = []
+        self.proposal = None
+        self.executor = None
+
+    @instrument.timed('open directory')
+    def open_directory(self, path):
+        """
+        Open an images folder and load its first image
+
+        The labels of the previous folder are written out first.
+
+        # Returns
+            The number of images of the folder (nothing is changed if there are none)
+        """
+
+        # Sorted by name, so that the frames of a sequence follow each other
+        image_list = sorted(Path(x.path) for x in scan(path))
+        if len(image_list) == 0:
+            return 0
+
+        self.close()
+        self.directory = Path(path)
+        self.image_list = image_list
+        self.store = WriteBehind(self.store_kind, self.labels/self.directory.name)
+        self.current_img = 1
+        self.load()
+        self.schedule_proposals()
+
+        return len(self.image_list)
+
+    def imagepath(self):
+        """
+        Path of the current image
+        """
+
+        return self.image_list[self.current_img - 1]
+
+    @instrument.timed('load')
+    def load(self):
+        """
+        Decode the current image and load its boxes
+
+        # Returns
+            The decoded image (see decode_image)
+        """
+
+        imagepath = self.imagepath()
+        self.image, self.ratio = self.image_cache.get(imagepath)
+
+        # Decode the neighbour images in the background
+        neighbours = []
+        for d in range(1, PREFETCH_DEPTH + 1):
+            for idx in (self.current_img - 1 + d, self.current_img - 1 - d):
+                if 0 <= idx < len(self.image_list):
+                    neighbours.append(self.image_list[idx])
+        self.image_cache.prefetch(neighbours)
+
+        self.imagename = imagepath.stem
+        self.saved_boxes = self.store.get(self.imagename)
+        self.bboxList = list(self.saved_boxes)
+        self.proposals = []
+
+        return self.image
+
+    @instrument.timed('save')
+    def save(self):
+        """
+        Save the boxes of the current image
+
+        Nothing is written if the boxes are unchanged since the image was
+        loaded. Otherwise they are queued and written in the background.
+        The proposals which were not accepted are not saved.
+
+        # Returns
+            True if the boxes were queued for writing
+        """
+
+        if self.store is None or self.bboxList == self.saved_boxes:
+            return False
+
+        self.store.put(self.imagename, self.bboxList)
+        self.saved_boxes = list(self.bboxList)
+        return True
+
+    def goto(self, idx):
+        """
+        Save the current image and move to image idx (1-based)
+
+        # Returns
+            True if the current image changed
+        """
+
+        self.save()
+        if not 1 <= idx <= len(self.image_list) or idx == self.current_img:
+            return False
+
+        source = (self.current_img, self.image, self.ratio, self.bboxList + self.proposals)
+        self.current_img = idx
+        self.load()
+
+        if self.prelabel and not self.bboxList and source[3] and abs(idx - source[0]) == 1:
+            try:
+                if self.proposal is not None and self.proposal[0] == (source[0], tuple(source[3])) and idx == source[0] + 1:
+                    self.proposals = self.proposal[1].result()
+                else:
+                    self.proposals = propose_boxes(source[1], source[2], self.image, self.ratio, source[3])
+            except Exception as e:
+                print(f'No proposals for {self.imagename}: {e!r}')
+                self.proposals = []
+        self.schedule_proposals()
+
+        return True
+
+    def next(self):
+        return self.goto(self.current_img + 1)
+
+    def prev(self):
+        return self.goto(self.current_img - 1)
+
+    def schedule_proposals(self):
+        """
+        Start computing the proposals for the next image from the current boxes
+        """
+
+        boxes = self.bboxList + self.proposals
+        if not self.prelabel or not boxes or self.current_img >= len(self.image_list):
+            return
+
+        key = (self.current_img, tuple(boxes))
+        if self.proposal is not None:
+            if self.proposal[0] == key:
+                return
+            self.proposal[1].cancel()
+        if self.executor is None:
+            from concurrent.futures import ThreadPoolExecutor
+            self.executor = ThreadPoolExecutor(max_workers=1)
+
+        nextpath = self.image_list[self.current_img]
+        self.proposal = (key, self.executor.submit(self.propose, self.image, self.ratio, nextpath, boxes))
+
+    def propose(self, prev, prev_ratio, path, boxes):
+        """
+        Propose the boxes of an image from the boxes of the previous one (background thread)
+        """
+
+        img, ratio = self.image_cache.get(path)
+
+        return propose_boxes(prev, prev_ratio, img, ratio, boxes)
+
+    def add_box(self, x1, y1, x2, y2, label=None):
+        """
+        Add a box to the current image, in original image coordinates
+
+        # Returns
+            The (x1, y1, x2, y2, label) tuple, with x1 <= x2 and y1 <= y2
+        """
+
+        bbox = (int(min(x1, x2)), int(min(y1, y2)), int(max(x1, x2)), int(max(y1, y2)), label)
+        self.bboxList.append(bbox)
+        self.schedule_proposals()
+        return bbox
+
+    def accept_proposals(self):
+        """
+        Add the proposals to the boxes of the current image
+
+        # Returns
+            The number of accepted proposals
+        """
+
+        count = len(self.proposals)
+        self.bboxList.extend(self.proposals)
+        self.proposals = []
+        return count
+
+    def delete_box(self, idx):
+        """
+        Remove the box idx of the current image, the proposals following
+        the boxes; deleting a proposal accepts the other ones
+        """
+
+        if idx < len(self.bboxList):
+            bbox = self.bboxList.pop(idx)
+        else:
+            bbox = self.proposals.pop(idx - len(self.bboxList))
+            self.accept_proposals()
+        self.schedule_proposals()
+        return bbox
+
+    def clear_boxes(self):
+        """
+        Remove all the boxes and proposals of the current image
+        """
+
+        self.bboxList = []
+        self.proposals = []
+
+    def display_boxes(self, ratio=None):
+        """
+        Boxes then proposals of the current image in display coordinates
+
+        # Arguments
+            ratio: Scale between the original and the displayed image (default: the decoded image)
+        """
+
+        ratio = ratio or self.ratio
+        return [tuple(int(c / ratio) for c in bbox[:4]) for bbox in self.bboxList + self.proposals]
+
+    def close(self):
+        """
+        Write out the pending labels, stop the proposals thread and close
+        the annotation store
+        """
+
+        if self.proposal is not None:
+            self.proposal[1].cancel()
+            self.proposal = None
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+        if self.store is not None:
+            self.save()
+            self.store.close()
+            self.store = None
@@ -4,15 +4,50 @@
 # Version 3, 29 June 2007
 # ==============================================================================
 
+import os
 import sys
+import json
+import time
 import shutil
 import argparse
 from pathlib import Path
-from sklearn.model_selection import train_test_split
+from collections import deque
+from hashlib import blake2b
+from scanner import scan, scan_dirs
+import instrument
+
+try:
+    import fcntl
+except ImportError: # Not available on Windows
+    fcntl = None
 
 TRAIN = 'train'
 VALID = 'valid'
 
+# File transfer modes
+MODES = ['copy', 'hardlink', 'reflink', 'symlink']
+
+# Linux ioctl sharing the data blocks of two files (copy-on-write clone)
+FICLONE = 0x40049409
+
+# Number of attempts for each file before reporting it as failed
+RETRIES = 3
+
+# Number of transferred files between two progress reports
+PROGRESS_EVERY = 1000
+
+# Split strategies: global shuffle of each category, or hash of each file path
+STRATEGIES = ['shuffle', 'hash']
+
+# Manifest formats
+MANIFEST_FORMATS = ['csv', 'jsonl']
+
+# Name of the file listing the categories of the manifests, by class index
+CLASSES_FILE = 'classes.txt'
+
+# Name of the file recording the last split, in the destination folder
+STATE_FILE = '.split_state.json'
+
 def get_categories(SRC_PATH):
     """
     Get all category paths in the SRC_PATH folder
@@ -24,8 +59,7 @@ def get_categories(SRC_PATH):
         List of category paths contained in the source folder
     """
     
-    cats = list(SRC_PATH.iterdir())
-    cats = [c for c in cats if c.is_dir()] # Keep only directories
+    cats = [Path(c.path) for c in scan_dirs(SRC_PATH)] # Keep only directories
     
     if len(cats) == 0:
         print(f'{SRC_PATH} is empty!')
@@ -34,13 +68,248 @@ def get_categories(SRC_PATH):
     return cats
 
 
-def copy_and_split(SRC_PATH, DST_TRAIN, DST_VALID, ratio=0.20, seed=None):
+def reflink(src, dst):
     """
-    Perform data splitting.
+    Clone src into the new file dst, sharing its data blocks (Btrfs, XFS...)
     
     # Arguments
+        src: Source file
+        dst: Destination file (must not exist)
+    """
+    
+    if fcntl is None:
+        raise OSError('reflinks are not supported on this platform')
+
+    with open(src, 'rb') as fsrc, open(dst, 'xb') as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        except OSError:
+            fdst.close()
+            os.unlink(dst)
+            raise
+
+
+def copy_file(src, dst):
+    """
+    Copy a file in the kernel when possible
+    
+    Uses os.copy_file_range (server-side copy on NFS, block sharing on
+    some filesystems), then os.sendfile, then a plain buffered copy,
+    starting each fallback where the previous method stopped.
+    
+    # Arguments
+        src: Source file
+        dst: Destination file
+    """
+    
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        size = os.fstat(fsrc.fileno()).st_size
+        copied = 0
+        for method in ('copy_file_range', 'sendfile'):
+            try:
+                while copied < size:
+                    if method == 'copy_file_range':
+                        n = os.copy_file_range(fsrc.fileno(), fdst.fileno(), size - copied)
+                    else:
+                        n = os.sendfile(fdst.fileno(), fsrc.fileno(), copied, size - copied)
+                    if n == 0:
+                        break
+                    copied += n
+                break
+            except (AttributeError, OSError):
+                pass # Not supported by the platform or the filesystems
+        if copied < size:
+            fsrc.seek(copied)
+            fdst.seek(copied)
+            shutil.copyfileobj(fsrc, fdst)
+    shutil.copymode(src, dst)
+
+
+def transfer_file(src, dst, mode='copy'):
+    """
+    Copy or link a file, falling back to a copy if the link fails
+    
+    # Arguments
+        src: Source file
+        dst: Destination file
+        mode: One of MODES
         
-        SRC_PATH: Source path
+    # Returns
+        The number of bytes written, and the number of bytes linked
+    """
+    
+    size = os.stat(src).st_size
+    try:
+        if mode == 'hardlink':
+            os.link(src, dst)
+            return 0, size
+        if mode == 'reflink':
+            reflink(src, dst)
+            return 0, size
+        if mode == 'symlink':
+            os.symlink(Path(src).resolve(), dst)
+            return 0, size
+    except OSError:
+        pass # Not supported by the filesystem (e.g. across devices), copy instead
+    
+    copy_file(src, dst)
+    return size, 0
+
+
+@instrument.timed('transfer')
+def transfer_with_retry(src, dst, mode='copy', retries=RETRIES):
+    """
+    Transfer a file, retrying after a failure
+    
+    # Arguments
+        src: Source file
+        dst: Destination file
+        mode: One of MODES
+        retries: Number of attempts
+        
+    # Returns
+        The number of bytes written, and the number of bytes linked
+    """
+    
+    for attempt in range(retries):
+        try:
+            return transfer_file(src, dst, mode)
+        except OSError:
+            if os.path.lexists(dst):
+                os.unlink(dst) # Remove the partial copy
+            if attempt == retries - 1:
+                raise
+            time.sleep(0.1 * 2 ** attempt)
+
+
+class TransferReport():
+    """
+    Progress and throughput of the transfers of a split, across all categories
+    """
+    
+    def __init__(self):
+        
+        self.files = 0
+        self.written = 0
+        self.linked = 0
+        self.failed = []
+        self.start = time.perf_counter()
+    
+    def update(self, src, future):
+        """
+        Account for a finished transfer
+        
+        # Arguments
+            src: Source file
+            future: Future of transfer_with_retry
+        """
+        
+        try:
+            w, l = future.result()
+        except OSError as e:
+            self.failed.append((src, e))
+            print(f'Failed to transfer {src}: {e}')
+            return
+        
+        self.files += 1
+        self.written += w
+        self.linked += l
+        instrument.count('bytes written', w)
+        instrument.count('bytes linked', l)
+        if self.files % PROGRESS_EVERY == 0:
+            print(f'{self.files} files, {self.rate() / 1e6:.1f} MB/s')
+    
+    def rate(self):
+        """
+        Throughput in bytes/sec (bytes written or linked)
+        """
+        
+        elapsed = time.perf_counter() - self.start
+        return (self.written + self.linked) / elapsed if elapsed > 0 else 0.0
+    
+    def summary(self):
+        """
+        Print the final report
+        """
+        
+        elapsed = time.perf_counter() - self.start
+        print(f'Transferred {self.files} files in {elapsed:.2f}s ({self.rate() / 1e6:.1f} MB/s)')
+        print(f'Bytes written: {self.written}, bytes linked: {self.linked}')
+        if self.failed:
+            print(f'{len(self.failed)} files could not be transferred:')
+            for src, e in self.failed:
+                print(f'  {src}: {e}')
+
+
+def is_valid_file(name, ratio=0.20, seed=None):
+    """
+    Assign a file to the validation set from the hash of its path
+    
+    The assignment only depends on the path and the seed, so files keep
+    their split when the dataset grows.
+    
+    # Arguments
+        
+        name: Path of the file relative to the dataset folder
+        
+        ratio: Split ratio
+        
+        seed: Split seed
+        
+    # Returns
+        True if the file belongs to the validation set
+    """
+    
+    digest = blake2b(f'{seed}/{name}'.encode(), digest_size=8).digest()
+    
+    return int.from_bytes(digest, 'big') < ratio * 2**64
+
+
+def split_category(cat, ratio=0.20, seed=None, strategy='shuffle'):
+    """
+    Split the files of a category
+    
+    With the 'hash' strategy, files are assigned as they are listed.
+    
+    # Arguments
+        
+        cat: Category path
+        
+        ratio: Split ratio
+        
+        seed: Split seed
+        
+        strategy: One of STRATEGIES
+        
+    # Returns
+        A generator of (file, split) where file is an os.DirEntry and split is TRAIN or VALID
+    """
+    
+    if strategy == 'hash':
+        for f in scan(cat, extensions=None):
+            yield f, VALID if is_valid_file(f'{cat.name}/{f.name}', ratio, seed) else TRAIN
+        return
+    
+    from sklearn.model_selection import train_test_split
+    
+    files = list(scan(cat, extensions=None))
+    train, val = train_test_split(files, shuffle=True, test_size=ratio, random_state=seed)
+    for f in train:
+        yield f, TRAIN
+    for f in val:
+        yield f, VALID
+
+
+def split_files(cats, DST_TRAIN, DST_VALID, ratio=0.20, seed=None, strategy='shuffle', files=None):
+    """
+    Split each category and yield the transfers to perform
+    
+    The destination folders of a category are created before its files
+    are yielded.
+    
+    # Arguments
+        
+        cats: Category paths
         
         DST_TRAIN: Destination path for training data
         
@@ -49,27 +318,357 @@ def copy_and_split(SRC_PATH, DST_TRAIN, DST_VALID, ratio=0.20, seed=None):
         ratio: Split ratio
         
         seed: Split seed
+        
+        strategy: One of STRATEGIES
+        
+        files: Optional dictionnary filled with {'category/file': [split, size, mtime_ns]}
+        
+    # Returns
+        A generator of (source, destination) paths
     """
     
-    cats = get_categories(SRC_PATH)
+    dst = {TRAIN: DST_TRAIN, VALID: DST_VALID}
     
     for cat in cats:
-        files = list(cat.iterdir())
-        print(f'Copying and splitting {cat} ({len(files)})')
+        print(f'Copying and splitting {cat}')
         
         (DST_TRAIN/cat.name).mkdir()
         (DST_VALID/cat.name).mkdir()
 
-        train, val = train_test_split(files, shuffle=True, test_size=ratio, random_state=seed)
+        count = {TRAIN: 0, VALID: 0}
+        for img, part in split_category(cat, ratio, seed, strategy):
+            count[part] += 1
+            if files is not None:
+                st = img.stat()
+                files[f'{cat.name}/{img.name}'] = [part, st.st_size, st.st_mtime_ns]
+            yield Path(img.path), dst[part]/cat.name/img.name
         
-        for img in train:
-            shutil.copy(img, DST_TRAIN/cat.name)
-        for img in val:
-            shutil.copy(img, DST_VALID/cat.name)
+        print(f'-> Train ({count[TRAIN]}), Valid ({count[VALID]})')
+
+
+class ManifestWriter():
+    """
+    Writer of a split manifest: one (path, class, size) row per file
+    """
+    
+    def __init__(self, path, fmt='csv'):
+        
+        self.fmt = fmt
+        self.file = open(path, 'w', newline='')
+        if fmt == 'csv':
+            import csv
+            self.csv = csv.writer(self.file)
+            self.csv.writerow(['path', 'class', 'size'])
+    
+    def write(self, path, index, size):
+        """
+        Write the row of a file
+        
+        # Arguments
+            path: Path relative to the dataset folder
+            index: Class index
+            size: File size in bytes
+        """
+        
+        if self.fmt == 'csv':
+            self.csv.writerow([path, index, size])
+        else:
+            self.file.write(json.dumps({'path': path, 'class': index, 'size': size}) + '\n')
+    
+    def close(self):
+        """
+        Close the manifest file
+        """
         
-        print(f'-> Train ({len(train)}), Valid ({len(val)})')
+        self.file.close()
 
+
+@instrument.timed('write_manifests')
+def write_manifests(SRC_PATH, DST_PATH, ratio=0.20, seed=None, fmt='csv', strategy='shuffle'):
+    """
+    Perform data splitting into manifest files, without touching the images.
+    
+    Writes train.<fmt> and valid.<fmt> in DST_PATH, and CLASSES_FILE with
+    the category names sorted by class index.
+    
+    # Arguments
+        
+        SRC_PATH: Source path
+        
+        DST_PATH: Destination path of the manifests
         
+        ratio: Split ratio
+        
+        seed: Split seed
+        
+        fmt: One of MANIFEST_FORMATS
+        
+        strategy: One of STRATEGIES
+        
+    # Returns
+        The number of training and validation files
+    """
+    
+    cats = sorted(get_categories(SRC_PATH), key=lambda c: c.name)
+    DST_PATH.mkdir(parents=True, exist_ok=True)
+    
+    with (DST_PATH/CLASSES_FILE).open('w') as f:
+        for cat in cats:
+            f.write(cat.name + '\n')
+    
+    manifests = {part: ManifestWriter(DST_PATH/f'{part}.{fmt}', fmt) for part in (TRAIN, VALID)}
+    count = {TRAIN: 0, VALID: 0}
+    
+    for index, cat in enumerate(cats):
+        for img, part in split_category(cat, ratio, seed, strategy):
+            manifests[part].write(f'{cat.name}/{img.name}', index, img.stat().st_size)
+            count[part] += 1
+    
+    for manifest in manifests.values():
+        manifest.close()
+    print(f'Manifests written to {DST_PATH}: Train ({count[TRAIN]}), Valid ({count[VALID]})')
+    
+    return count[TRAIN], count[VALID]
+
+
+def run_transfers(transfers, mode='copy', jobs=1):
+    """
+    Transfer files with a pool of threads
+    
+    At most 4 transfers per thread are in flight, so transfers can be a
+    generator listing the files as they are transferred.
+    
+    # Arguments
+        
+        transfers: Iterable of (source, destination) paths
+        
+        mode: Transfer mode of the images, one of MODES
+        
+        jobs: Number of concurrent transfers
+        
+    # Returns
+        The TransferReport of the transfers
+    """
+    
+    from concurrent.futures import ThreadPoolExecutor
+    
+    report = TransferReport()
+    
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        pending = deque()
+        for src, dst in instrument.timed_iter('list and split', transfers):
+            pending.append((src, executor.submit(transfer_with_retry, src, dst, mode)))
+            if len(pending) >= 4 * jobs:
+                report.update(*pending.popleft())
+        while pending:
+            report.update(*pending.popleft())
+
+    report.summary()
+    
+    return report
+
+
+@instrument.timed('copy_and_split')
+def copy_and_split(SRC_PATH, DST_TRAIN, DST_VALID, ratio=0.20, seed=None, mode='copy', jobs=1, strategy='shuffle'):
+    """
+    Perform data splitting.
+    
+    Files are transferred by a pool of threads while the next categories
+    are listed and split. The split is recorded in the STATE_FILE of the
+    destination folder for later --sync runs.
+    
+    # Arguments
+        
+        SRC_PATH: Source path
+        
+        DST_TRAIN: Destination path for training data
+        
+        DST_VALID: Destination path for validation data
+        
+        ratio: Split ratio
+        
+        seed: Split seed
+        
+        mode: Transfer mode of the images, one of MODES
+        
+        jobs: Number of concurrent transfers
+        
+        strategy: One of STRATEGIES
+        
+    # Returns
+        The TransferReport of the split
+    """
+    
+    cats = get_categories(SRC_PATH)
+    files = {}
+    
+    report = run_transfers(split_files(cats, DST_TRAIN, DST_VALID, ratio, seed, strategy, files), mode, jobs)
+    
+    mark_failed(files, report)
+    with instrument.stage('save state'):
+        save_state(DST_TRAIN.parent, {'ratio': ratio, 'seed': seed, 'strategy': strategy, 'files': files})
+    
+    return report
+
+
+def mark_failed(files, report):
+    """
+    Keep the split of the files which could not be transferred, with a
+    stale size and mtime, so that the next sync transfers them again
+    into the same split
+    
+    # Arguments
+        files: Dictionnary {'category/file': [split, size, mtime_ns]} of the split
+        report: TransferReport of the transfers
+    """
+    
+    for src, e in report.failed:
+        name = f'{src.parent.name}/{src.name}'
+        files[name] = [files[name][0], -1, -1]
+
+
+def load_state(DST_PATH):
+    """
+    Load the record of the last split of a destination folder
+    
+    # Arguments
+        DST_PATH: Destination path
+        
+    # Returns
+        The state dictionnary, or None if the folder has no STATE_FILE
+    """
+    
+    try:
+        with (DST_PATH/STATE_FILE).open() as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def save_state(DST_PATH, state):
+    """
+    Atomically write the record of a split in its destination folder
+    
+    # Arguments
+        DST_PATH: Destination path
+        state: Dictionnary with the split parameters and the split files
+    """
+    
+    tmp = DST_PATH/(STATE_FILE + '.tmp')
+    with tmp.open('w') as f:
+        json.dump(state, f, separators=(',', ':'))
+    os.replace(tmp, DST_PATH/STATE_FILE)
+
+
+def sync_files(cats, DST_PATH, state, files, stats, ratio=0.20, seed=None):
+    """
+    Compare the categories with the last split and yield the transfers to perform
+    
+    Unchanged files are left alone, modified files are transferred again
+    into the same split, and new files are assigned with is_valid_file.
+    Files missing from cats are then removed from the destination.
+    
+    # Arguments
+        
+        cats: Category paths
+        
+        DST_PATH: Destination path
+        
+        state: Record of the last split (see load_state)
+        
+        files: Dictionnary filled with the new {'category/file': [split, size, mtime_ns]}
+        
+        stats: Dictionnary counting the 'unchanged', 'new', 'modified' and 'removed' files
+        
+        ratio: Split ratio
+        
+        seed: Split seed
+        
+    # Returns
+        A generator of (source, destination) paths
+    """
+    
+    previous = state['files']
+    
+    for cat in cats:
+        (DST_PATH/TRAIN/cat.name).mkdir(exist_ok=True)
+        (DST_PATH/VALID/cat.name).mkdir(exist_ok=True)
+        
+        for img in scan(cat, extensions=None):
+            name = f'{cat.name}/{img.name}'
+            st = img.stat()
+            old = previous.pop(name, None)
+            if old is not None and old[1:] == [st.st_size, st.st_mtime_ns]:
+                files[name] = old
+                stats['unchanged'] += 1
+                continue
+            
+            if old is None:
+                part = VALID if is_valid_file(name, ratio, seed) else TRAIN
+                stats['new'] += 1
+            else:
+                part = old[0]
+                stats['modified'] += 1
+                if os.path.lexists(DST_PATH/part/name):
+                    os.unlink(DST_PATH/part/name)
+            files[name] = [part, st.st_size, st.st_mtime_ns]
+            yield Path(img.path), DST_PATH/part/name
+    
+    # Files deleted from the source
+    for name, old in previous.items():
+        if os.path.lexists(DST_PATH/old[0]/name):
+            os.unlink(DST_PATH/old[0]/name)
+        stats['removed'] += 1
+
+
+@instrument.timed('sync_split')
+def sync_split(SRC_PATH, DST_PATH, state, ratio=0.20, seed=None, mode='copy', jobs=1, strategy='shuffle'):
+    """
+    Update a previous split with the changes of the source folder
+    
+    # Arguments
+        
+        SRC_PATH: Source path
+        
+        DST_PATH: Destination path, containing a STATE_FILE
+        
+        state: Record of the last split (see load_state)
+        
+        ratio: Split ratio
+        
+        seed: Split seed
+        
+        mode: Transfer mode of the images, one of MODES
+        
+        jobs: Number of concurrent transfers
+        
+        strategy: One of STRATEGIES
+        
+    # Returns
+        The TransferReport of the transfers
+    """
+    
+    if [state['ratio'], state['seed'], state['strategy']] != [ratio, seed, strategy]:
+        print(f'"{DST_PATH}" was split with ratio={state["ratio"]}, seed={state["seed"]}, strategy={state["strategy"]}')
+        print('Please use the same parameters, or split again without --sync')
+        sys.exit(1)
+    
+    cats = get_categories(SRC_PATH)
+    files = {}
+    stats = {'unchanged': 0, 'new': 0, 'modified': 0, 'removed': 0}
+    
+    report = run_transfers(sync_files(cats, DST_PATH, state, files, stats, ratio, seed), mode, jobs)
+    
+    mark_failed(files, report)
+    state['files'] = files
+    save_state(DST_PATH, state)
+    
+    print(f'Unchanged ({stats["unchanged"]}), New ({stats["new"]}), '
+          f'Modified ({stats["modified"]}), Removed ({stats["removed"]})')
+    
+    return report
+
+
 def create_destination_folders(DST_PATH):
     """
     Create destination folders for training and validation sets.
@@ -130,6 +729,23 @@ def check_source_and_destination_folders(args):
     return SRC_PATH, DST_TRAIN, DST_VALID
 
 
+def add_arguments(parser):
+    """
+    Add the command line arguments to a parser
+    """
+
+    parser.add_argument('-s','--src', help='Source folder containing the dataset', required=True, type=str)
+    parser.add_argument('-d','--dst', help='Destination folder for the splitted dataset', required=True, type=str)
+    parser.add_argument('-r','--ratio', help='Split ratio', required=True, type=float)
+    parser.add_argument('-e','--seed', help='Split seed', required=False, type=int, default=None)
+    parser.add_argument('-m','--mode', help='Copy the images, or link them when the filesystem allows it (default: copy)', choices=MODES, default='copy')
+    parser.add_argument('-j','--jobs', help='Number of concurrent file transfers (default: 1)', required=False, type=int, default=1)
+    parser.add_argument('-t','--strategy', help='Shuffle each category, or assign each file from the hash of its path (default: shuffle)', choices=STRATEGIES, default='shuffle')
+    parser.add_argument('--sync', help='Only transfer new and modified files and remove deleted ones since the last split', action='store_true')
+    parser.add_argument('--manifest', help='Only write manifests of the split files (default format: csv)', nargs='?', choices=MANIFEST_FORMATS, const='csv', default=None)
+    instrument.add_arguments(parser)
+
+
 def parse_arguments():
     """
     Parse command line arguments.
@@ -139,35 +755,63 @@ def parse_arguments():
     """
     
     parser = argparse.ArgumentParser(description='Dataset Split!')
-    parser.add_argument('-s','--src', help='Source folder containing the dataset', required=True, type=str)
-    parser.add_argument('-d','--dst', help='Destination folder for the splitted dataset', required=True, type=str)
-    parser.add_argument('-r','--ratio', help='Split ratio', required=True, type=float)
-    parser.add_argument('-e','--seed', help='Split seed', required=False, type=int, default=None)
+    add_arguments(parser)
     args = vars(parser.parse_args())
 
     return args
 
 
-def main():    
+def main(args=None):
     """
     Main function
+
+    # Arguments
+        args: Dictionnary of command line arguments (default: parsed from sys.argv)
     """
     
     # Parse command line arguments
-    args = parse_arguments()
+    if args is None:
+        args = parse_arguments()
+    
+    with instrument.profile(args):
+        # Create variables for split ratio and seed
+        ratio = args['ratio']
+        seed = args['seed']
+        mode = args['mode']
+        jobs = args['jobs']
+        strategy = args['strategy']
+    
+        # Only write the manifests of the split
+        if args['manifest'] is not None:
+            SRC_PATH = Path(args['src'])
+            if SRC_PATH.is_dir() is False:
+                print(f'"{SRC_PATH}" does not exist!')
+                sys.exit(1)
+            write_manifests(SRC_PATH, Path(args['dst']), ratio, seed, args['manifest'], strategy)
+            print('Done!')
+            return
     
-    # Check if source and destination folders exist
-    SRC_PATH, DST_PATH_TRAIN, DST_PATH_VALID = check_source_and_destination_folders(args)
+        # Update the previous split
+        if args['sync']:
+            SRC_PATH, DST_PATH = Path(args['src']), Path(args['dst'])
+            if SRC_PATH.is_dir() is False:
+                print(f'"{SRC_PATH}" does not exist!')
+                sys.exit(1)
+            state = load_state(DST_PATH)
+            if state is not None:
+                sync_split(SRC_PATH, DST_PATH, state, ratio, seed, mode, jobs, strategy)
+                print('Done!')
+                return
+            print(f'No previous split found in "{DST_PATH}"')
     
-    # Create variables for split ratio and seed
-    ratio = args['ratio']
-    seed = args['seed']
+        # Check if source and destination folders exist
+        SRC_PATH, DST_PATH_TRAIN, DST_PATH_VALID = check_source_and_destination_folders(args)
    
-    # Perform data splitting
-    copy_and_split(SRC_PATH, DST_PATH_TRAIN, DST_PATH_VALID, ratio, seed)
+        # Perform data splitting
+        copy_and_split(SRC_PATH, DST_PATH_TRAIN, DST_PATH_VALID, ratio, seed, mode, jobs, strategy)
     
-    # End
-    print('Done!')
+        # End
+        print('Done!')
 
     
 if __name__ == "__main__":
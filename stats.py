@@ -0,0 +1,433 @@
+# Copyright 2018 Mikaël Swawola. All Rights Reserved.
+#
+# GNU GENERAL PUBLIC LICENSE
+# Version 3, 29 June 2007
+# ==============================================================================
+
+import sys
+import json
+import math
+import argparse
+from pathlib import Path
+
+from scanner import scan_dirs
+from annotations import TextStore, SQLiteStore
+from lazy import lazy_import
+
+np = lazy_import('numpy')
+
+# Number of boxes loaded in memory at once
+CHUNK_BOXES = 1 << 20
+
+# Number of box pairs compared at once
+PAIR_BATCH = 1 << 22
+
+# IoU above which two boxes of the same image are reported as overlapping
+IOU_THRESHOLD = 0.5
+
+# IoU above which two overlapping boxes are reported as duplicates
+DUPLICATE_IOU = 0.95
+
+# Number of overlapping pairs listed in the report (all of them are counted)
+MAX_OVERLAPS = 10000
+
+# Histogram bins, log2 spaced (start, stop and step exponents): box sides in
+# pixels and aspect ratios (width / height)
+SIZE_BINS = (0, 16.5, 0.5)
+ASPECT_BINS = (-6, 6.25, 0.25)
+
+
+class Distribution():
+    """
+    Histogram and moments of a value, accumulated chunk by chunk
+    """
+
+    def __init__(self, bins):
+
+        self.edges = 2 ** np.arange(*bins)
+        self.counts = np.zeros(len(self.edges) + 1, dtype=np.int64)
+        self.n = 0
+        self.total = 0.0
+        self.squares = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+
+    def add(self, values):
+        """
+        Add an array of values
+        """
+
+        if len(values) == 0:
+            return
+        self.counts += np.bincount(np.searchsorted(self.edges, values, side='right'),
+                                   minlength=len(self.counts))
+        self.n += len(values)
+        self.total += values.sum()
+        self.squares += np.square(values).sum()
+        self.min = min(self.min, values.min())
+        self.max = max(self.max, values.max())
+
+    def summary(self):
+        """
+        Summary as a JSON-serializable dictionnary
+
+        counts[0] holds the values below edges[0], counts[i] the values
+        between edges[i-1] and edges[i], and counts[-1] the values above
+        edges[-1].
+        """
+
+        if self.n == 0:
+            return {'count': 0}
+        mean = self.total / self.n
+
+        return {'count': self.n, 'mean': mean, 'std': max(self.squares / self.n - mean ** 2, 0.0) ** 0.5,
+                'min': float(self.min), 'max': float(self.max),
+                'edges': self.edges.tolist(), 'counts': self.counts.tolist()}
+
+
+def box_pairs(ends):
+    """
+    Enumerate the pairs of boxes belonging to the same image, in batches
+
+    # Arguments
+        ends: For each box, the index following the last box of its image
+              (boxes of an image are contiguous)
+
+    # Returns
+        A generator of (first, second) index arrays, with first < second,
+        of at most PAIR_BATCH pairs (unless a single box has more partners)
+    """
+
+    n = len(ends)
+    partners = ends - np.arange(n) - 1
+    starts = np.concatenate(([0], np.cumsum(partners)))
+    lo = 0
+    while lo < n:
+        hi = max(int(np.searchsorted(starts, starts[lo] + PAIR_BATCH, side='right')) - 1, lo + 1)
+        counts = partners[lo:hi]
+        first = np.repeat(np.arange(lo, hi), counts)
+        offsets = np.arange(len(first)) - np.repeat(starts[lo:hi] - starts[lo], counts)
+        yield first, first + 1 + offsets
+        lo = hi
+
+
+def pairwise_iou(x1, y1, x2, y2, first, second):
+    """
+    Intersection over union of pairs of boxes
+
+    # Arguments
+        x1, y1, x2, y2: Coordinate columns of the boxes
+        first, second: Index arrays of the pairs
+    """
+
+    w = np.minimum(x2[first], x2[second]) - np.maximum(x1[first], x1[second])
+    h = np.minimum(y2[first], y2[second]) - np.maximum(y1[first], y1[second])
+    inter = np.maximum(w, 0) * np.maximum(h, 0)
+    area = (x2 - x1) * (y2 - y1)
+    union = area[first] + area[second] - inter
+
+    return np.divide(inter, union, out=np.zeros_like(inter), where=union > 0)
+
+
+def finite_coordinates(tokens):
+    """
+    Check that the coordinates of the boxes of a label file are finite numbers
+
+    # Arguments
+        tokens: Tokens of the label file without its first line (5 per box)
+    """
+
+    try:
+        return all(math.isfinite(float(x)) for (i, x) in enumerate(tokens) if i % 5 < 4)
+    except ValueError:
+        return False
+
+
+def box_table(tokens, valid):
+    """
+    Table of the boxes of the valid label files of a chunk
+
+    # Arguments
+        tokens: Tokens of each label file without its first line
+        valid: Whether each label file is kept
+
+    # Returns
+        The (boxes, 5) object array of the tokens, and the (boxes, 4) array
+        of the coordinates, or None if some of them are not finite numbers
+    """
+
+    table = np.array([x for (t, v) in zip(tokens, valid) if v for x in t], dtype=object).reshape(-1, 5)
+    try:
+        coords = table[:, :4].astype(np.float64)
+    except ValueError:
+        return table, None
+
+    return table, (coords if np.isfinite(coords).all() else None)
+
+
+class AnnotationStats():
+    """
+    Dataset statistics accumulated over chunks of boxes
+    """
+
+    def __init__(self, iou=IOU_THRESHOLD):
+
+        self.iou = iou
+        self.images = 0
+        self.malformed = []
+        self.classes = {}
+        self.class_counts = np.zeros(0, dtype=np.int64)
+        self.per_image = np.zeros(0, dtype=np.int64)
+        self.width = Distribution(SIZE_BINS)
+        self.height = Distribution(SIZE_BINS)
+        self.aspect = Distribution(ASPECT_BINS)
+        self.degenerate = 0
+        self.overlaps = []
+        self.overlap_count = 0
+        self.duplicate_count = 0
+
+    def add_chunk(self, names, counts, bodies):
+        """
+        Add a chunk of images
+
+        # Arguments
+            names: Names of the images
+            counts: Number of boxes announced on the first line of each label file
+            bodies: Label files content without their first line, in the same order
+        """
+
+        # A file is malformed if it does not have 5 tokens per announced box,
+        # or if its coordinates are not numbers (checked file by file only
+        # when the chunk does not convert)
+        tokens = [b.split() for b in bodies]
+        valid = [len(t) == 5 * n for (n, t) in zip(counts, tokens)]
+        table, coords = box_table(tokens, valid)
+        if coords is None:
+            valid = [v and finite_coordinates(t) for (v, t) in zip(valid, tokens)]
+            table, coords = box_table(tokens, valid)
+        self.malformed.extend(name for (name, v) in zip(names, valid) if not v)
+        names, counts = ([x for (x, v) in zip(l, valid) if v] for l in (names, counts))
+
+        self.images += len(names)
+        if not names:
+            return
+        counts = np.asarray(counts, dtype=np.int64)
+        self.per_image = np.pad(self.per_image, (0, max(counts.max() + 1 - len(self.per_image), 0)))
+        self.per_image += np.bincount(counts, minlength=len(self.per_image))
+        if len(table) == 0:
+            return
+
+        x1, y1, x2, y2 = coords.T
+        labels = table[:, 4]
+        for l in set(labels) - self.classes.keys():
+            self.classes[l] = len(self.classes)
+        labels = np.fromiter(map(self.classes.get, labels), dtype=np.int64, count=len(labels))
+        self.class_counts = np.pad(self.class_counts, (0, len(self.classes) - len(self.class_counts)))
+        self.class_counts += np.bincount(labels, minlength=len(self.classes))
+
+        w, h = x2 - x1, y2 - y1
+        valid = (w > 0) & (h > 0)
+        self.degenerate += int((~valid).sum())
+        self.width.add(w)
+        self.height.add(h)
+        self.aspect.add(w[valid] / h[valid])
+
+        # Pairwise IoU within each image
+        image = np.repeat(np.arange(len(counts)), counts)
+        ends = np.cumsum(counts)
+        index = np.arange(len(labels)) - (ends - counts)[image]
+        for first, second in box_pairs(ends[image]):
+            iou = pairwise_iou(x1, y1, x2, y2, first, second)
+            found = np.flatnonzero(iou >= self.iou)
+            self.overlap_count += len(found)
+            self.duplicate_count += int((iou[found] >= DUPLICATE_IOU).sum())
+            for k in found[:MAX_OVERLAPS - len(self.overlaps)]:
+                i, j = first[k], second[k]
+                self.overlaps.append((names[image[i]], int(index[i]), int(index[j]), float(iou[k])))
+
+    def report(self):
+        """
+        The statistics as a JSON-serializable dictionnary
+        """
+
+        classes = sorted(self.classes, key=self.classes.get)
+
+        return {
+            'images': self.images,
+            'boxes': int(self.class_counts.sum()),
+            'classes': {c: int(self.class_counts[i]) for (i, c) in enumerate(classes)},
+            'boxes_per_image': {n: int(c) for (n, c) in enumerate(self.per_image) if c},
+            'width': self.width.summary(),
+            'height': self.height.summary(),
+            'aspect_ratio': self.aspect.summary(),
+            'degenerate': self.degenerate,
+            'overlap_count': self.overlap_count,
+            'duplicate_count': self.duplicate_count,
+            'overlaps': [{'image': name, 'boxes': [i, j], 'iou': iou, 'duplicate': iou >= DUPLICATE_IOU}
+                         for (name, i, j, iou) in self.overlaps],
+            'malformed': self.malformed,
+        }
+
+
+def compute_stats(texts, iou=IOU_THRESHOLD, chunk_boxes=CHUNK_BOXES):
+    """
+    Compute the statistics of label files
+
+    The boxes are loaded in chunks of about chunk_boxes boxes (an image is
+    never split between two chunks) and each chunk is processed as NumPy
+    arrays, so memory stays bounded whatever the number of boxes.
+
+    # Arguments
+        texts: Iterable of (image name, label file content), as given by the texts() method of the stores
+        iou: IoU above which two boxes of the same image are reported
+        chunk_boxes: Number of boxes per chunk
+
+    # Returns
+        The statistics, as a dictionnary (see AnnotationStats.report)
+    """
+
+    stats = AnnotationStats(iou)
+    names, counts, bodies = [], [], []
+    boxes = 0
+    for name, text in texts:
+        head, _, body = text.lstrip().partition('\n')
+        try:
+            n = int(head)
+        except ValueError:
+            n = -1
+        if n < 0:
+            stats.malformed.append(name)
+            continue
+        names.append(name)
+        counts.append(n)
+        bodies.append(body)
+        boxes += n
+        if boxes >= chunk_boxes:
+            stats.add_chunk(names, counts, bodies)
+            names, counts, bodies = [], [], []
+            boxes = 0
+    if names:
+        stats.add_chunk(names, counts, bodies)
+
+    return stats.report()
+
+
+def label_texts(labels):
+    """
+    Iterate over the label files of a labels folder, in text and SQLite stores
+
+    # Arguments
+        labels: Labels folder (Labels/)
+
+    # Returns
+        A generator of ('images folder/image name', label file content)
+    """
+
+    labels = Path(labels)
+    for entry in sorted(scan_dirs(labels), key=lambda e: e.name):
+        if entry.name.startswith('.'):
+            continue
+        for name, text in TextStore(entry.path).texts():
+            yield f'{entry.name}/{name}', text
+    for path in sorted(labels.glob('*.sqlite')):
+        store = SQLiteStore(path)
+        for name, text in store.texts():
+            yield f'{path.stem}/{name}', text
+        store.close()
+
+
+def annotation_stats(labels, iou=IOU_THRESHOLD, chunk_boxes=CHUNK_BOXES):
+    """
+    Compute the statistics of all the labels of a labels folder
+
+    # Arguments
+        labels: Labels folder (Labels/)
+        iou: IoU above which two boxes of the same image are reported
+        chunk_boxes: Number of boxes per chunk
+
+    # Returns
+        The statistics, as a dictionnary (see AnnotationStats.report)
+    """
+
+    return compute_stats(label_texts(labels), iou, chunk_boxes)
+
+
+def print_distribution(name, d):
+    """
+    Print the summary of a distribution
+    """
+
+    if d['count'] == 0:
+        return
+    print(f'{name:>12}: mean {d["mean"]:.1f}  std {d["std"]:.1f}  min {d["min"]:.1f}  max {d["max"]:.1f}')
+
+
+def add_arguments(parser):
+    """
+    Add the command line arguments to a parser
+    """
+
+    parser.add_argument('-l','--labels', help='Labels folder, containing one folder or SQLite file per images folder (default: Labels)', required=False, type=str, default='Labels')
+    parser.add_argument('--iou', help=f'IoU above which two boxes of an image are reported (default: {IOU_THRESHOLD})', required=False, type=float, default=IOU_THRESHOLD)
+    parser.add_argument('-o','--output', help='Write the full report, with histograms, to a JSON file', required=False, type=str, default=None)
+
+
+def parse_arguments():
+    """
+    Parse command line arguments.
+
+    # Returns
+        Dictionnary containing the command line arguments
+    """
+
+    parser = argparse.ArgumentParser(description='Statistics of the bounding box labels')
+    add_arguments(parser)
+    args = vars(parser.parse_args())
+
+    return args
+
+
+def main(args=None):
+    """
+    Main function
+
+    # Arguments
+        args: Dictionnary of command line arguments (default: parsed from sys.argv)
+    """
+
+    if args is None:
+        args = parse_arguments()
+
+    if not Path(args['labels']).is_dir():
+        print(f'Labels folder {args["labels"]} does not exist')
+        sys.exit(1)
+
+    report = annotation_stats(args['labels'], iou=args['iou'])
+
+    print(f'{report["images"]} images, {report["boxes"]} boxes')
+    for c, n in sorted(report['classes'].items(), key=lambda x: -x[1]):
+        print(f'{c:>12}: {n}')
+    print('Boxes per image: ' + ', '.join(f'{n}: {c}' for (n, c) in report['boxes_per_image'].items()))
+    print_distribution('width', report['width'])
+    print_distribution('height', report['height'])
+    print_distribution('aspect ratio', report['aspect_ratio'])
+    if report['degenerate']:
+        print(f'{report["degenerate"]} boxes with an empty area')
+    for o in report['overlaps']:
+        kind = 'duplicate' if o['duplicate'] else 'overlap'
+        print(f'{kind}: {o["image"]} boxes {o["boxes"][0]} and {o["boxes"][1]} (IoU {o["iou"]:.2f})')
+    if report['overlap_count'] > len(report['overlaps']):
+        print(f'... {report["overlap_count"]} overlapping pairs in total, {report["duplicate_count"]} duplicates '
+              f'(only the first {len(report["overlaps"])} are listed)')
+    for name in report['malformed']:
+        print(f'malformed: {name}')
+
+    if args['output'] is not None:
+        with open(args['output'], 'w') as f:
+            json.dump(report, f, indent=2)
+
+    print('Done!')
+
+
+if __name__ == "__main__":
+    main()
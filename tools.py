@@ -0,0 +1,62 @@
+# Copyright 2018 Mikaël Swawola. All Rights Reserved.
+#
+# GNU GENERAL PUBLIC LICENSE
+# Version 3, 29 June 2007
+# ==============================================================================
+
+import sys
+import argparse
+import importlib
+
+# Subcommands: name -> (module, description)
+# Only the module of the selected subcommand is imported.
+COMMANDS = {
+    'split': ('split', 'Split a dataset into train and validation sets'),
+    'duplicates': ('duplicate_find', 'Find identical or near-duplicate images'),
+    'index': ('duplicate_index', 'Persistent index of identical images across folders'),
+    'label': ('bbox', 'Bounding box labeler'),
+    'annotations': ('annotations', 'Annotation store export and import'),
+    'convert': ('convert', 'Validate the bounding box labels and convert them'),
+    'stats': ('stats', 'Statistics of the bounding box labels'),
+    'benchmark': ('benchmark', 'Benchmarks'),
+}
+
+
+def parse_arguments(argv=None):
+    """
+    Parse command line arguments.
+
+    The arguments of a subcommand are added only when it is selected, so
+    that the other modules and their dependencies are not imported.
+
+    # Arguments
+        argv: Command line arguments (default: sys.argv[1:])
+
+    # Returns
+        The subcommand name and the dictionnary containing its arguments
+    """
+
+    argv = sys.argv[1:] if argv is None else argv
+    parser = argparse.ArgumentParser(description='Dataset tools')
+    subparsers = parser.add_subparsers(dest='command', metavar='command')
+    subparsers.required = True
+    for name, (module, description) in COMMANDS.items():
+        sub = subparsers.add_parser(name, help=description, description=description)
+        if argv and argv[0] == name:
+            importlib.import_module(module).add_arguments(sub)
+    args = vars(parser.parse_args(argv))
+
+    return args.pop('command'), args
+
+
+def main():
+    """
+    Main function
+    """
+
+    command, args = parse_arguments()
+    importlib.import_module(COMMANDS[command][0]).main(args)
+
+
+if __name__ == "__main__":
+    main()